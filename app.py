@@ -5,53 +5,108 @@
 # - Signature Twilio optionnelle
 # - .env auto (python-dotenv)
 
-import sys, os, time, uuid, unicodedata
+import sys, os, time, uuid, threading
+from infra import startup as _startup  # profil de démarrage (avant les imports lourds)
 from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from flask import Flask, request, jsonify, Response, g
-from concurrent.futures import ThreadPoolExecutor
-from dotenv import load_dotenv
+_startup.mark("import_flask")
 
-def _clean_outgoing(text: str) -> str:
-    s = unicodedata.normalize("NFC", text or "")
-    s = s.replace("\u202f", " ").replace("\xa0", " ")
-    try:
-        s.encode("utf-8")
-    except Exception:
-        s = s.encode("utf-8", "ignore").decode("utf-8", "ignore")
-    return s
-
-# ---- .env ----
-load_dotenv()
+# ---- .env, configuration et logique partagées avec asgi.py ----
+import server_common as _common
+from server_common import clean_outgoing as _clean_outgoing, twilio_ready as _twilio_ready
+from server_common import outbox_ready as _outbox_ready, twiml as _twiml
+from server_common import system_prompt as _system_prompt, history_budget as _history_budget
 
 # ---- Noyau mémoire (SQLite) ----
 # (Ton projet avait un chemin "lanai_core" — ici on importe simplement "core")
 import core as coreapp  # expose bootstrap_memory, process_incoming
+from core import prompt as _prompt
+from core import jobs as _jobs
+from core import router as _router
+from core import outbox as _outbox
+from core import fastpath as _fastpath
+from core import response_cache as _rcache
+from core.dispatch import Dispatcher
+from infra.monitoring import incr as _incr
+from infra.monitoring import observe as _observe
+from infra.monitoring import span as _span, prometheus_text as _prometheus_text
+from infra import resilience as _resilience
+from infra.resilience import Unavailable as _Unavailable
+_startup.mark("import_core")
+
+# ---- OpenAI (timeouts/retries) : variables lues par server_common ----
+OPENAI_API_KEY = _common.OPENAI_API_KEY
+_FALLBACK_REPLY = _common.FALLBACK_REPLY
 
-# ---- OpenAI (timeouts/retries) ----
-OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
-OPENAI_MODEL = os.environ.get("OPENAI_MODEL", "gpt-4o-mini")
-OPENAI_TIMEOUT = float(os.environ.get("OPENAI_REQUEST_TIMEOUT", "8"))
-OPENAI_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "1"))
-OPENAI_MAX_TOKENS = int(os.environ.get("OPENAI_MAX_TOKENS", "180"))
+# Échéance dure (epoch) de la génération en cours sur ce thread, posée par
+# l'Option B (TwiML) ; None = timeouts/retries habituels.
+_deadline = threading.local()
+
+def _openai_budget():
+    """(timeout, retries) bornés par l'échéance du thread, ou None si elle est dépassée."""
+    return _common.openai_budget(getattr(_deadline, "t", None))
 
 def _openai_generate(prompt_messages: List[Dict]) -> str:
+    # Modèle et max_tokens choisis par core.router (message court → modèle rapide).
+    # Prompts répétés (même prompt complet : système, résumé, historique, texte) : réponse
+    # servie par le cache si le profil l'a activé ; les replis ne sont pas gardés.
+    route = _router.route(prompt_messages)
+    return _rcache.cached(route.model, prompt_messages, lambda: _openai_call(prompt_messages, route),
+                          temperature=0.3, skip=(_FALLBACK_REPLY,))
+
+def _openai_call(prompt_messages: List[Dict], route=None) -> str:
     import time as _t
+    route = route or _router.route(prompt_messages)
     t0 = _t.time()
+    budget = _openai_budget()
+    if budget is None:
+        _incr("llm_deadline_exceeded")
+        print("[GPT][deadline] échéance dépassée, pas d'appel", flush=True)
+        return _FALLBACK_REPLY
     try:
-        from openai import OpenAI
-        base = OpenAI(api_key=OPENAI_API_KEY)
-        client = base.with_options(timeout=OPENAI_TIMEOUT, max_retries=OPENAI_RETRIES)
-        r = client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=prompt_messages,
-            temperature=0.3,
-            max_tokens=OPENAI_MAX_TOKENS
-        )
+        from core import llm
+        # client partagé (pool keep-alive) ; timeout/retries propres au webhook
+        client = llm.client().with_options(timeout=budget[0], max_retries=budget[1])
+        t1 = _t.time()
+        if OPENAI_STREAM:
+            with _span("llm"):
+                return _openai_stream(llm, client, prompt_messages, t0, route)
+        # disjoncteur + limite adaptative : échec immédiat pendant une panne amont
+        with _span("llm"):
+            r = llm.upstream.call(
+                client.chat.completions.create,
+                model=route.model,
+                messages=prompt_messages,
+                temperature=0.3,
+                max_tokens=route.max_tokens
+            )
         dt = int((_t.time() - t0) * 1000)
-        print(f"[GPT][v1] ms={dt}", flush=True)
-        return (r.choices[0].message.content or "").strip()
+        setup_ms = int((t1 - t0) * 1000)
+        tm = llm.last_call_timing()
+        gen_ms = int((_t.time() - t1) * 1000 - tm["connect_ms"])
+        usage = getattr(r, "usage", None)
+        prompt_tokens = getattr(usage, "prompt_tokens", None)
+        print(f"[GPT][v1] ms={dt} setup_ms={setup_ms} connect_ms={tm['connect_ms']} new_conn={tm['new_conn']} "
+              f"gen_ms={gen_ms} prompt_tokens={prompt_tokens} route={route.name} model={route.model}", flush=True)
+        reply = (r.choices[0].message.content or "").strip()
+        _router.record(route, dt, usage)
+        _router.maybe_shadow(route, prompt_messages, reply, dt, usage)
+        return reply
+    except _Unavailable as e1:
+        _incr("llm_degraded")
+        print(f"[GPT][degraded] {e1}", flush=True)
+        return _FALLBACK_REPLY
     except Exception as e1:
         print(f"[GPT][v1-fail] {e1}", flush=True)
+        _router.record(route, (_t.time() - t0) * 1000, error=e1)
+        if not isinstance(e1, ImportError) and llm.upstream.is_failure(e1):
+            # panne/lenteur amont : le SDK legacy taperait le même service
+            return _FALLBACK_REPLY
+    budget = _openai_budget()
+    if budget is None:
+        _incr("llm_deadline_exceeded")
+        return _FALLBACK_REPLY
     try:
         import openai
         if OPENAI_API_KEY:
@@ -60,8 +115,8 @@ def _openai_generate(prompt_messages: List[Dict]) -> str:
             model=os.environ.get("OPENAI_MODEL_FALLBACK", "gpt-3.5-turbo"),
             messages=prompt_messages,
             temperature=0.3,
-            max_tokens=OPENAI_MAX_TOKENS,
-            request_timeout=OPENAI_TIMEOUT
+            max_tokens=route.max_tokens,
+            request_timeout=budget[0]
         )
         dt = int((_t.time() - t0) * 1000)
         print(f"[GPT][v028] ms={dt}", flush=True)
@@ -69,91 +124,129 @@ def _openai_generate(prompt_messages: List[Dict]) -> str:
     except Exception as e2:
         dt = int((_t.time() - t0) * 1000)
         print(f"[GPT][v028-fail] ms={dt} err={e2}", flush=True)
-        return "Désolé, je ne peux pas répondre pour le moment."
+        return _FALLBACK_REPLY
 
-def _load_system_prompt() -> str:
-    txt = "Tu es un compagnon simple et bienveillant. Phrases courtes. Ton chaleureux."
-    try:
-        path = os.path.join(os.path.dirname(__file__), "LLM_SYSTEM_PROMPT.txt")
-        if os.path.exists(path):
-            with open(path, "r", encoding="utf-8") as f:
-                raw = (f.read() or "").strip()
-                if raw:
-                    txt = raw
-    except Exception:
-        pass
-    return txt
+# ---- Streaming (OPENAI_STREAM=1) ----
+# La complétion est lue en flux et coupée à REPLY_MAX_CHARS (défaut : profil).
+# Option A + STREAM_EARLY_SEND=1 : la/les première(s) phrase(s) partent via
+# _send_whatsapp pendant que la suite est générée ; _handle_burst n'envoie
+# ensuite que le reste.
+OPENAI_STREAM = os.environ.get("OPENAI_STREAM", "0") == "1"
+STREAM_EARLY_SEND = os.environ.get("STREAM_EARLY_SEND", "1") == "1"
+_stream_ctx = threading.local()  # to (destinataire), t0, sent (texte déjà envoyé)
+
+def _reply_max_chars() -> int:
+    env = int(os.environ.get("REPLY_MAX_CHARS", "0"))
+    if env > 0:
+        return env
+    from core import llm
+    return llm.reply_max_chars(llm.load_profile(os.environ.get("PROFILE_PATH", "profile.json")))
+
+def _note_first_message():
+    t0 = getattr(_stream_ctx, "t0", None)
+    if t0 is not None:
+        _observe("ttfm_ms", (time.time() - t0) * 1000)
+        _stream_ctx.t0 = None
 
-def _history_to_msgs(history: List[Dict]) -> List[Dict]:
-    msgs = []
-    for h in history:
-        role = "user" if (h.get("direction") == "IN") else "assistant"
-        msgs.append({"role": role, "content": h.get("text", "")})
-    return msgs
+def _send_early(to: str, part: str):
+    out_sid = _send_whatsapp(to, part)
+    if out_sid:
+        _stream_ctx.sent = part
+        _note_first_message()
+        _incr("stream_early_sent")
+        print(f"[OUT][early] to={to} tw_sid={out_sid} chars={len(part)}", flush=True)
+
+def _openai_stream(llm, client, prompt_messages: List[Dict], t0: float, route) -> str:
+    to = getattr(_stream_ctx, "to", None)
+    on_early = (lambda part: _send_early(to, part)) if (to and STREAM_EARLY_SEND) else None
+    max_chars = _reply_max_chars()
+    # flux lu sous le disjoncteur/limiteur : durée totale et coupures comptent
+    try:
+        text, info = llm.stream_completion(
+            client.chat.completions.create,
+            max_chars,
+            on_early,
+            model=route.model,
+            messages=prompt_messages,
+            temperature=0.3,
+            max_tokens=route.max_tokens,
+        )
+    except llm.StreamInterrupted as e:
+        _rcache.skip_store()  # réponse partielle : envoyée, jamais mise en cache
+        _incr("llm_stream_interrupted")
+        text, info = e.text, e.info
+    if info["ttft_ms"] is not None:
+        _observe("llm_ttft_ms", info["ttft_ms"])
+    ms = (time.time() - t0) * 1000
+    print(f"[GPT][stream] ms={int(ms)} ttft_ms={info['ttft_ms']} route={route.name} "
+          f"early_ms={info['early_ms']} truncated={info['truncated']} err={info['error']}", flush=True)
+    _router.record(route, ms, error=info["error"], ttft_ms=info["ttft_ms"])
+    return llm.truncate(text, max_chars)
 
 def _generate_with_history(user_text: str, history: List[Dict]) -> str:
-    msgs = [{"role": "system", "content": _load_system_prompt()}]
-    msgs.extend(_history_to_msgs(history))
-    msgs.append({"role": "user", "content": user_text})
+    msgs = _common.prompt_messages(user_text, history)
+    est = _system_prompt().tokens + sum(_prompt.message_tokens(m["content"]) for m in msgs[1:])
+    print(f"[PROMPT] est_tokens={est} turns={len(history)}", flush=True)
     return _openai_generate(msgs)
 
 # ---- Twilio (Option A: API) + fallback TwiML (Option B) ----
-try:
-    from twilio.rest import Client as TwilioClient
-    from twilio.request_validator import RequestValidator
-    _TWILIO_SDK_OK = True
-except Exception:
-    TwilioClient = None
-    RequestValidator = None
-    _TWILIO_SDK_OK = False
-
-TWILIO_SID   = os.environ.get("TWILIO_ACCOUNT_SID")
-TWILIO_TOKEN = os.environ.get("TWILIO_AUTH_TOKEN")
-# >>> multi-ENV pour FROM (évite les confusions entre noms)
-TWILIO_FROM  = (
-    os.environ.get("TWILIO_WHATSAPP_FROM")
-    or os.environ.get("TWILIO_SANDBOX_FROM")
-    or os.environ.get("TWILIO_FROM")
-    or os.environ.get("TWILIO_WHATSAPP_NUMBER")
-    or ""
-)
-VERIFY_TWILIO_SIGNATURE = (os.environ.get("VERIFY_TWILIO_SIGNATURE", "false").lower() == "true")
-
-twilio_client = TwilioClient(TWILIO_SID, TWILIO_TOKEN) if (_TWILIO_SDK_OK and TWILIO_SID and TWILIO_TOKEN) else None
-twilio_validator = RequestValidator(TWILIO_TOKEN) if (VERIFY_TWILIO_SIGNATURE and _TWILIO_SDK_OK and TWILIO_TOKEN) else None
+# Configuration (SID, token, FROM, signature) lue par server_common.
+TWILIO_SID = _common.TWILIO_SID
+TWILIO_FROM = _common.TWILIO_FROM
+
+_twilio = {}  # "client", créé à la demande
+_twilio_lock = threading.Lock()
+# Session HTTP keep-alive partagée : un slot par thread d'envoi (core.outbox) + envois directs
+TWILIO_POOL_SIZE = int(os.environ.get("TWILIO_POOL_SIZE")
+                       or _outbox.CONCURRENCY + int(os.environ.get("WEBHOOK_WORKERS", "4")))
+TWILIO_TIMEOUT = float(os.environ.get("TWILIO_TIMEOUT", "10"))
+
+def _twilio_client():
+    c = _twilio.get("client")
+    if c is None and _common.TWILIO_SDK_OK and TWILIO_SID and _common.TWILIO_TOKEN:
+        with _twilio_lock:
+            c = _twilio.get("client")
+            if c is None:
+                from requests.adapters import HTTPAdapter
+                from twilio.http.http_client import TwilioHttpClient
+                from twilio.rest import Client as TwilioClient
+                http = TwilioHttpClient(timeout=TWILIO_TIMEOUT)
+                # pas de retry urllib3 : les nouveaux essais passent par core.outbox (backoff)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=TWILIO_POOL_SIZE, max_retries=0)
+                http.session.mount("https://", adapter)
+                http.session.mount("http://", adapter)
+                c = _twilio["client"] = TwilioClient(TWILIO_SID, _common.TWILIO_TOKEN, http_client=http)
+    return c
 
 def _verify_twilio(req) -> bool:
-    if not VERIFY_TWILIO_SIGNATURE:
-        return True
-    if not twilio_validator:
-        return False
-    try:
-        signature = req.headers.get("X-Twilio-Signature", "")
-        url = req.url
-        params = dict(req.form)
-        return twilio_validator.validate(url, params, signature)
-    except Exception as e:
-        print(f"[SIG][err] {e}", flush=True)
-        return False
+    return _common.verify_twilio(req.url, dict(req.form), req.headers.get("X-Twilio-Signature", ""))
 
-def _twilio_ready() -> bool:
-    return bool(twilio_client and TWILIO_FROM.startswith("whatsapp:"))
+_twilio_upstream = _resilience.upstream("twilio", _common.TWILIO_LATENCY_TARGET_S, _common.twilio_failure)
+
+def _twilio_send(to: str, body: str) -> str | None:
+    # Envoi brut : l'échec remonte (core.outbox réessaie, check-in retenté au tick suivant)
+    with _span("twilio_send"):
+        msg = _twilio_upstream.call(_twilio_client().messages.create, from_=TWILIO_FROM, to=to,
+                                    body=_clean_outgoing(body))
+    return getattr(msg, "sid", None)
 
 def _send_whatsapp(to: str, body: str) -> str | None:
-    body = _clean_outgoing(body)
     if not _twilio_ready():
         print("[TWILIO] no-op (client absent ou FROM manquant).", flush=True)
         return None
     try:
-        msg = twilio_client.messages.create(from_=TWILIO_FROM, to=to, body=body)
-        return getattr(msg, "sid", None)
+        return _twilio_send(to, body)
+    except _Unavailable as e:
+        _incr("twilio_degraded")
+        print(f"[TWILIO][degraded] {e}", flush=True)
+        return None
     except Exception as e:
+        _incr("twilio_errors")
         print(f"[TWILIO][err] {e}", flush=True)
         return None
 
 # ---- Flask + worker ----
 app = Flask(__name__)
-executor = ThreadPoolExecutor(max_workers=int(os.environ.get("WEBHOOK_WORKERS", "4")))
 
 @app.before_request
 def _obs_begin():
@@ -164,28 +257,58 @@ def _obs_begin():
 def _obs_end(resp):
     try:
         dt = int((time.time() - getattr(g, "t0", time.time())) * 1000)
+        # route (et non chemin brut) : pas d'explosion de séries sur les 404
+        _observe("request_ms", dt, route=request.url_rule.rule if request.url_rule else "other")
         print(f"[REQ] id={getattr(g,'req_id','-')} {request.method} {request.path} {resp.status_code} {dt}ms", flush=True)
     except Exception:
         pass
     return resp
 
-# Init DB
+# Init DB (+ file de jobs durable : reprise des jobs interrompus)
 coreapp.bootstrap_memory()
+_jobs.bootstrap_jobs()
+_startup.mark("db_bootstrap")
 
 @app.route("/health", methods=["GET"])
 def health():
     return jsonify({"status": "ok"}), 200
 
+@app.route("/ready", methods=["GET"])
+def ready():
+    # 200 une fois le démarrage (et le préchauffage WARMUP=1) terminé, sinon 503
+    st = _startup.status()
+    return jsonify(st), (200 if st["ready"] else 503)
+
+def _authorized() -> bool:
+    return _common.authorized(request.headers.get("X-Token") or "")
+
+@app.route("/internal/stats", methods=["GET"])
+def internal_stats():
+    if not _authorized():
+        return jsonify({"error": "forbidden"}), 403
+    return jsonify(_common.stats_payload(dispatcher.stats())), 200
+
+@app.route("/internal/history", methods=["GET"])
+def internal_history():
+    # Historique archives comprises
+    if not _authorized():
+        return jsonify({"error": "forbidden"}), 403
+    status, body = _common.history_query(request.args.get)
+    return jsonify(body), status
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    # Prometheus : en-tête X-Token ou "Authorization: Bearer <INTERNAL_TOKEN>"
+    if not _common.authorized(request.headers.get("X-Token") or "", request.headers.get("Authorization", "")):
+        return jsonify({"error": "forbidden"}), 403
+    return Response(_prometheus_text(), mimetype="text/plain; version=0.0.4")
+
 @app.route("/internal/send", methods=["POST"])
 def internal_send():
-    token = request.headers.get("X-Token") or ""
-    expect = os.environ.get("INTERNAL_TOKEN") or ""
-    if not expect or token != expect:
+    if not _authorized():
         return jsonify({"error": "forbidden"}), 403
 
-    data = request.get_json(silent=True) or {}
-    text = (data.get("text") or "").strip() or "ping"
-    user_id = (data.get("user_id") or "local")
+    text, user_id = _common.send_params(request.get_json(silent=True) or {})
     no_llm = (request.args.get("nollm", "0") == "1")
 
     t0 = time.time()
@@ -193,26 +316,109 @@ def internal_send():
         reply = f"(NO-LLM) {text}"
         coreapp.process_incoming(user_id, text, None, lambda t, h: reply)
     else:
-        reply = coreapp.process_incoming(user_id, text, None, _generate_with_history)
+        reply = coreapp.process_incoming(user_id, text, None, _generate_with_history, _history_budget(text),
+                                         _fastpath.answer)
     dt = round((time.time() - t0) * 1000)
     reply = _clean_outgoing(reply)
 
     return jsonify({"ok": True, "ms": dt, "reply": reply, "no_llm": no_llm}), 200
 
-def _worker_process(sender: str, text_in: str, msg_sid: str | None):
+def _handle_burst(sender: str, items) -> str:
+    # Exécuté sous la file de l'utilisateur : génération ET envoi restent ordonnés
+    sids = ",".join(str(sid) for (_, sid) in items)
+    merged = "\n".join(t for (t, _) in items)
+    _stream_ctx.to, _stream_ctx.t0, _stream_ctx.sent = sender, time.time(), ""
     try:
-        print(f"[IN] id={getattr(g,'req_id','-')} {sender} sid={msg_sid} text={text_in[:120]}", flush=True)
-    except Exception:
-        print(f"[IN] {sender} sid={msg_sid} text={text_in[:120]}", flush=True)
+        reply = coreapp.process_burst(sender.replace("whatsapp:", ""), items, _generate_with_history,
+                                      _history_budget(merged), _fastpath.answer)
+        sent = _stream_ctx.sent
+    finally:
+        _stream_ctx.to = None
+    if reply:
+        # début déjà parti pendant le streaming : seulement la suite
+        rest = reply[len(sent):].strip() if sent and reply.startswith(sent) else reply
+        if rest and _outbox_ready():
+            # envoi confié à core.outbox : ce worker est libéré pour le LLM suivant
+            _outbox.enqueue(sender, _clean_outgoing(rest), sender.replace("whatsapp:", ""), reply,
+                            t0=_stream_ctx.t0)
+            _stream_ctx.t0 = None
+            print(f"[OUT] to={sender} outbox merged={len(items)} early={bool(sent)}", flush=True)
+            return reply
+        out_sid = _send_whatsapp(sender, rest) if rest else None
+        if out_sid:
+            _note_first_message()
+        print(f"[OUT] to={sender} tw_sid={out_sid} merged={len(items)} early={bool(sent)}", flush=True)
+    else:
+        print(f"[DUP] sid={sids} ignoré", flush=True)
+    return reply
+
+# Option A : un dispatcher par utilisateur devant core.process_burst
+dispatcher = Dispatcher(_handle_burst, pending=lambda s: _jobs.queued_for("whatsapp_in", "sender", s))
+
+def _worker_process(sender: str, text_in: str, msg_sid: str | None, req_id: str = "-"):
+    print(f"[IN] id={req_id} {sender} sid={msg_sid} text={text_in[:120]}", flush=True)
+    # Leader : traite (et envoie) les lots de l'utilisateur puis rend la main.
+    # Suiveur : renvoie tout de suite la Future de son lot (worker libéré,
+    # le job reste sous bail jusqu'à l'envoi de la réponse fusionnée).
+    fut = dispatcher.submit(sender, text_in, msg_sid)
+    fut.add_done_callback(lambda f: f.exception() and print(f"[WORKER][err] {f.exception()}", flush=True))
+    return fut
+
+def _job_whatsapp_in(payload: dict):
+    return _worker_process(payload["sender"], payload["text"], payload.get("msg_sid"), payload.get("req_id", "-"))
+
+_jobs.register("whatsapp_in", _job_whatsapp_in)
+_jobs.ensure_workers()
+
+# ---- Check-ins du matin (core.scheduler) ----
+def _send_checkin(to: str, body: str) -> str | None:
+    # envoi direct (le scheduler garde le SID et retente lui-même au tick suivant)
+    if not _twilio_ready():
+        print(f"[TWILIO] no-op (client absent ou FROM manquant) checkin to={to}", flush=True)
+        return None
+    return _twilio_send(to, body)
+
+# Envois sortants (core.outbox), check-ins du matin, rétention
+_common.start_services(_twilio_send, _send_checkin)
+
+# ---- Option B : budget de latence + livraison différée ----
+TWIML_BUDGET_S = _common.TWIML_BUDGET_S
+TWIML_GRACE_S = _common.TWIML_GRACE_S
+_twiml_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("WEBHOOK_WORKERS", "4")),
+                                     thread_name_prefix="twiml")
+_deferred_replies = _common.DeferredReplies()
+
+def _process_with_deadline(sender: str, text_in: str, msg_sid: str | None, deadline: float) -> str:
+    _deadline.t = deadline
     try:
-        reply = coreapp.process_incoming(sender.replace("whatsapp:", ""), text_in, msg_sid, _generate_with_history)
-        if reply:
-            out_sid = _send_whatsapp(sender, reply)
-            print(f"[OUT] to={sender} tw_sid={out_sid}", flush=True)
-        else:
-            print(f"[DUP] sid={msg_sid} ignoré", flush=True)
+        return coreapp.process_incoming(sender.replace("whatsapp:", ""), text_in, msg_sid,
+                                        _generate_with_history, _history_budget(text_in),
+                                        _fastpath.answer)
+    finally:
+        _deadline.t = None
+
+def _deliver_deferred(sender: str, fut):
+    try:
+        reply = fut.result()
     except Exception as e:
-        print(f"[WORKER][err] {e}", flush=True)
+        print(f"[TWIML][deferred-err] {e}", flush=True)
+        _incr("twiml_deferred_errors")
+        return
+    if not reply:
+        return
+    if _outbox_ready():
+        _outbox.enqueue(sender, _clean_outgoing(reply), sender.replace("whatsapp:", ""), reply)
+        _incr("twiml_deferred_sent")
+        print(f"[OUT][deferred] to={sender} outbox", flush=True)
+    elif _twilio_ready():
+        out_sid = _send_whatsapp(sender, reply)
+        _incr("twiml_deferred_sent")
+        print(f"[OUT][deferred] to={sender} tw_sid={out_sid}", flush=True)
+    else:
+        # pas d'API Twilio : la réponse partira avec le prochain TwiML de ce contact
+        _deferred_replies.put(sender, reply)
+        _incr("twiml_deferred_parked")
+        print(f"[OUT][deferred] to={sender} en attente du prochain webhook", flush=True)
 
 @app.route("/whatsapp/webhook", methods=["POST"])
 def whatsapp_webhook():
@@ -220,28 +426,67 @@ def whatsapp_webhook():
     if not _verify_twilio(request):
         return Response(status=403)
 
-    sender = request.form.get("From") or ""
-    text_in = (request.form.get("Body") or "").strip() or "Salut"
-    msg_sid = request.form.get("MessageSid")
+    sender, text_in, msg_sid = _common.webhook_fields(request.form)
 
     if not sender:
         # Twilio a bien frappé mais pas d'expéditeur
         return Response(status=200)
 
+    if not coreapp.accept_sid(msg_sid):
+        # Webhook rejoué par Twilio : écarté en mémoire, sans DB ni LLM
+        print(f"[DUP] sid={msg_sid} ignoré (webhook)", flush=True)
+        if _twilio_ready():
+            return Response(status=200)
+        return Response(_twiml(), status=200, mimetype="application/xml")
+
     if _twilio_ready():
-        # ----- Option A: envoi via API (async), réponse HTTP vide -----
-        executor.submit(_worker_process, sender, text_in, msg_sid)
+        # ----- Option A: envoi via API (async, file durable), réponse HTTP vide -----
+        if not _common.enqueue_incoming(sender, text_in, msg_sid, getattr(g, "req_id", "-")):
+            return Response(status=503)
         return Response(status=200)
 
     # ----- Option B: fallback TwiML (pas de secrets requis) -----
+    # La génération a TWIML_BUDGET secondes pour tenir dans le timeout du webhook
+    # Twilio (15 s). Sinon : accusé de réception court tout de suite, et la vraie
+    # réponse part plus tard (API Twilio si dispo, sinon avec le prochain TwiML).
+    t0 = time.time()
+    fut = _twiml_executor.submit(_process_with_deadline, sender, text_in, msg_sid,
+                                 t0 + TWIML_BUDGET_S + TWIML_GRACE_S)
+    messages = _deferred_replies.pop(sender)
     try:
-        reply = coreapp.process_incoming(sender.replace("whatsapp:", ""), text_in, msg_sid, _generate_with_history) or "pong"
-    except Exception:
+        reply = fut.result(timeout=TWIML_BUDGET_S) or ""
+        _common.twiml_outcome("in_time", t0)
+    except FutureTimeout:
+        reply = _common.TWIML_ACK_TEXT
+        fut.add_done_callback(lambda f: _deliver_deferred(sender, f))
+        _common.twiml_outcome("deferred", t0)
+    except Exception as e:
+        print(f"[TWIML][err] {e}", flush=True)
+        _incr("twiml_errors")
         reply = "pong"
-    reply = _clean_outgoing(reply)
-    twiml = f"""<?xml version="1.0" encoding="UTF-8"?>
-<Response><Message>{reply}</Message></Response>"""
-    return Response(twiml, status=200, mimetype="application/xml")
+    messages.append(reply)
+    return Response(_twiml(*messages), status=200, mimetype="application/xml")
+
+# ---- Préchauffage (WARMUP=1) : hors du chemin de la 1re requête ----
+def _warm_openai():
+    from core import llm  # importe le SDK openai (le plus lourd)
+    c = llm.client()
+    c.chat.completions  # ressources chargées paresseusement par le SDK
+    if _startup.WARMUP_HTTP and OPENAI_API_KEY:
+        c.with_options(timeout=3, max_retries=0).models.list()  # connexion TLS dans le pool
+
+def _warm_twilio():
+    client = _twilio_client()
+    _common.twilio_validator()
+    if client is not None and _startup.WARMUP_HTTP:
+        client.api.accounts(TWILIO_SID).fetch()  # connexion TLS dans le pool
+
+_startup.step("db", coreapp.warm_db)
+_startup.step("openai", _warm_openai)
+_startup.step("prompts", _common.warm_prompts)
+_startup.step("twilio", _warm_twilio)
+_startup.mark("app")
+_startup.ready_after_import()
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", "5000"))
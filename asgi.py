@@ -0,0 +1,403 @@
+# asgi.py — mode serveur asyncio (ASGI), même contrat HTTP que app.py (Flask)
+# - /health, /internal/send, /internal/stats, /internal/history, /whatsapp/webhook
+# - OpenAI : AsyncOpenAI partagé (core.llm.aclient) ; Twilio : client HTTP async
+# - Mémoire (SQLite) : core.process_burst_async, accès DB dans des threads
+# - Une conversation en attente du LLM = une coroutine, pas un thread bloqué :
+#   un seul process tient des centaines d'échanges en vol.
+# Lancement : uvicorn asgi:app --host 0.0.0.0 --port $PORT
+
+import os, json, time, uuid, asyncio, contextvars
+from infra import startup as _startup  # profil de démarrage (avant les imports lourds)
+from typing import List, Dict
+from urllib.parse import parse_qs
+
+# .env, configuration et logique partagées avec app.py
+import server_common as _common
+from server_common import clean_outgoing as _clean_outgoing, twilio_ready as _twilio_ready
+from server_common import outbox_ready as _outbox_ready, history_budget as _history_budget
+
+import core as coreapp
+from core import llm
+from core import jobs as _jobs
+from core import router as _router
+from core import outbox as _outbox
+from core import fastpath as _fastpath
+from core import response_cache as _rcache
+from core.dispatch import AsyncDispatcher, spawn as _spawn
+from infra import resilience as _resilience
+from infra.resilience import Unavailable as _Unavailable
+from infra.monitoring import incr as _incr
+from infra.monitoring import observe as _observe
+from infra.monitoring import span as _span, prometheus_text as _prometheus_text
+_startup.mark("import_core")
+
+# ---- OpenAI : variables lues par server_common (mêmes que app.py) ----
+_FALLBACK_REPLY = _common.FALLBACK_REPLY
+
+# Concurrence LLM bien plus haute qu'en mode threads : le limiteur AIMD part de
+# ASGI_LLM_CONCURRENCY appels en vol (et redescend tout seul si l'amont sature).
+ASGI_LLM_CONCURRENCY = float(os.environ.get("ASGI_LLM_CONCURRENCY", "256"))
+_oai = _resilience.upstream("openai_async", llm.OPENAI_LATENCY_TARGET_S, llm._is_upstream_failure,
+                            initial=ASGI_LLM_CONCURRENCY, max_limit=ASGI_LLM_CONCURRENCY * 4)
+
+# Échéance (epoch) de la génération en cours, posée par l'Option B (TwiML)
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+def _openai_budget():
+    """(timeout, retries) bornés par l'échéance courante, ou None si dépassée."""
+    return _common.openai_budget(_deadline.get())
+
+async def _openai_generate(prompt_messages: List[Dict]) -> str:
+    route = _router.route(prompt_messages)
+    ttl = _rcache.ttl_for(None)
+    key = _rcache.make_key(route.model, prompt_messages, 0.3) if ttl else None
+    if key:
+        hit = await asyncio.to_thread(_rcache.get, key)
+        if hit is not None:
+            return hit
+    reply = await _openai_call(prompt_messages, route)
+    if key and reply and reply != _FALLBACK_REPLY:
+        await asyncio.to_thread(_rcache.put, key, reply, ttl)
+    return reply
+
+async def _openai_call(prompt_messages: List[Dict], route=None) -> str:
+    route = route or _router.route(prompt_messages)
+    t0 = time.time()
+    budget = _openai_budget()
+    if budget is None:
+        _incr("llm_deadline_exceeded")
+        return _FALLBACK_REPLY
+    try:
+        client = llm.aclient().with_options(timeout=budget[0], max_retries=budget[1])
+        with _span("llm"):
+            r = await _oai.acall(
+                client.chat.completions.create,
+                model=route.model,
+                messages=prompt_messages,
+                temperature=0.3,
+                max_tokens=route.max_tokens,
+            )
+        ms = (time.time() - t0) * 1000
+        print(f"[GPT][async] ms={int(ms)} route={route.name} model={route.model}", flush=True)
+        reply = (r.choices[0].message.content or "").strip()
+        usage = getattr(r, "usage", None)
+        _router.record(route, ms, usage)
+        _router.maybe_shadow(route, prompt_messages, reply, ms, usage)
+        return reply
+    except _Unavailable as e:
+        _incr("llm_degraded")
+        print(f"[GPT][degraded] {e}", flush=True)
+    except Exception as e:
+        print(f"[GPT][async-fail] ms={int((time.time() - t0) * 1000)} err={e}", flush=True)
+        _router.record(route, (time.time() - t0) * 1000, error=e)
+    return _FALLBACK_REPLY
+
+async def _generate_with_history(user_text: str, history: List[Dict]) -> str:
+    return await _openai_generate(_common.prompt_messages(user_text, history))
+
+# ---- Twilio (client HTTP async) ; configuration lue par server_common ----
+_twilio_client = None
+
+def _twilio():
+    # créé dans la boucle (session aiohttp de AsyncTwilioHttpClient)
+    global _twilio_client
+    if _twilio_client is None:
+        from twilio.rest import Client as TwilioClient
+        from twilio.http.async_http_client import AsyncTwilioHttpClient
+        _twilio_client = TwilioClient(_common.TWILIO_SID, _common.TWILIO_TOKEN,
+                                      http_client=AsyncTwilioHttpClient())
+    return _twilio_client
+
+_twilio_upstream = _resilience.upstream("twilio_async", _common.TWILIO_LATENCY_TARGET_S,
+                                        _common.twilio_failure, initial=ASGI_LLM_CONCURRENCY,
+                                        max_limit=ASGI_LLM_CONCURRENCY * 4)
+
+async def _twilio_send(to: str, body: str):
+    # Envoi brut : l'échec remonte (core.outbox réessaie)
+    with _span("twilio_send"):
+        msg = await _twilio_upstream.acall(_twilio().messages.create_async,
+                                           from_=_common.TWILIO_FROM, to=to, body=_clean_outgoing(body))
+    return getattr(msg, "sid", None)
+
+def _outbox_send(to: str, body: str):
+    # Thread d'envoi de core.outbox : l'envoi passe par le client async de la boucle ;
+    # attente bornée par le bail pour qu'une ligne ne soit pas reprise pendant l'envoi
+    return asyncio.run_coroutine_threadsafe(_twilio_send(to, body), _loop).result(timeout=_outbox.LEASE_S)
+
+async def _send_whatsapp(to: str, body: str):
+    if not _twilio_ready():
+        print("[TWILIO] no-op (client absent ou FROM manquant).", flush=True)
+        return None
+    try:
+        return await _twilio_send(to, body)
+    except _Unavailable as e:
+        _incr("twilio_degraded")
+        print(f"[TWILIO][degraded] {e}", flush=True)
+    except Exception as e:
+        _incr("twilio_errors")
+        print(f"[TWILIO][err] {e}", flush=True)
+    return None
+
+# ---- Option A : dispatch par utilisateur, file de jobs durable ----
+async def _handle_burst(sender: str, items) -> str:
+    t0 = time.time()
+    merged = "\n".join(t for (t, _) in items)
+    reply = await coreapp.process_burst_async(sender.replace("whatsapp:", ""), items, _generate_with_history,
+                                              _history_budget(merged), _fastpath.answer)
+    if reply and _outbox_ready():
+        # envoi confié à core.outbox (ordre par destinataire, retry avec backoff)
+        await asyncio.to_thread(_outbox.enqueue, sender, _clean_outgoing(reply), sender.replace("whatsapp:", ""),
+                                reply, t0)
+        print(f"[OUT] to={sender} outbox merged={len(items)}", flush=True)
+    elif reply:
+        out_sid = await _send_whatsapp(sender, reply)
+        if out_sid:
+            _observe("ttfm_ms", (time.time() - t0) * 1000)
+        print(f"[OUT] to={sender} tw_sid={out_sid} merged={len(items)}", flush=True)
+    return reply
+
+dispatcher = AsyncDispatcher(_handle_burst, pending=lambda s: _jobs.queued_for("whatsapp_in", "sender", s))
+_loop = None  # boucle du serveur (les threads workers de core.jobs y postent)
+
+async def _dispatch(payload: dict):
+    print(f"[IN] id={payload.get('req_id', '-')} {payload['sender']} sid={payload.get('msg_sid')} "
+          f"text={payload['text'][:120]}", flush=True)
+    return await dispatcher.submit(payload["sender"], payload["text"], payload.get("msg_sid"))
+
+def _job_whatsapp_in(payload: dict):
+    # Thread worker de core.jobs : le job reste sous bail jusqu'à la fin de la
+    # coroutine (Future concurrente), le thread est libéré tout de suite.
+    return asyncio.run_coroutine_threadsafe(_dispatch(payload), _loop)
+
+# ---- Option B : budget de latence + livraison différée ----
+TWIML_BUDGET_S = _common.TWIML_BUDGET_S
+TWIML_GRACE_S = _common.TWIML_GRACE_S
+_deferred_replies = _common.DeferredReplies()
+
+async def _process_with_deadline(sender: str, text_in: str, msg_sid, deadline: float) -> str:
+    _deadline.set(deadline)  # contexte propre à la tâche
+    return await coreapp.process_burst_async(sender.replace("whatsapp:", ""), [(text_in, msg_sid)],
+                                             _generate_with_history, _history_budget(text_in),
+                                             _fastpath.answer)
+
+async def _deliver_deferred(sender: str, task: asyncio.Task):
+    try:
+        reply = await task
+    except Exception as e:
+        print(f"[TWIML][deferred-err] {e}", flush=True)
+        _incr("twiml_deferred_errors")
+        return
+    if reply:
+        # la réponse partira avec le prochain TwiML de ce contact
+        _deferred_replies.put(sender, reply)
+        _incr("twiml_deferred_parked")
+
+def _twiml(*messages: str) -> bytes:
+    return _common.twiml(*messages).encode("utf-8")
+
+# ---- HTTP (ASGI brut) ----
+class _Request:
+    def __init__(self, scope, body: bytes):
+        self.scope = scope
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        self.headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+        self.body = body
+
+    def form(self) -> Dict[str, str]:
+        return {k: v[0] for k, v in parse_qs(self.body.decode("utf-8"), keep_blank_values=True).items()}
+
+    def json(self) -> Dict:
+        try:
+            data = json.loads(self.body or b"{}")
+            return data if isinstance(data, dict) else {}
+        except ValueError:
+            return {}
+
+    def url(self) -> str:
+        qs = self.scope.get("query_string", b"").decode("latin-1")
+        host = self.headers.get("host", "")
+        return f"{self.scope.get('scheme', 'http')}://{host}{self.path}" + (f"?{qs}" if qs else "")
+
+def _json(status: int, obj) -> tuple:
+    return status, json.dumps(obj, ensure_ascii=False).encode("utf-8"), "application/json"
+
+def _forbidden(req: _Request, bearer: bool = False):
+    return not _common.authorized(req.headers.get("x-token", ""),
+                                  req.headers.get("authorization", "") if bearer else "")
+
+async def _health(req):
+    return _json(200, {"status": "ok"})
+
+async def _ready(req):
+    st = _startup.status()
+    return _json(200 if st["ready"] else 503, st)
+
+async def _internal_stats(req):
+    if _forbidden(req):
+        return _json(403, {"error": "forbidden"})
+    return _json(200, await asyncio.to_thread(_common.stats_payload, dispatcher.stats()))
+
+async def _internal_history(req):
+    if _forbidden(req):
+        return _json(403, {"error": "forbidden"})
+    return _json(*await asyncio.to_thread(_common.history_query, lambda k: req.query.get(k, [None])[0]))
+
+async def _metrics(req):
+    if _forbidden(req, bearer=True):
+        return _json(403, {"error": "forbidden"})
+    return 200, (await asyncio.to_thread(_prometheus_text)).encode("utf-8"), "text/plain; version=0.0.4"
+
+async def _internal_send(req):
+    if _forbidden(req):
+        return _json(403, {"error": "forbidden"})
+    text, user_id = _common.send_params(req.json())
+    no_llm = (req.query.get("nollm", ["0"])[0] == "1")
+
+    t0 = time.time()
+    if no_llm:
+        reply = f"(NO-LLM) {text}"
+
+        async def _echo(t, h):
+            return reply
+        await coreapp.process_burst_async(user_id, [(text, None)], _echo)
+    else:
+        reply = await coreapp.process_burst_async(user_id, [(text, None)], _generate_with_history,
+                                                  _history_budget(text), _fastpath.answer)
+    dt = round((time.time() - t0) * 1000)
+    return _json(200, {"ok": True, "ms": dt, "reply": _clean_outgoing(reply), "no_llm": no_llm})
+
+def _verify_twilio(req: _Request, form: Dict[str, str]) -> bool:
+    return _common.verify_twilio(req.url(), form, req.headers.get("x-twilio-signature", ""))
+
+async def _whatsapp_webhook(req):
+    form = req.form()
+    if not _verify_twilio(req, form):
+        return 403, b"", "text/plain"
+    sender, text_in, msg_sid = _common.webhook_fields(form)
+    if not sender:
+        return 200, b"", "text/plain"
+
+    if not coreapp.accept_sid(msg_sid):
+        print(f"[DUP] sid={msg_sid} ignoré (webhook)", flush=True)
+        if _twilio_ready():
+            return 200, b"", "text/plain"
+        return 200, _twiml(), "application/xml"
+
+    if _twilio_ready():
+        # ----- Option A : file durable, réponse HTTP vide -----
+        if not await asyncio.to_thread(_common.enqueue_incoming, sender, text_in, msg_sid, req.req_id):
+            return 503, b"", "text/plain"
+        return 200, b"", "text/plain"
+
+    # ----- Option B : TwiML sous budget, sinon accusé + réponse différée -----
+    t0 = time.time()
+    task = _spawn(_process_with_deadline(sender, text_in, msg_sid,
+                                         t0 + TWIML_BUDGET_S + TWIML_GRACE_S))
+    messages = _deferred_replies.pop(sender)
+    try:
+        reply = await asyncio.wait_for(asyncio.shield(task), TWIML_BUDGET_S) or ""
+        _common.twiml_outcome("in_time", t0)
+    except asyncio.TimeoutError:
+        reply = _common.TWIML_ACK_TEXT
+        _spawn(_deliver_deferred(sender, task))
+        _common.twiml_outcome("deferred", t0)
+    except Exception as e:
+        print(f"[TWIML][err] {e}", flush=True)
+        _incr("twiml_errors")
+        reply = "pong"
+    messages.append(reply)
+    return 200, _twiml(*messages), "application/xml"
+
+_ROUTES = {
+    ("GET", "/health"): _health,
+    ("GET", "/ready"): _ready,
+    ("GET", "/internal/stats"): _internal_stats,
+    ("GET", "/internal/history"): _internal_history,
+    ("GET", "/metrics"): _metrics,
+    ("POST", "/internal/send"): _internal_send,
+    ("POST", "/whatsapp/webhook"): _whatsapp_webhook,
+}
+
+# ---- Préchauffage (WARMUP=1) ----
+async def _warm_openai():
+    t0 = time.perf_counter()
+    err = None
+    try:
+        c = llm.aclient()
+        c.chat.completions
+        if _startup.WARMUP_HTTP and os.environ.get("OPENAI_API_KEY"):
+            await c.with_options(timeout=3, max_retries=0).models.list()
+    except Exception as e:
+        err = e
+        print(f"[STARTUP][warmup-err] openai_async: {e}", flush=True)
+    _startup.record("openai_async", (time.perf_counter() - t0) * 1000, err)
+
+_startup.step("db", coreapp.warm_db)
+_startup.step("prompts", _common.warm_prompts)
+_startup.expect("openai_async")
+
+async def _on_startup():
+    global _loop
+    _loop = asyncio.get_running_loop()
+    await asyncio.to_thread(coreapp.bootstrap_memory)
+    await asyncio.to_thread(_jobs.bootstrap_jobs)
+    _jobs.register("whatsapp_in", _job_whatsapp_in)
+    _jobs.ensure_workers()
+    # envois sortants (core.outbox) et rétention ; les check-ins restent côté Flask (app.py)
+    await asyncio.to_thread(_common.start_services, _outbox_send)
+    _startup.mark("db_bootstrap")
+    _startup.ready_after_import()
+    if _startup.ENABLED:
+        _spawn(_warm_openai())
+
+async def _shutdown():
+    await asyncio.to_thread(coreapp.flush_memory)
+
+async def _lifespan(receive, send):
+    while True:
+        msg = await receive()
+        if msg["type"] == "lifespan.startup":
+            try:
+                await _on_startup()
+            except Exception as e:
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif msg["type"] == "lifespan.shutdown":
+            await _shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+    body = b""
+    while True:
+        msg = await receive()
+        body += msg.get("body", b"")
+        if not msg.get("more_body"):
+            break
+    req = _Request(scope, body)
+    req.req_id = str(uuid.uuid4())[:8]
+    t0 = time.time()
+    handler = _ROUTES.get((req.method, req.path))
+    if handler is None:
+        status, payload, ctype = 404, b"", "text/plain"
+    else:
+        try:
+            status, payload, ctype = await handler(req)
+        except Exception as e:
+            print(f"[REQ][err] id={req.req_id} {e}", flush=True)
+            status, payload, ctype = 500, b"", "text/plain"
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", ctype.encode("latin-1")),
+                            (b"content-length", str(len(payload)).encode("latin-1"))]})
+    await send({"type": "http.response.body", "body": payload})
+    _observe("request_ms", (time.time() - t0) * 1000, route=req.path if handler else "other")
+    print(f"[REQ] id={req.req_id} {req.method} {req.path} {status} {int((time.time() - t0) * 1000)}ms", flush=True)
+
+_startup.mark("app")
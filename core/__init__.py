@@ -1,8 +1,20 @@
 # core/__init__.py — Patch minimal "stricte mais compatible"
-from typing import List, Dict, Callable, Optional
+from typing import List, Dict, Callable, Optional, Tuple, Awaitable
+import asyncio
+import os
 import sys
+import time
 import traceback
 
+from . import prompt as _prompt
+from infra.monitoring import span as _span
+
+# Fenêtre d'historique : budgets de tokens dans core.prompt (HISTORY_TOKEN_BUDGET,
+# HISTORY_MAX_TURNS ; budget <= 0 = les 10 derniers tours, ancien mode)
+# Rappel long terme (FTS5) : k extraits anciens pertinents, dans une part du budget
+RECALL_K = int(os.getenv("RECALL_K", "3"))  # 0 = désactivé
+RECALL_MAX_TOKENS = int(os.getenv("RECALL_MAX_TOKENS", "300"))
+
 # 1) Import du backend officiel (SQLite) — fallback seulement si ImportError
 try:
     from .memory import (
@@ -10,7 +22,13 @@ try:
         get_history as _get_history,
         clear_history as _clear_history,
         bootstrap_memory as _bootstrap_memory,
+        flush as _flush_memory,
+        history_cache_stats as _history_cache_stats,
+        incoming_state as _incoming_state,
+        iter_history as _iter_history,
+        search_history as _search_history,
     )
+    from . import summary as _summary
     _USING_FALLBACK = False
 except ImportError:
     # Fallback RAM minimal (pour ne pas bloquer en dev si le module manque)
@@ -22,7 +40,7 @@ except ImportError:
         # Rien à faire en RAM
         return True
 
-    def _add_message(user_id: str, direction: str, text: str) -> bool:
+    def _add_message(user_id: str, direction: str, text: str, msg_sid: Optional[str] = None) -> bool:
         lst = _store.setdefault(user_id, [])
         lst.append({"direction": direction, "text": text})
         return True
@@ -35,46 +53,244 @@ except ImportError:
         _store[user_id] = []
         return True
 
+    def _flush_memory() -> int:
+        return 0
+
+    def _history_cache_stats() -> Dict:
+        return {}
+
+    def _incoming_state(msg_sid: str) -> Optional[str]:
+        return None
+
+    def _iter_history(user_id: str, page: int = 8, max_rows: int = 200):
+        return reversed(_store.get(user_id, [])[-max_rows:])
+
+    def _search_history(user_id: str, text: str, k: int = 5, max_terms: int = 8) -> List[Dict]:
+        return []
+
+    _summary = None
+
+from .dedup import recent as _recent_sids
+from . import fastpath as _fastpath
+
 # 2) API exposée (mêmes noms partout dans l’app)
 def bootstrap_memory() -> bool:
     # Si le backend officiel est présent, on l’utilise sans try/except global
     return _bootstrap_memory()
 
-def add_message(user_id: str, direction: str, text: str) -> bool:
-    return _add_message(user_id, direction, text)
+def add_message(user_id: str, direction: str, text: str, msg_sid: Optional[str] = None) -> bool:
+    with _span("db_write"):
+        return _add_message(user_id, direction, text, msg_sid)
+
+def record_outgoing(user_id: str, text: str, msg_sid: Optional[str] = None) -> bool:
+    """Message sortant hors conversation (check-in) : historique + compteur du résumé."""
+    ok = add_message(user_id, "OUT", text, msg_sid)
+    if _summary is not None:
+        _summary.note_turns(user_id, 1)
+    return ok
 
 def get_history(user_id: str, limit: int = 10) -> List[Dict]:
     return _get_history(user_id, limit)
 
 def clear_history(user_id: str) -> bool:
+    if _summary is not None:
+        _summary.invalidate(user_id)
+    if not _USING_FALLBACK:
+        from . import retention
+        retention.delete_archive(user_id)
     return _clear_history(user_id)
 
+def full_history(user_id: str, since: Optional[str] = None, until: Optional[str] = None,
+                 limit: int = 1000) -> List[Dict]:
+    """Historique archives comprises (core.retention), du plus ancien au plus récent."""
+    if _USING_FALLBACK:
+        return _get_history(user_id, limit)
+    from . import retention
+    return retention.history(user_id, since, until, limit)
+
+def warm_db() -> int:
+    """Ouvre d'avance les connexions SQLite du process (préchauffage)."""
+    from .memory import warm_pool
+    return warm_pool()
+
+def flush_memory() -> int:
+    """Écrit les messages encore en tampon (write-behind). À appeler à l'arrêt."""
+    return _flush_memory()
+
+def history_cache_stats() -> Dict:
+    """Compteurs du cache d'historique (hits/misses/évictions)."""
+    return _history_cache_stats()
+
+def search_history(user_id: str, text: str, k: int = 5) -> List[Dict]:
+    """Top-k messages passés de l'utilisateur pertinents pour `text` (FTS5, bm25)."""
+    return _search_history(user_id, text, k)
+
+def select_history(user_id: str, token_budget: Optional[int] = None,
+                   query: Optional[str] = None) -> List[Dict]:
+    """Derniers tours (du plus ancien au plus récent) qui tiennent dans le budget
+    de tokens, lus du plus récent au plus ancien et seulement jusque-là.
+    Si un résumé existe, il arrive en tête ({"direction": "SUMMARY", ...}) ;
+    avec `query`, les extraits anciens pertinents suivent ({"direction": "RECALL"})."""
+    with _span("history_read"):
+        return _select_history(user_id, token_budget, query)
+
+def _select_history(user_id: str, token_budget: Optional[int], query: Optional[str]) -> List[Dict]:
+    budget = _prompt.HISTORY_TOKEN_BUDGET if token_budget is None else token_budget
+    if budget <= 0:
+        return get_history(user_id, _prompt.LEGACY_HISTORY_TURNS)
+    # Résumé glissant (s'il existe) en tête + seulement quelques tours récents
+    head, max_turns = [], _prompt.HISTORY_MAX_TURNS
+    s = _summary.get(user_id) if _summary is not None else None
+    if s:
+        summary, after = s
+        head = [{"direction": _summary.SUMMARY_DIRECTION, "text": summary}]
+        budget -= _prompt.message_tokens(summary)
+        # uniquement les tours que le résumé ne couvre pas encore
+        max_turns = min(max_turns, max(after, 1))
+    reserve = min(RECALL_MAX_TOKENS, budget // 4) if (query and RECALL_K > 0) else 0
+    kept, used = _prompt.fit_newest(_iter_history(user_id, 8, max_turns), budget - reserve,
+                                    lambda h: h.get("text", ""), newest_first=True)
+    if reserve:
+        recall = _recall(user_id, query, kept, budget - used)
+        if recall:
+            head.append(recall)
+    return head + kept
+
+def _recall(user_id: str, query: str, window: List[Dict], budget: int) -> Optional[Dict]:
+    # Extraits déjà présents dans la fenêtre récente (dont le message courant) écartés
+    seen = {h.get("text", "") for h in window}
+    seen.update(query.split("\n"))
+    lines = []
+    for h in _search_history(user_id, query, RECALL_K * 2):
+        if h["text"] in seen:
+            continue
+        line = ("Utilisateur : " if h["direction"] == "IN" else "Toi : ") + h["text"]
+        t = _prompt.message_tokens(line)
+        if t > budget:
+            break
+        lines.append(line)
+        budget -= t
+        if len(lines) >= RECALL_K:
+            break
+    if not lines:
+        return None
+    return {"direction": "RECALL", "text": "\n".join(lines)}
+
+def accept_sid(msg_sid: Optional[str]) -> bool:
+    """Chemin rapide du webhook (mémoire seule) : False si ce MessageSid a déjà été reçu."""
+    return _recent_sids.accept(msg_sid)
+
+def forget_sid(msg_sid: Optional[str]):
+    """Annule accept_sid quand le message n'a pas pu être mis en file."""
+    _recent_sids.forget(msg_sid)
+
 def process_incoming(
     user_id: str,
     text: str,
     session_id: Optional[str],
     generate: Callable[[str, List[Dict]], str],
+    token_budget: Optional[int] = None,
+    fastpath: Optional[Callable[[str, str], Optional[str]]] = None,
 ) -> str:
     """
     Orchestrateur standard :
     - Log IN
-    - Récupère 10 derniers
-    - Appelle la génération
+    - fastpath(user_id, text) : réponse locale éventuelle (ex. core.fastpath.answer)
+    - Sinon : derniers tours dans le budget de tokens (select_history) + génération
     - Log OUT si reply non vide
     - Renvoie reply
     """
-    add_message(user_id, "IN", text)
-    history = get_history(user_id, 10)
+    return process_burst(user_id, [(text, session_id)], generate, token_budget, fastpath)
+
+def process_burst(
+    user_id: str,
+    items: List[Tuple[str, Optional[str]]],
+    generate: Callable[[str, List[Dict]], str],
+    token_budget: Optional[int] = None,
+    fastpath: Optional[Callable[[str, str], Optional[str]]] = None,
+) -> str:
+    """
+    Comme process_incoming, pour une rafale [(texte, session_id), ...] du même
+    utilisateur : chaque message est journalisé (IN), puis UNE seule génération
+    sur les textes fusionnés.
+    """
+    begun = _begin_burst(user_id, items)
+    if begun is None:
+        return ""
+    fresh, text = begun
 
     # 3) Ne pas avaler l’erreur de génération : on log + on relance
     reply: str
     try:
-        reply = generate(text, history) or ""
+        reply = fastpath(user_id, text) if fastpath is not None else None
+        if reply is None:
+            history = select_history(user_id, token_budget, query=text)
+            t0 = time.perf_counter()
+            reply = generate(text, history) or ""
+            _fastpath.record_llm((time.perf_counter() - t0) * 1000)
     except Exception as e:
-        traceback.print_exc()
+        _fail_burst(fresh)
         # Relancer pour que l’erreur soit visible dans les logs/smokes
         raise
 
+    _end_burst(user_id, fresh, reply)
+    return reply
+
+async def process_burst_async(
+    user_id: str,
+    items: List[Tuple[str, Optional[str]]],
+    agenerate: Callable[[str, List[Dict]], Awaitable[str]],
+    token_budget: Optional[int] = None,
+    fastpath: Optional[Callable[[str, str], Optional[str]]] = None,
+) -> str:
+    """process_burst pour une boucle asyncio : accès DB dans des threads
+    (asyncio.to_thread), génération attendue sans bloquer la boucle."""
+    begun = await asyncio.to_thread(_begin_burst, user_id, items)
+    if begun is None:
+        return ""
+    fresh, text = begun
+    try:
+        reply = await asyncio.to_thread(fastpath, user_id, text) if fastpath is not None else None
+        if reply is None:
+            history = await asyncio.to_thread(select_history, user_id, token_budget, text)
+            t0 = time.perf_counter()
+            reply = await agenerate(text, history) or ""
+            _fastpath.record_llm((time.perf_counter() - t0) * 1000)
+    except Exception:
+        _fail_burst(fresh)
+        raise
+    await asyncio.to_thread(_end_burst, user_id, fresh, reply)
+    return reply
+
+def _begin_burst(user_id: str, items: List[Tuple[str, Optional[str]]]):
+    """Dédoublonne et journalise les IN ; (fresh, texte fusionné) ou None."""
+    # Idempotence : sid déjà en cours/répondu (mémoire), puis répondu (DB)
+    fresh = []
+    for (text, sid) in items:
+        if not _recent_sids.begin(sid):
+            continue
+        state = _incoming_state(sid) if sid else None
+        if state == "answered":
+            _recent_sids.done(sid)
+            continue
+        fresh.append((text, sid, state))
+    if not fresh:
+        return None
+
+    for (text, sid, state) in fresh:
+        if state is None:  # "received" : IN déjà en base (retry après échec)
+            add_message(user_id, "IN", text, sid)
+    return fresh, "\n".join(t for (t, _sid, _st) in fresh)
+
+def _fail_burst(fresh):
+    for (_t, sid, _st) in fresh:
+        _recent_sids.release(sid)
+    traceback.print_exc()
+
+def _end_burst(user_id: str, fresh, reply: str):
     if reply:
         add_message(user_id, "OUT", reply)
-    return reply
+    for (_t, sid, _st) in fresh:
+        _recent_sids.done(sid)
+    if _summary is not None:
+        _summary.note_turns(user_id, len(fresh) + (1 if reply else 0))
@@ -0,0 +1,81 @@
+# core/dedup.py — ensemble borné et fenêtré des MessageSid Twilio récents
+# Chemin rapide de l'idempotence : un webhook rejoué est écarté en mémoire,
+# avant tout accès DB ou LLM. L'index unique (msg_sid, direction) reste le filet
+# de sécurité entre process et après un redémarrage.
+#   accepted   : reçu par le webhook (job en file)
+#   processing : en cours dans core.process_burst
+#   done       : réponse produite
+import os, time, threading
+from collections import OrderedDict
+
+WINDOW_S = float(os.getenv("DEDUP_WINDOW", "900"))
+MAX_SIDS = int(os.getenv("DEDUP_MAX", "20000"))
+
+class RecentSids:
+    def __init__(self, window_s: float = WINDOW_S, max_sids: int = MAX_SIDS):
+        self.window_s = window_s
+        self.max_sids = max_sids
+        self._sids = OrderedDict()  # sid -> (state, ts)
+        self._lock = threading.Lock()
+        self.hits = 0
+
+    def _get(self, sid: str):
+        # Appelant : _lock tenu
+        v = self._sids.get(sid)
+        if v is not None and time.monotonic() - v[1] > self.window_s:
+            del self._sids[sid]
+            return None
+        return v
+
+    def _set(self, sid: str, state: str):
+        self._sids[sid] = (state, time.monotonic())
+        self._sids.move_to_end(sid)
+        while len(self._sids) > self.max_sids:
+            self._sids.popitem(last=False)
+
+    def accept(self, sid: str) -> bool:
+        """Webhook : False si ce sid a déjà été reçu récemment."""
+        if not sid:
+            return True
+        with self._lock:
+            if self._get(sid) is not None:
+                self.hits += 1
+                return False
+            self._set(sid, "accepted")
+            return True
+
+    def begin(self, sid: str) -> bool:
+        """Traitement : False si ce sid est déjà en cours ou déjà répondu."""
+        if not sid:
+            return True
+        with self._lock:
+            v = self._get(sid)
+            if v is not None and v[0] in ("processing", "done"):
+                self.hits += 1
+                return False
+            self._set(sid, "processing")
+            return True
+
+    def done(self, sid: str):
+        if sid:
+            with self._lock:
+                self._set(sid, "done")
+
+    def release(self, sid: str):
+        """Échec du traitement : le sid pourra être retraité (retry du job)."""
+        if sid:
+            with self._lock:
+                if self._get(sid) is not None:
+                    self._set(sid, "accepted")
+
+    def forget(self, sid: str):
+        """Webhook non mis en file (503) : le retry de Twilio ne doit pas passer pour un doublon."""
+        if sid:
+            with self._lock:
+                self._sids.pop(sid, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._sids), "hits": self.hits}
+
+recent = RecentSids()
@@ -0,0 +1,185 @@
+# core/dispatch.py — dispatch ordonné et fusionnant, par utilisateur
+# Les messages d'un même utilisateur passent un par un (jamais deux générations
+# en parallèle sur le même historique) ; ceux arrivés pendant la fenêtre de
+# debounce, ou pendant la génération précédente, sont fusionnés en UN appel.
+# Le premier appelant ("leader") exécute les lots ; les suivants attendent leur
+# Future. Seul le dernier message d'un lot reçoit la réponse, les autres "".
+# Debounce sans bloquer de thread : on n'attend que si `pending(user_id)` signale
+# d'autres messages de l'utilisateur encore en amont (file de jobs) ; le leader
+# rend alors la main et l'appelant suivant relance le lot (minuterie en secours,
+# au plus DEBOUNCE_S après le premier message).
+import os, time, asyncio, threading
+from concurrent.futures import Future
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+DEBOUNCE_S = float(os.getenv("DISPATCH_DEBOUNCE_MS", "800")) / 1000.0
+MAX_BATCH = int(os.getenv("DISPATCH_MAX_BATCH", "5"))
+
+Item = Tuple[str, Optional[str]]  # (texte, msg_sid)
+
+# La boucle ne garde qu'une référence faible aux tâches : un leader en cours
+# pourrait être ramassé par le GC (réponses perdues). Référence forte ici.
+_tasks = set()
+
+def spawn(coro) -> asyncio.Task:
+    """asyncio.create_task, tâche gardée en vie jusqu'à sa fin."""
+    task = asyncio.create_task(coro)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+class _UserQueue:
+    __slots__ = ("items", "first", "running", "timer")
+
+    def __init__(self):
+        self.items = []  # [(texte, sid, Future)]
+        self.first = time.monotonic()  # arrivée du premier message du lot en cours
+        self.running = False
+        self.timer = None
+
+def _no_pending(user_id: str) -> bool:
+    return False
+
+class Dispatcher:
+    def __init__(self, handle: Callable[[str, List[Item]], str],
+                 debounce_s: float = DEBOUNCE_S, max_batch: int = MAX_BATCH,
+                 pending: Callable[[str], bool] = _no_pending):
+        self.handle = handle
+        self.debounce_s = debounce_s
+        self.max_batch = max(1, max_batch)
+        self.pending = pending  # user_id -> d'autres messages arrivent-ils (déjà en file) ?
+        self._queues = {}  # user_id -> _UserQueue (présent = messages en attente ou lot en cours)
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.messages = 0
+        self.deferred = 0
+
+    def submit(self, user_id: str, text: str, msg_sid: Optional[str] = None) -> Future:
+        fut = Future()
+        with self._lock:
+            q = self._queues.get(user_id)
+            if q is None:
+                q = self._queues[user_id] = _UserQueue()
+            q.items.append((text, msg_sid, fut))
+            run = not q.running
+            q.running = True
+        if run:
+            self._drain(user_id, q)
+        return fut
+
+    def _resume(self, user_id: str, q: _UserQueue):
+        # minuterie : le message attendu n'est pas arrivé ici (autre process, job en retry)
+        with self._lock:
+            if q.running or self._queues.get(user_id) is not q:
+                return
+            q.running = True
+        self._drain(user_id, q)
+
+    def _drain(self, user_id: str, q: _UserQueue):
+        while True:
+            wait = self.debounce_s - (time.monotonic() - q.first)
+            more = wait > 0 and len(q.items) < self.max_batch and self.pending(user_id)
+            with self._lock:
+                if q.timer is not None:
+                    q.timer.cancel()
+                    q.timer = None
+                if more and len(q.items) < self.max_batch:
+                    q.running = False
+                    q.timer = threading.Timer(wait, self._resume, (user_id, q))
+                    q.timer.daemon = True
+                    q.timer.start()
+                    self.deferred += 1
+                    return
+                batch = q.items[:self.max_batch]
+                del q.items[:self.max_batch]
+            try:
+                reply = self.handle(user_id, [(t, sid) for (t, sid, _) in batch])
+            except BaseException as e:
+                for (_, _, f) in batch:
+                    f.set_exception(e)
+            else:
+                for (_, _, f) in batch[:-1]:
+                    f.set_result("")
+                batch[-1][2].set_result(reply)
+            with self._lock:
+                self.batches += 1
+                self.messages += len(batch)
+                if not q.items:
+                    del self._queues[user_id]
+                    return
+                q.first = 0.0  # arrivés pendant la génération : déjà assez attendu
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "active_users": len(self._queues),
+                "batches": self.batches,
+                "messages": self.messages,
+                "calls_saved": self.messages - self.batches,
+                "deferred": self.deferred,
+            }
+
+class AsyncDispatcher:
+    """Même contrat que Dispatcher pour une boucle asyncio : le leader est une
+    tâche, pas un thread bloqué ; handle est une coroutine."""
+
+    def __init__(self, handle: Callable[[str, List[Item]], Awaitable[str]],
+                 debounce_s: float = DEBOUNCE_S, max_batch: int = MAX_BATCH,
+                 pending: Callable[[str], bool] = _no_pending):
+        self.handle = handle
+        self.debounce_s = debounce_s
+        self.max_batch = max(1, max_batch)
+        self.pending = pending  # appelé hors de la boucle (asyncio.to_thread)
+        self._queues = {}  # user_id -> _UserQueue (présent = un leader tourne)
+        self.batches = 0
+        self.messages = 0
+
+    def submit(self, user_id: str, text: str, msg_sid: Optional[str] = None) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        q = self._queues.get(user_id)
+        if q is None:
+            q = self._queues[user_id] = _UserQueue()
+            spawn(self._drain(user_id, q))
+        q.items.append((text, msg_sid, fut))
+        return fut
+
+    async def _more(self, user_id: str, q: _UserQueue) -> bool:
+        if self.pending is _no_pending or len(q.items) >= self.max_batch:
+            return False
+        if self.debounce_s - (time.monotonic() - q.first) <= 0:
+            return False
+        return await asyncio.to_thread(self.pending, user_id)
+
+    async def _drain(self, user_id: str, q: _UserQueue):
+        while True:
+            # debounce seulement si d'autres messages de l'utilisateur sont déjà en file
+            while await self._more(user_id, q):
+                await asyncio.sleep(min(0.05, self.debounce_s))
+            batch = q.items[:self.max_batch]
+            del q.items[:self.max_batch]
+            try:
+                reply = await self.handle(user_id, [(t, sid) for (t, sid, _) in batch])
+            except Exception as e:
+                for (_, _, f) in batch:
+                    if not f.done():
+                        f.set_exception(e)
+            else:
+                for (_, _, f) in batch[:-1]:
+                    if not f.done():
+                        f.set_result("")
+                if not batch[-1][2].done():
+                    batch[-1][2].set_result(reply)
+            self.batches += 1
+            self.messages += len(batch)
+            if not q.items:
+                del self._queues[user_id]
+                return
+            q.first = 0.0
+
+    def stats(self) -> dict:
+        return {
+            "active_users": len(self._queues),
+            "batches": self.batches,
+            "messages": self.messages,
+            "calls_saved": self.messages - self.batches,
+        }
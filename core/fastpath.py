@@ -0,0 +1,164 @@
+# core/fastpath.py — réponses locales (sans LLM) aux messages triviaux
+# "ping", "Salut", "ok", "merci"… : une règle reconnaît le message entier
+# (normalisé : minuscules, sans accents ni ponctuation/emoji) et renvoie un
+# modèle de core.templates passé par enforce_style. Pas de règle → None, le
+# message suit le chemin LLM habituel. IN/OUT restent journalisés par
+# core.process_burst.
+#
+# Règles par profil (profile.json) :
+#   "fastpath": {"enabled": true, "disabled": ["ack"],
+#                "rules": [{"name": "bye", "match": ["bonne nuit"], "reply": "Bonne nuit {name} 🌙"},
+#                          {"name": "lol", "pattern": "(ha)+|lol|mdr", "template": "ack"}]}
+# Les règles du profil passent avant celles par défaut (même nom = remplacée).
+# "after_question": false → la règle ne répond pas si la dernière réponse OUT
+# posait une question (« ok » y est une vraie réponse : le LLM la traite).
+import os, re, time, threading, unicodedata
+from typing import Dict, Optional
+
+from .templates import TEMPLATES
+
+ENABLED = os.getenv("FASTPATH", "1") != "0"
+PROFILE_PATH = os.getenv("FASTPATH_PROFILE", "profile.json")
+MAX_CHARS = int(os.getenv("FASTPATH_MAX_CHARS", "40"))  # au-delà : jamais trivial
+
+DEFAULT_RULES = [
+    {"name": "ping", "match": ["ping", "test"], "template": "ping", "after_question": False},
+    {"name": "greeting", "match": ["salut", "bonjour", "bonsoir", "hello", "hey", "coucou",
+                                   "yo", "hi", "slt", "cc", "salut salut"], "template": "greeting"},
+    {"name": "thanks", "match": ["merci", "merci beaucoup", "merci bien", "thanks", "thx",
+                                 "mrc", "super merci", "top merci"], "template": "thanks"},
+    {"name": "ack", "match": ["ok", "okay", "oki", "okk", "d accord", "dac", "daccord", "ca marche",
+                              "parfait", "top", "cool", "nickel", "ok merci"], "template": "ack",
+     "after_question": False},
+]
+
+_lock = threading.Lock()
+_compiled = {}  # id(profile) -> (profile, [(name, set|None, regex|None, texte, after_question)])
+_stats = {"hits": 0, "misses": 0, "skipped_repeat": 0, "saved_ms": 0.0, "by_rule": {}}
+_llm_ms = None  # moyenne glissante de la génération LLM (estimation du temps gagné)
+
+def normalize(text: str) -> str:
+    s = unicodedata.normalize("NFKD", (text or "").lower())
+    s = "".join(ch if ch.isalnum() else " " for ch in s if not unicodedata.combining(ch))
+    return " ".join(s.split())
+
+def _compile(profile: dict):
+    conf = profile.get("fastpath") or {}
+    disabled = set(conf.get("disabled") or [])
+    rules, names = [], set()
+    for r in list(conf.get("rules") or []) + DEFAULT_RULES:
+        name = r.get("name") or f"rule{len(rules)}"
+        if name in names or name in disabled:
+            continue
+        names.add(name)
+        text = r.get("reply") or TEMPLATES.get(r.get("template") or name)
+        if not text:
+            continue
+        words = {normalize(m) for m in r.get("match") or []} or None
+        try:
+            pattern = re.compile(r["pattern"]) if r.get("pattern") else None
+        except re.error as e:
+            # une regex invalide du profil ne doit pas priver tout le monde de réponse
+            print(f"[FAST][rule-err] {name}: pattern invalide ({e}), règle ignorée", flush=True)
+            continue
+        if words or pattern:
+            rules.append((name, words, pattern, text, r.get("after_question", True)))
+    return rules
+
+def _rules(profile: dict):
+    # load_profile renvoie le même dict tant que le fichier ne change pas
+    key = id(profile)
+    with _lock:
+        hit = _compiled.get(key)
+        if hit is not None and hit[0] is profile:
+            return hit[1]
+    rules = _compile(profile)
+    with _lock:
+        if len(_compiled) > 32:
+            _compiled.clear()
+        _compiled[key] = (profile, rules)
+    return rules
+
+def _asked(history) -> bool:
+    """La dernière réponse OUT se termine-t-elle par une question ?"""
+    for h in reversed(history):
+        if h.get("direction") == "OUT":
+            return (h.get("text") or "").rstrip().endswith("?")
+    return False
+
+def match(text: str, profile: dict, asked: bool = False) -> Optional[tuple]:
+    """(nom de règle, réponse brute) si le message entier est trivial, sinon None.
+    asked : la dernière réponse posait une question (règles "after_question": false écartées)."""
+    if len(text or "") > MAX_CHARS:
+        return None
+    norm = normalize(text)
+    if not norm:
+        return None
+    for (name, words, pattern, reply, after_question) in _rules(profile):
+        if asked and not after_question:
+            continue
+        if (words and norm in words) or (pattern and pattern.fullmatch(norm)):
+            return name, reply
+    return None
+
+def _render(reply: str, profile: dict) -> str:
+    from .llm import enforce_style
+    name = (profile.get("user") or {}).get("display_name") or ""
+    try:
+        text = reply.format(name=name)
+    except (KeyError, IndexError, ValueError):
+        text = reply
+    text = re.sub(r"[ \t]+", " ", text).replace(" ,", ",").strip()
+    return enforce_style(text, profile)
+
+def answer(user_id: str, text: str, profile: Optional[dict] = None) -> Optional[str]:
+    """Réponse locale pour `text`, ou None (→ LLM). Branché sur core.process_burst."""
+    if not ENABLED:
+        return None
+    t0 = time.perf_counter()
+    if profile is None:
+        from .llm import load_profile
+        profile = load_profile(PROFILE_PATH)
+    if not (profile.get("fastpath") or {}).get("enabled", True):
+        return None
+    m = match(text, profile)
+    if m is not None:
+        from . import get_history
+        history = get_history(user_id, 10)
+        if _asked(history):
+            m = match(text, profile, asked=True)
+    if m is None:
+        with _lock:
+            _stats["misses"] += 1
+        return None
+    name, reply = m
+    reply = _render(reply, profile)
+    # Pas deux fois la même réponse locale d'affilée (ex. l'accueil) : le LLM varie
+    recent = [h.get("text") for h in history if h.get("direction") == "OUT"]
+    if reply in recent:
+        with _lock:
+            _stats["skipped_repeat"] += 1
+        return None
+    ms = (time.perf_counter() - t0) * 1000
+    with _lock:
+        _stats["hits"] += 1
+        _stats["by_rule"][name] = _stats["by_rule"].get(name, 0) + 1
+        if _llm_ms is not None:
+            _stats["saved_ms"] += max(_llm_ms - ms, 0.0)
+    print(f"[FAST] user={user_id} rule={name} ms={ms:.2f}", flush=True)
+    return reply
+
+def record_llm(ms: float):
+    """Durée d'une génération LLM (moyenne glissante → temps gagné par hit)."""
+    global _llm_ms
+    with _lock:
+        _llm_ms = ms if _llm_ms is None else 0.9 * _llm_ms + 0.1 * ms
+
+def stats() -> Dict:
+    with _lock:
+        st = dict(_stats, by_rule=dict(_stats["by_rule"]))
+        seen = st["hits"] + st["misses"] + st["skipped_repeat"]
+        st["hit_ratio"] = round(st["hits"] / seen, 3) if seen else 0.0
+        st["saved_ms"] = round(st["saved_ms"])
+        st["llm_ms_avg"] = round(_llm_ms) if _llm_ms is not None else None
+    return st
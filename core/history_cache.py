@@ -0,0 +1,148 @@
+# core/history_cache.py — cache LRU en mémoire des derniers tours par utilisateur
+# Un anneau borné (deque) par utilisateur actif, alimenté par add_message et
+# invalidé par clear_history. Chaque entrée porte la "version" de la DB lue au
+# remplissage (PRAGMA data_version, qui ne bouge que si un AUTRE process
+# gunicorn a commité) : version différente ou TTL dépassé → relecture SQLite.
+import os, threading, time
+from collections import OrderedDict, deque
+
+MAX_USERS = int(os.getenv("HISTORY_CACHE_USERS", "1000"))       # 0 = cache désactivé
+MAX_BYTES = int(os.getenv("HISTORY_CACHE_BYTES", str(8 * 1024 * 1024)))
+TURNS = int(os.getenv("HISTORY_CACHE_TURNS", "32"))
+TTL_S = float(os.getenv("HISTORY_CACHE_TTL", "60"))
+
+_ROW_OVERHEAD = 96  # estimation grossière d'un tuple (direction, text) en mémoire
+
+def _row_size(text: str) -> int:
+    return _ROW_OVERHEAD + len(text or "")
+
+class _Entry:
+    __slots__ = ("rows", "complete", "version", "ts", "size", "seq")
+
+    def __init__(self):
+        self.rows = None      # None tant que l'entrée n'est pas remplie
+        self.complete = False # True si l'anneau contient TOUT l'historique
+        self.version = None
+        self.ts = 0.0
+        self.size = 0
+        self.seq = 0          # incrémenté à chaque écriture (anti-course remplissage)
+
+class HistoryCache:
+    def __init__(self, max_users: int = MAX_USERS, max_bytes: int = MAX_BYTES,
+                 turns: int = TURNS, ttl_s: float = TTL_S):
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.turns = turns
+        self.ttl_s = ttl_s
+        self._entries = OrderedDict()  # user_id -> _Entry
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_users > 0 and self.turns > 0
+
+    def get(self, user_id: str, limit: int, version):
+        """Renvoie les `limit` derniers tours [(direction, text)] ou None (miss)."""
+        with self._lock:
+            e = self._entries.get(user_id)
+            if (e is not None and e.rows is not None and e.version == version
+                    and time.monotonic() - e.ts < self.ttl_s
+                    and (limit <= len(e.rows) or e.complete)):
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                rows = list(e.rows)
+                return rows[-limit:] if limit > 0 else []
+            self.misses += 1
+            return None
+
+    def begin_fill(self, user_id: str) -> int:
+        """À appeler AVANT la lecture SQLite ; renvoie un jeton pour fill()."""
+        with self._lock:
+            e = self._entries.get(user_id)
+            if e is None:
+                e = self._entries[user_id] = _Entry()
+                self._evict()
+            return e.seq
+
+    def fill(self, user_id: str, token: int, rows, fetched: int, version):
+        """rows : du plus ancien au plus récent, lus avec LIMIT `fetched`."""
+        with self._lock:
+            e = self._entries.get(user_id)
+            if e is None or e.seq != token:
+                return  # une écriture est passée entre-temps : on ne fige pas un état périmé
+            self._bytes -= e.size
+            e.rows = deque(rows[-self.turns:], maxlen=self.turns)
+            e.complete = len(rows) < fetched and len(rows) <= self.turns
+            e.version = version
+            e.ts = time.monotonic()
+            e.size = sum(_row_size(t) for (_, t) in e.rows)
+            self._bytes += e.size
+            self._entries.move_to_end(user_id)
+            self._evict()
+
+    def touch(self, user_id: str):
+        """Signale une écriture en cours (les remplissages concurrents seront ignorés)."""
+        with self._lock:
+            e = self._entries.get(user_id)
+            if e is not None:
+                e.seq += 1
+
+    def append(self, user_id: str, direction: str, text: str):
+        with self._lock:
+            e = self._entries.get(user_id)
+            if e is None:
+                return
+            e.seq += 1
+            if e.rows is None:
+                return
+            if len(e.rows) == e.rows.maxlen:
+                _, old = e.rows[0]
+                e.size -= _row_size(old)
+                self._bytes -= _row_size(old)
+                e.complete = False
+            e.rows.append((direction, text))
+            e.size += _row_size(text)
+            self._bytes += _row_size(text)
+            self._entries.move_to_end(user_id)
+            self._evict()
+
+    def invalidate(self, user_id: str = None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+                self._bytes = 0
+                return
+            e = self._entries.pop(user_id, None)
+            if e is not None:
+                self._bytes -= e.size
+
+    def reset(self):
+        """Vide tout et recrée le verrou (fils après fork)."""
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    def _evict(self):
+        # Appelant : _lock tenu
+        while self._entries and (len(self._entries) > self.max_users or self._bytes > self.max_bytes):
+            _, e = self._entries.popitem(last=False)
+            self._bytes -= e.size
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "users": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+            }
+
+cache = HistoryCache()
@@ -0,0 +1,243 @@
+# core/jobs.py — file de jobs durable (SQLite, même DB que core.memory)
+# - enqueue() écrit le job dans la table `jobs` (survit à un restart/redeploy) ;
+# - des threads workers le réclament avec un bail (lease) ; bail expiré → job repris ;
+# - un handler peut renvoyer une Future : le job est clos à sa résolution ;
+# - échec → nouvel essai avec backoff exponentiel, puis état 'dead' ;
+# - contre-pression : au-delà de JOBS_MAX_DEPTH, 'reject' (QueueFull) ou 'shed'
+#   (le plus ancien job en attente part en 'dead') ;
+# - workers au repos : simple lecture (pool) avant de réclamer, pas de BEGIN
+#   IMMEDIATE sans job prêt ; jobs terminés supprimés, 'dead' purgés après
+#   JOBS_KEEP_DEAD s.
+import os, json, time, random, socket, threading
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional
+
+from . import memory as _memory
+from infra.monitoring import log_json as _log, observe as _observe
+
+LEASE_S = float(os.getenv("JOBS_LEASE", "120"))
+MAX_ATTEMPTS = int(os.getenv("JOBS_MAX_ATTEMPTS", "5"))
+BACKOFF_BASE_S = float(os.getenv("JOBS_BACKOFF_BASE", "2"))
+BACKOFF_MAX_S = float(os.getenv("JOBS_BACKOFF_MAX", "300"))
+MAX_DEPTH = int(os.getenv("JOBS_MAX_DEPTH", "1000"))
+OVERFLOW = os.getenv("JOBS_OVERFLOW", "reject").lower()  # reject | shed
+POLL_S = float(os.getenv("JOBS_POLL", "0.5"))
+STATS_EVERY_S = float(os.getenv("JOBS_STATS_EVERY", "60"))
+KEEP_DEAD_S = float(os.getenv("JOBS_KEEP_DEAD", str(7 * 86400)))  # 0 = jamais purgés
+PURGE_EVERY_S = 3600
+
+class QueueFull(Exception):
+    pass
+
+_handlers = {}  # kind -> Callable[[dict], None]
+_wake = threading.Event()
+_workers = None  # (pid, [threads])
+_workers_lock = threading.Lock()
+
+def register(kind: str, handler: Callable[[dict], None]):
+    _handlers[kind] = handler
+
+def bootstrap_jobs() -> int:
+    """Crée la table et reprend les jobs restés 'running' dont le bail a expiré."""
+    with _memory.write_tx() as c:
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind        TEXT NOT NULL,
+            payload     TEXT NOT NULL,
+            state       TEXT NOT NULL DEFAULT 'queued'
+                        CHECK(state IN ('queued','running','dead')),
+            attempts    INTEGER NOT NULL DEFAULT 0,
+            run_at      REAL NOT NULL,
+            lease_until REAL,
+            owner       TEXT,
+            last_error  TEXT,
+            created_at  REAL NOT NULL,
+            updated_at  REAL NOT NULL
+        )""")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_state_run ON jobs(state, run_at)")
+    return recover()
+
+def recover() -> int:
+    now = time.time()
+    with _memory.write_tx() as c:
+        n = c.execute(
+            "UPDATE jobs SET state='queued', owner=NULL, lease_until=NULL, updated_at=? "
+            "WHERE state='running' AND lease_until < ?", (now, now)
+        ).rowcount
+    if n:
+        print(f"[JOBS] {n} job(s) repris après bail expiré", flush=True)
+    return n
+
+def enqueue(kind: str, payload: dict, delay_s: float = 0.0) -> int:
+    now = time.time()
+    with _memory.write_tx() as c:
+        depth = c.execute("SELECT COUNT(*) FROM jobs WHERE state='queued'").fetchone()[0]
+        if MAX_DEPTH > 0 and depth >= MAX_DEPTH:
+            if OVERFLOW != "shed":
+                raise QueueFull(f"depth={depth}")
+            c.execute(
+                "UPDATE jobs SET state='dead', last_error='shed', updated_at=? WHERE id IN "
+                "(SELECT id FROM jobs WHERE state='queued' ORDER BY id LIMIT ?)",
+                (now, depth - MAX_DEPTH + 1),
+            )
+            _log("jobs_shed", depth=depth)
+        job_id = c.execute(
+            "INSERT INTO jobs (kind, payload, run_at, created_at, updated_at) VALUES (?,?,?,?,?)",
+            (kind, json.dumps(payload, ensure_ascii=False), now + delay_s, now, now),
+        ).lastrowid
+    _wake.set()
+    ensure_workers()
+    return job_id
+
+def queued_for(kind: str, field: str, value) -> bool:
+    """Vrai si un job `kind` prêt attend avec payload[field] == value (debounce du dispatch)."""
+    with _memory.read_conn() as c:
+        return c.execute(
+            "SELECT 1 FROM jobs WHERE state='queued' AND kind=? AND run_at <= ? "
+            "AND json_extract(payload, '$.' || ?) = ? LIMIT 1", (kind, time.time(), field, value),
+        ).fetchone() is not None
+
+def _ready(now: float) -> bool:
+    with _memory.read_conn() as c:
+        return c.execute(
+            "SELECT 1 FROM jobs WHERE (state='queued' AND run_at <= ?) "
+            "OR (state='running' AND lease_until < ?) LIMIT 1", (now, now),
+        ).fetchone() is not None
+
+def _claim(owner: str) -> Optional[tuple]:
+    now = time.time()
+    if not _ready(now):
+        return None  # file vide : pas de verrou d'écriture pris pour rien
+    with _memory.write_tx() as c:
+        row = c.execute(
+            "SELECT id FROM jobs WHERE state='queued' AND run_at <= ? ORDER BY run_at, id LIMIT 1", (now,)
+        ).fetchone() or c.execute(
+            "SELECT id FROM jobs WHERE state='running' AND lease_until < ? ORDER BY id LIMIT 1", (now,)
+        ).fetchone()
+        if not row:
+            return None
+        return c.execute(
+            "UPDATE jobs SET state='running', owner=?, lease_until=?, attempts=attempts+1, updated_at=? "
+            "WHERE id=? RETURNING id, kind, payload, attempts, created_at",
+            (owner, now + LEASE_S, now, row[0]),
+        ).fetchone()
+
+def _complete(job_id: int):
+    with _memory.write_tx() as c:
+        c.execute("DELETE FROM jobs WHERE id=?", (job_id,))
+
+def _fail(job_id: int, attempts: int, err: str):
+    now = time.time()
+    with _memory.write_tx() as c:
+        if attempts >= MAX_ATTEMPTS:
+            c.execute("UPDATE jobs SET state='dead', owner=NULL, lease_until=NULL, last_error=?, updated_at=? "
+                      "WHERE id=?", (err[:500], now, job_id))
+            _log("job_dead", id=job_id, attempts=attempts, error=err[:200])
+            return
+        delay = min(BACKOFF_MAX_S, BACKOFF_BASE_S * (2 ** (attempts - 1)))
+        delay *= random.uniform(0.8, 1.2)
+        c.execute("UPDATE jobs SET state='queued', owner=NULL, lease_until=NULL, last_error=?, run_at=?, "
+                  "updated_at=? WHERE id=?", (err[:500], now + delay, now, job_id))
+
+def run_one(owner: str) -> bool:
+    """Réclame et exécute un job. Renvoie False si la file est vide."""
+    job = _claim(owner)
+    if job is None:
+        return False
+    job_id, kind, payload, attempts, created_at = job
+    if attempts == 1:
+        _observe("stage_ms", (time.time() - created_at) * 1000, stage="queue_wait")
+    handler = _handlers.get(kind)
+    try:
+        if handler is None:
+            raise RuntimeError(f"aucun handler pour '{kind}'")
+        res = handler(json.loads(payload))
+    except Exception as e:
+        _finish(job_id, kind, attempts, e)
+        return True
+    if isinstance(res, Future) and not res.done():
+        # handler asynchrone : le worker est libéré, le job reste sous bail
+        # jusqu'à la résolution de la Future
+        res.add_done_callback(lambda f: _finish(job_id, kind, attempts, f.exception()))
+    else:
+        _finish(job_id, kind, attempts, res.exception() if isinstance(res, Future) else None)
+    return True
+
+def _finish(job_id: int, kind: str, attempts: int, err: Optional[BaseException]):
+    try:
+        if err is None:
+            _complete(job_id)
+            return
+        print(f"[JOBS][err] id={job_id} kind={kind} try={attempts} {err}", flush=True)
+        _fail(job_id, attempts, str(err) or err.__class__.__name__)
+    except Exception as e:
+        # bail expiré → le job sera repris
+        print(f"[JOBS][finish-err] id={job_id} {e}", flush=True)
+
+def purge(keep_dead_s: float = KEEP_DEAD_S) -> int:
+    """Supprime les jobs 'dead' plus vieux que keep_dead_s (les jobs réussis le sont déjà)."""
+    if keep_dead_s <= 0:
+        return 0
+    with _memory.write_tx() as c:
+        n = c.execute("DELETE FROM jobs WHERE state='dead' AND updated_at < ?",
+                      (time.time() - keep_dead_s,)).rowcount
+    if n:
+        _log("jobs_purge", dead=n)
+    return n
+
+def _worker_loop(idx: int):
+    owner = f"{socket.gethostname()}:{os.getpid()}:{idx}"
+    last_stats = last_purge = time.monotonic()
+    while True:
+        try:
+            busy = run_one(owner)
+        except Exception as e:
+            print(f"[JOBS][loop-err] {e}", flush=True)
+            busy = False
+        if idx == 0 and STATS_EVERY_S > 0 and time.monotonic() - last_stats >= STATS_EVERY_S:
+            last_stats = time.monotonic()
+            try:
+                _log("jobs", **stats())
+            except Exception:
+                pass
+        if idx == 0 and time.monotonic() - last_purge >= PURGE_EVERY_S:
+            last_purge = time.monotonic()
+            try:
+                purge()
+            except Exception as e:
+                print(f"[JOBS][purge-err] {e}", flush=True)
+        if not busy:
+            _wake.wait(POLL_S)
+            _wake.clear()
+
+def ensure_workers(n: Optional[int] = None):
+    """Démarre (une fois par process, y compris après fork) les threads workers."""
+    global _workers
+    w = _workers
+    if w is not None and w[0] == os.getpid():
+        return
+    with _workers_lock:
+        w = _workers
+        if w is not None and w[0] == os.getpid():
+            return
+        n = n or int(os.getenv("WEBHOOK_WORKERS", "4"))
+        threads = []
+        for i in range(n):
+            t = threading.Thread(target=_worker_loop, args=(i,), name=f"jobs-{i}", daemon=True)
+            t.start()
+            threads.append(t)
+        _workers = (os.getpid(), threads)
+
+def stats() -> Dict:
+    now = time.time()
+    with _memory.read_conn() as c:
+        rows = c.execute("SELECT state, COUNT(*), MIN(created_at) FROM jobs GROUP BY state").fetchall()
+    by_state = {s: (n, oldest) for (s, n, oldest) in rows}
+    queued, oldest = by_state.get("queued", (0, None))
+    return {
+        "depth": queued,
+        "running": by_state.get("running", (0, None))[0],
+        "dead": by_state.get("dead", (0, None))[0],
+        "oldest_age_s": round(now - oldest, 1) if oldest else 0.0,
+    }
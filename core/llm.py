@@ -1,26 +1,32 @@
 # core/llm.py
-import os, json, textwrap, time
+import os, re, json, textwrap, time, threading
 from datetime import datetime
+from zoneinfo import ZoneInfo
 from openai import OpenAI
-from infra.monitoring import log_json as _log
+from infra.monitoring import log_json as _log, span as _span
+from infra import resilience as _resilience
+from . import prompt as _prompt
+from . import response_cache as _rcache
+from . import router as _router
+
+BASE_PROMPT_PATH = "LLM_SYSTEM_PROMPT.txt"
 
 # ---------- Chargement profil ----------
+_DEFAULT_PROFILE = {
+    "display_name": "Ami",
+    "language": "fr",
+    "timezone": "Europe/Paris",
+    "tone": "chaleureux, clair, sans jargon",
+    "short_sentences": True,
+    "signature": "— Bot 🤝",
+    "features": {"weather": False, "sports": [], "checkin": {"enabled": False}},
+    "preferences": {"reply_max_chars": 400, "emoji_level": "léger"},
+}
+
 def load_profile(path: str = "profile.json") -> dict:
-    try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        # fallback minimal
-        return {
-            "display_name": "Ami",
-            "language": "fr",
-            "timezone": "Europe/Paris",
-            "tone": "chaleureux, clair, sans jargon",
-            "short_sentences": True,
-            "signature": "— Bot 🤝",
-            "features": {"weather": False, "sports": [], "checkin": {"enabled": False}},
-            "preferences": {"reply_max_chars": 400, "emoji_level": "léger"},
-        }
+    """Profil JSON mis en cache (relu si son mtime change). Ne pas le modifier en place."""
+    # fallback minimal si le fichier est absent
+    return _prompt.read_json(path, default=_DEFAULT_PROFILE)
 
 def _ensure_profile(profile_or_path) -> dict:
     """Accepte soit un dict, soit un chemin vers le JSON."""
@@ -30,11 +36,10 @@ def _ensure_profile(profile_or_path) -> dict:
 
 # ---------- Prompt ----------
 def base_prompt() -> str:
-    try:
-        with open("LLM_SYSTEM_PROMPT.txt", "r", encoding="utf-8") as f:
-            return f.read().strip()
-    except Exception:
-        return "Parle français. Phrases courtes. Ton chaleureux, clair, sans jargon."
+    return _prompt.read_text(
+        BASE_PROMPT_PATH,
+        default="Parle français. Phrases courtes. Ton chaleureux, clair, sans jargon.",
+    )
 
 def build_system_prompt(profile: dict) -> str:
     tone = profile.get("tone", "chaleureux, clair, sans jargon")
@@ -79,82 +84,327 @@ Règles de style:
 """
     return textwrap.dedent(sys).strip()
 
-def enforce_style(text: str, profile: dict) -> str:
-    sig = profile.get("signature", "")
-    max_chars = int(profile.get("preferences", {}).get("reply_max_chars", 400))
+def system_prompt(profile_or_path="profile.json") -> "_prompt.Compiled":
+    """Prompt système compilé (texte + nb de tokens), recompilé seulement si le
+    profil ou LLM_SYSTEM_PROMPT.txt changent."""
+    base_v = _prompt.file_version(BASE_PROMPT_PATH)
+    if isinstance(profile_or_path, dict):
+        profile = profile_or_path
+        key = ("dict", json.dumps(profile, sort_keys=True, ensure_ascii=False), base_v)
+    else:
+        path = profile_or_path or "profile.json"
+        key = ("path", path, _prompt.file_version(path), base_v)
+        profile = None
+    return _prompt.compile_prompt(
+        key, lambda: build_system_prompt(profile if profile is not None else load_profile(path))
+    )
+
+def reply_max_chars(profile: dict) -> int:
+    return int(profile.get("preferences", {}).get("reply_max_chars", 400))
+
+def truncate(text: str, max_chars: int) -> str:
     text = (text or "").strip()
-    if len(text) > max_chars:
+    if max_chars > 0 and len(text) > max_chars:
         text = text[:max_chars - 1].rstrip() + "…"
+    return text
+
+def enforce_style(text: str, profile: dict) -> str:
+    sig = profile.get("signature", "")
+    text = truncate(text, reply_max_chars(profile))
     if sig and not text.endswith(sig):
         if not text.endswith("\n"): text += "\n"
         text += sig
     return text
 
-# ---------- Client OpenAI avec timeout & retries ----------
+# ---------- Client OpenAI partagé (process-wide) ----------
+# Un seul client par process (core.llm ET app._openai_generate) : pool HTTP
+# keep-alive + session TLS conservés d'un appel à l'autre. Recréé après un fork
+# gunicorn (un pool hérité du parent n'est jamais réutilisé).
+# Surcharges par appel : client().with_options(timeout=..., max_retries=...),
+# qui partage le même pool HTTP.
+OPENAI_KEEPALIVE_S = float(os.getenv("OPENAI_KEEPALIVE", "120"))
+OPENAI_POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", "20"))
+OPENAI_ASYNC_POOL_SIZE = int(os.getenv("OPENAI_ASYNC_POOL_SIZE", "200"))
+
 _client = None
+_client_pid = None
+_client_lock = threading.Lock()
+_trace = threading.local()
+_conn_stats = {"requests": 0, "new_conns": 0, "connect_ms_total": 0.0}
+
+def _on_trace(event: str, info: dict):
+    # Événements httpcore : connexion TCP et handshake TLS (absents si keep-alive)
+    if event in ("connection.connect_tcp.started", "connection.start_tls.started"):
+        _trace.t = time.perf_counter()
+    elif event in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+        t = getattr(_trace, "t", None)
+        if t is not None:
+            _trace.connect_ms += (time.perf_counter() - t) * 1000
+        if event == "connection.connect_tcp.complete":
+            _trace.new_conn = True
+
+def _on_request(request):
+    _trace.connect_ms = 0.0
+    _trace.new_conn = False
+    _trace.t = None
+    request.extensions["trace"] = _on_trace
+
+def _on_response(response):
+    with _client_lock:
+        _conn_stats["requests"] += 1
+        if getattr(_trace, "new_conn", False):
+            _conn_stats["new_conns"] += 1
+        _conn_stats["connect_ms_total"] += getattr(_trace, "connect_ms", 0.0)
+
+def _build_client():
+    from openai import DefaultHttpxClient, DEFAULT_CONNECTION_LIMITS
+    # même classe Limits que le transport du SDK, sans importer httpx directement
+    limits = type(DEFAULT_CONNECTION_LIMITS)(
+        max_connections=OPENAI_POOL_SIZE,
+        max_keepalive_connections=OPENAI_POOL_SIZE,
+        keepalive_expiry=OPENAI_KEEPALIVE_S,
+    )
+    http_client = DefaultHttpxClient(
+        limits=limits,
+        event_hooks={"request": [_on_request], "response": [_on_response]},
+    )
+    return OpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        timeout=15.0,      # secondes (défaut ; surcharge via with_options)
+        max_retries=2,     # le SDK retente automatiquement
+        http_client=http_client,
+    )
+
 def client():
-    """Client OpenAI robuste: timeout global + 2 retries SDK."""
-    global _client
-    if _client is None:
-        _client = OpenAI(
-            api_key=os.getenv("OPENAI_API_KEY"),
-            timeout=15.0,      # secondes
-            max_retries=2      # le SDK retente automatiquement
-        )
+    """Client OpenAI partagé: pool keep-alive, timeout global + 2 retries SDK."""
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                _client = _build_client()
+                _client_pid = os.getpid()
     return _client
 
+_aclients = {}  # id(boucle asyncio) -> (boucle, AsyncOpenAI)
+
+def aclient():
+    """Client AsyncOpenAI partagé par boucle asyncio (serveur asgi.py), pool
+    keep-alive plus large (pas de thread par connexion) ; à appeler depuis la boucle."""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    hit = _aclients.get(id(loop))
+    if hit is not None and hit[0] is loop:
+        return hit[1]
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DEFAULT_CONNECTION_LIMITS
+    limits = type(DEFAULT_CONNECTION_LIMITS)(
+        max_connections=OPENAI_ASYNC_POOL_SIZE,
+        max_keepalive_connections=OPENAI_ASYNC_POOL_SIZE,
+        keepalive_expiry=OPENAI_KEEPALIVE_S,
+    )
+    c = AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        timeout=15.0,
+        max_retries=2,
+        http_client=DefaultAsyncHttpxClient(limits=limits),
+    )
+    _aclients[id(loop)] = (loop, c)
+    return c
+
+def _reset_client():
+    global _client, _client_pid, _client_lock
+    _client = _client_pid = None
+    _client_lock = threading.Lock()
+    _aclients.clear()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_client)
+
+# Disjoncteur + limite adaptative partagés par tous les appels OpenAI du process
+OPENAI_LATENCY_TARGET_S = float(os.getenv("OPENAI_LATENCY_TARGET", "6"))
+
+def _is_upstream_failure(e: BaseException) -> bool:
+    # 4xx (hors 408/409/429) : requête refusée, pas une panne amont
+    status = getattr(e, "status_code", None)
+    return not (isinstance(status, int) and 400 <= status < 500 and status not in (408, 409, 429))
+
+upstream = _resilience.upstream("openai", OPENAI_LATENCY_TARGET_S, _is_upstream_failure)
+
+def last_call_timing() -> dict:
+    """Temps de connexion (TCP+TLS) du dernier appel HTTP de ce thread."""
+    return {"connect_ms": round(getattr(_trace, "connect_ms", 0.0), 1),
+            "new_conn": bool(getattr(_trace, "new_conn", False))}
+
+def client_stats() -> dict:
+    """Pool HTTP du client synchrone : requêtes, connexions neuves / réutilisées, temps de connexion."""
+    with _client_lock:
+        st = dict(_conn_stats)
+    st["connect_ms_total"] = round(st["connect_ms_total"], 1)
+    st["reused"] = st["requests"] - st["new_conns"]
+    return st
+
+# ---------- Streaming ----------
+# LLM_STREAM=1 : les générateurs consomment la complétion en flux et coupent le
+# flux dès que reply_max_chars est atteint (tokens et temps économisés).
+# consume_stream() sert aussi à app._openai_generate (OPENAI_STREAM=1), qui peut
+# envoyer la/les première(s) phrase(s) complète(s) pendant que la suite arrive.
+LLM_STREAM = os.getenv("LLM_STREAM", "0") == "1"
+STREAM_EARLY_MIN_CHARS = int(os.getenv("STREAM_EARLY_MIN_CHARS", "60"))
+_SENTENCE_END = re.compile(r"[.!?…]+[\"»)]*\s+(?=\S)")
+
+def _early_cut(text: str, min_chars: int, max_chars: int) -> int:
+    """Fin de la première phrase complète au-delà de min_chars, suivie d'autre
+    chose (jamais un envoi anticipé qui serait toute la réponse), 0 sinon."""
+    for m in _SENTENCE_END.finditer(text, min(min_chars, len(text))):
+        end = len(text[:m.end()].rstrip())
+        if max_chars > 0 and end >= max_chars - 1:
+            return 0  # la troncature couperait avant : pas de préfixe sûr
+        return end
+    return 0
+
+class StreamInterrupted(Exception):
+    """Flux coupé après le début : échec amont ; .text/.info gardent la partie lue."""
+
+    def __init__(self, text: str, info: dict):
+        super().__init__(info["error"])
+        self.text = text
+        self.info = info
+
+def stream_completion(create, max_chars: int = 0, on_early=None, up=None, **kwargs):
+    """Crée ET lit le flux sous le disjoncteur/limiteur `up` (défaut : upstream) :
+    durée totale et erreurs en cours de flux comptent. Renvoie (texte, infos) ;
+    lève StreamInterrupted si le flux a été coupé (texte partiel, pas de cache)."""
+    def _run():
+        text, info = consume_stream(create(stream=True, **kwargs), max_chars, on_early)
+        if info["error"]:
+            raise StreamInterrupted(text, info)
+        return text, info
+    return (up or upstream).call(_run)
+
+def consume_stream(stream, max_chars: int = 0, on_early=None,
+                   early_min_chars: int = STREAM_EARLY_MIN_CHARS):
+    """Lit un flux chat.completions. Renvoie (texte, infos) ; infos : ttft_ms,
+    early_ms, early (texte envoyé en avance), truncated, error. Le flux est fermé
+    dès que max_chars est dépassé. Une erreur en cours de flux garde le début."""
+    t0 = time.monotonic()
+    text = ""
+    info = {"ttft_ms": None, "early_ms": None, "early": "", "truncated": False, "error": None}
+    try:
+        for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if not delta:
+                continue
+            if info["ttft_ms"] is None:
+                info["ttft_ms"] = int((time.monotonic() - t0) * 1000)
+            text += delta
+            if on_early is not None and not info["early"]:
+                cut = _early_cut(text, early_min_chars, max_chars)
+                if cut:
+                    # strip comme truncate() : le texte final doit commencer par cette partie
+                    info["early"] = text[:cut].strip()
+                    on_early(info["early"])
+                    info["early_ms"] = int((time.monotonic() - t0) * 1000)
+            if max_chars > 0 and len(text) > max_chars:
+                info["truncated"] = True
+                break
+    except Exception as e:
+        if not text:
+            raise
+        info["error"] = str(e)
+    finally:
+        close = getattr(stream, "close", None)
+        if close is not None:
+            try:
+                close()
+            except Exception:
+                pass
+    return text, info
+
 # ---------- Générateurs ----------
 def generate_reply(user_text: str, profile_or_path="profile.json") -> str:
     profile = _ensure_profile(profile_or_path)
-    system = build_system_prompt(profile)
-    rsp = client().chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": system},
-            {"role": "user", "content": user_text},
-        ],
-        temperature=0.7,
+    system = system_prompt(profile_or_path).text
+    messages = [
+        {"role": "system", "content": system},
+        {"role": "user", "content": user_text},
+    ]
+    route = _router.route(messages, profile=profile)
+    return _rcache.cached(route.model, messages, lambda: _complete(messages, 0.7, profile, route),
+                          profile=profile, temperature=0.7)
+
+def _complete(messages, temperature, profile, route=None, kind="chat") -> str:
+    route = route or _router.route(messages, kind, profile)
+    t0 = time.perf_counter()
+    try:
+        with _span("llm"):
+            text, usage = _complete_timed(messages, temperature, profile, route)
+    except Exception as e:
+        _router.record(route, (time.perf_counter() - t0) * 1000, error=e)
+        raise
+    ms = (time.perf_counter() - t0) * 1000
+    _router.record(route, ms, usage)
+    _router.maybe_shadow(route, messages, text, ms, usage, temperature, profile)
+    return text
+
+def _complete_timed(messages, temperature, profile, route):
+    if LLM_STREAM:
+        try:
+            text, info = stream_completion(
+                client().chat.completions.create,
+                reply_max_chars(profile),
+                model=route.model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=route.max_tokens,
+            )
+        except StreamInterrupted as e:
+            _rcache.skip_store()  # réponse partielle : servie, jamais mise en cache
+            text, info = e.text, e.info
+        _log("llm_stream", ttft_ms=info["ttft_ms"], truncated=info["truncated"], error=info["error"])
+        return enforce_style(text, profile), None
+    rsp = upstream.call(
+        client().chat.completions.create,
+        model=route.model,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=route.max_tokens,
     )
-    return enforce_style(rsp.choices[0].message.content, profile)
+    return enforce_style(rsp.choices[0].message.content, profile), getattr(rsp, "usage", None)
 
-def generate_checkin(profile_or_path="profile.json", weather_hint=None) -> str:
+def generate_checkin(profile_or_path="profile.json", weather_hint=None, now=None) -> str:
     profile = _ensure_profile(profile_or_path)
-    system = build_system_prompt(profile)
-    now = datetime.now().strftime("%A %d %B, %H:%M")
+    system = system_prompt(profile_or_path).text
+    if now is None:
+        try:
+            now = datetime.now(ZoneInfo(profile.get("timezone") or "Europe/Paris"))
+        except Exception:
+            now = datetime.now()
+    now = now.strftime("%A %d %B, %H:%M")
     u = "Fais un check-in du matin (bref). Format: bonjour bref + météo (si dispo) + 1–2 priorités + 1 conseil."
     if weather_hint:
         u += f" Météo: {weather_hint}."
     u += f" Date/heure: {now}. Utilise mes intérêts si utile."
-    rsp = client().chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": system},
-            {"role": "user", "content": u},
-        ],
-        temperature=0.6,
-    )
-    return enforce_style(rsp.choices[0].message.content, profile)
+    return _complete([
+        {"role": "system", "content": system},
+        {"role": "user", "content": u},
+    ], 0.6, profile, kind="checkin")
 
 # ---------- Wrapper sûr (retry + fallback) ----------
 def safe_generate_reply(user_text: str, profile_or_path="profile.json") -> str:
     """
     Appelle generate_reply avec:
-      - 1 retry si rate-limit/timeout,
+      - retries du SDK seulement (pas de sleep/retry dans le worker),
+      - échec immédiat si le disjoncteur OpenAI est ouvert,
       - fallback poli en cas d'échec.
     """
-    last_err = None
-    for attempt in range(2):
-        try:
-            return generate_reply(user_text, profile_or_path)
-        except Exception as e:
-            last_err = e
-            msg = str(e)
-            if attempt == 0 and any(x in msg for x in ("429", "Rate limit", "timeout", "Timeout")):
-                _log("retry", where="openai", reason="rate_limit_or_timeout")
-                time.sleep(2)
-                continue
-            break
-    _log("error", where="openai", error=str(last_err))
+    try:
+        return generate_reply(user_text, profile_or_path)
+    except _resilience.Unavailable as e:
+        _log("degraded", where="openai", reason=str(e))
+    except Exception as e:
+        _log("error", where="openai", error=str(e))
+    return _fallback_reply(profile_or_path)
+
+def _fallback_reply(profile_or_path) -> str:
     profile = _ensure_profile(profile_or_path)
     name = profile.get("display_name", "Ami")
     return f"Désolé, je ne peux pas répondre pour le moment. — {name} 🤝"
@@ -165,35 +415,27 @@ def generate_reply_with_history(user_text: str, history, profile_or_path="profil
     history: liste [(direction, text, ts), ...] du plus ancien au plus récent
     """
     profile = _ensure_profile(profile_or_path)
-    system = build_system_prompt(profile)
-    messages = [{"role": "system", "content": system}]
-    hist = history[-16:] if history else []
-    for direction, txt, ts in hist:
-        role = "user" if direction == "IN" else "assistant"
-        messages.append({"role": role, "content": str(txt or "")})
-    messages.append({"role": "user", "content": user_text})
-
-    rsp = client().chat.completions.create(
-        model="gpt-4o-mini",
-        messages=messages,
-        temperature=0.7,
-    )
-    return enforce_style(rsp.choices[0].message.content, profile)
+    with _span("prompt_build"):
+        compiled = system_prompt(profile_or_path)
+        messages = [{"role": "system", "content": compiled.text}]
+        # historique borné par tokens (et non plus "16 derniers")
+        budget = _prompt.history_budget(compiled.tokens, user_text)
+        recent = list(history or [])[-_prompt.HISTORY_MAX_TURNS:]
+        hist = (_prompt.fit_newest(recent, budget, text_of=lambda h: str(h[1] or ""))[0] if budget > 0
+                else recent[-_prompt.LEGACY_HISTORY_TURNS:])
+        for direction, txt, ts in hist:
+            role = "user" if direction == "IN" else "assistant"
+            messages.append({"role": role, "content": str(txt or "")})
+        messages.append({"role": "user", "content": user_text})
+    route = _router.route(messages, profile=profile)
+    return _rcache.cached(route.model, messages, lambda: _complete(messages, 0.7, profile, route),
+                          profile=profile, temperature=0.7)
 
 def safe_generate_reply_with_history(user_text: str, history, profile_or_path="profile.json") -> str:
-    last_err = None
-    for attempt in range(2):
-        try:
-            return generate_reply_with_history(user_text, history, profile_or_path)
-        except Exception as e:
-            last_err = e
-            msg = str(e)
-            if attempt == 0 and any(x in msg for x in ("429", "Rate limit", "timeout", "Timeout")):
-                _log("retry", where="openai", reason="rate_limit_or_timeout")
-                time.sleep(2)
-                continue
-            break
-    _log("error", where="openai", error=str(last_err))
-    profile = _ensure_profile(profile_or_path)
-    name = profile.get("display_name", "Ami")
-    return f"Désolé, je ne peux pas répondre pour le moment. — {name} 🤝"
+    try:
+        return generate_reply_with_history(user_text, history, profile_or_path)
+    except _resilience.Unavailable as e:
+        _log("degraded", where="openai", reason=str(e))
+    except Exception as e:
+        _log("error", where="openai", error=str(e))
+    return _fallback_reply(profile_or_path)
@@ -1,45 +1,615 @@
 # core/memory.py
-import os, sqlite3, threading
+import os, re, sqlite3, threading, time, atexit, unicodedata
+from contextlib import contextmanager
+from .history_cache import cache as _cache
 
 DB_PATH = os.getenv("DB_PATH", "local.db")
-_lock = threading.Lock()
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE") or os.getenv("WEBHOOK_WORKERS", "4")) + 1
+BUSY_TIMEOUT_S = float(os.getenv("DB_BUSY_TIMEOUT", "10"))
 
-def _get_conn():
-    conn = sqlite3.connect(DB_PATH, timeout=10, check_same_thread=False)
+# Modèle de concurrence (WAL) :
+# - lectures : connexions du pool, en parallèle, jamais bloquées par l'écrivain ;
+# - écritures : une seule connexion "writer" par process, sérialisée par _write_lock,
+#   transactions BEGIN IMMEDIATE (verrou pris d'emblée, busy_timeout entre process
+#   gunicorn au lieu d'un SQLITE_BUSY en cours de transaction).
+_write_lock = threading.Lock()
+
+def _open_conn(path: str, readonly: bool = True):
+    # PRAGMAs appliqués une seule fois par connexion ; le cache de requêtes
+    # préparées du module sqlite3 est conservé tant que la connexion vit.
+    # isolation_level=None : transactions explicites (BEGIN IMMEDIATE côté writer).
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_S, check_same_thread=False,
+                           cached_statements=64, isolation_level=None)
+    # Nouvelle DB : pages libérées rendables par core.retention (PRAGMA incremental_vacuum).
+    # Sans effet sur une DB existante ; doit précéder le passage en WAL.
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
     conn.execute("PRAGMA journal_mode=WAL;")
     conn.execute("PRAGMA synchronous=NORMAL;")
+    if readonly:
+        conn.execute("PRAGMA query_only=ON;")
     return conn
 
+class _Pool:
+    """Petit pool borné de connexions persistantes (une par worker + 1)."""
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = max(1, size)
+        self.pid = os.getpid()
+        self._idle = []
+        self._created = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while not self._idle and self._created >= self.size:
+                self._cond.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._created += 1
+        try:
+            return _open_conn(self.path)
+        except Exception:
+            with self._cond:
+                self._created -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn):
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            for c in self._idle:
+                try:
+                    c.close()
+                except Exception:
+                    pass
+            self._created -= len(self._idle)
+            self._idle = []
+
+_pool = None
+_pool_lock = threading.Lock()
+_writer = None  # (pid, path, conn)
+
+def _get_pool() -> _Pool:
+    global _pool
+    p = _pool
+    # Après un fork (gunicorn) ou un changement de DB_PATH : nouveau pool.
+    # Les connexions héritées du parent ne sont jamais réutilisées.
+    if p is None or p.pid != os.getpid() or p.path != DB_PATH:
+        with _pool_lock:
+            p = _pool
+            if p is None or p.pid != os.getpid() or p.path != DB_PATH:
+                p = _pool = _Pool(DB_PATH, POOL_SIZE)
+    return p
+
+def warm_pool() -> int:
+    """Ouvre toutes les connexions du pool (et celle d'écriture) d'avance ; nb ouvertes."""
+    pool = _get_pool()
+    conns = [pool.acquire() for _ in range(pool.size)]
+    try:
+        for c in conns:
+            c.execute("SELECT id FROM messages ORDER BY id DESC LIMIT 1").fetchall()  # schéma + pages chaudes
+    finally:
+        for c in conns:
+            pool.release(c)
+    with _write_lock:
+        _writer_conn()
+    return len(conns) + 1
+
+@contextmanager
+def _get_conn():
+    """Connexion de lecture (pool), sans verrou global."""
+    pool = _get_pool()
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+def _writer_conn():
+    # Appelant : _write_lock tenu
+    global _writer
+    w = _writer
+    if w is None or w[0] != os.getpid() or w[1] != DB_PATH:
+        w = _writer = (os.getpid(), DB_PATH, _open_conn(DB_PATH, readonly=False))
+    return w[2]
+
+@contextmanager
+def _write_conn():
+    """Connexion d'écriture unique du process, une transaction IMMEDIATE à la fois."""
+    with _write_lock:
+        conn = _writer_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        _absorb_own_commit(conn)
+
+# Accès partagés pour les autres modules core (jobs, outbox, retention, scheduler...)
+read_conn = _get_conn   # lecture (pool), sans verrou
+write_tx = _write_conn  # transaction IMMEDIATE sur la connexion writer
+
+@contextmanager
+def writer_raw():
+    """Connexion writer hors transaction (VACUUM, wal_checkpoint)."""
+    with _write_lock:
+        yield _writer_conn()
+
+def invalidate_cached_history(user_id: str = None):
+    _cache.invalidate(user_id)
+
+# ---------- Version de la DB (cache d'historique) ----------
+# PRAGMA data_version lu sur une connexion de lecture dédiée, sans _write_lock :
+# il bouge à chaque commit d'une AUTRE connexion, y compris notre writer. Nos
+# propres commits sont "absorbés" juste après le COMMIT (le cache les a déjà via
+# add_message) ; seuls les commits d'autres process font avancer _version["gen"].
+# Un commit étranger antérieur au nôtre est repéré par le data_version du writer
+# (qui ne bouge que pour les autres connexions) ; un commit étranger tombé entre
+# notre COMMIT et l'absorption passe inaperçu : fenêtre de quelques µs, couverte
+# par le TTL du cache.
+# Lecture de la version au plus toutes les HISTORY_VERSION_POLL_MS ms (et sans
+# attendre un autre thread déjà en train de la lire) : pas de point de passage
+# unique sur le chemin de lecture. Écriture d'un autre worker gunicorn visible au
+# plus tard après ce délai.
+VERSION_POLL_S = float(os.getenv("HISTORY_VERSION_POLL_MS", "50")) / 1000
+_version_lock = threading.Lock()
+_version = {"pid": None, "db": None, "conn": None, "seen": None, "gen": 0, "polled": 0.0, "wdv": None}
+
+def _poll_version(absorb: bool = False) -> int:
+    # Appelant : _version_lock tenu
+    v = _version
+    if v["pid"] != os.getpid() or v["db"] != DB_PATH:
+        v.update(pid=os.getpid(), db=DB_PATH, conn=_open_conn(DB_PATH), seen=None, wdv=None, gen=v["gen"] + 1)
+    dv = v["conn"].execute("PRAGMA data_version").fetchone()[0]
+    v["polled"] = time.monotonic()
+    if dv != v["seen"]:
+        if v["seen"] is not None and not absorb:
+            v["gen"] += 1
+        v["seen"] = dv
+    return v["gen"]
+
+def _absorb_own_commit(conn):
+    # Appelant : _write_lock tenu, juste après COMMIT sur le writer `conn`
+    try:
+        wdv = conn.execute("PRAGMA data_version").fetchone()[0]
+        with _version_lock:
+            _poll_version(absorb=True)
+            if _version["wdv"] is not None and wdv != _version["wdv"]:
+                _version["gen"] += 1  # un autre process a commité avant nous
+            _version["wdv"] = wdv
+    except sqlite3.Error:
+        pass
+
+def close_pool():
+    """Ferme les connexions inactives (arrêt propre, tests)."""
+    global _writer
+    flush()
+    if _pool is not None and _pool.pid == os.getpid():
+        _pool.close()
+    with _write_lock:
+        if _writer is not None and _writer[0] == os.getpid():
+            _writer[2].close()
+        _writer = None
+    with _version_lock:
+        if _version["pid"] == os.getpid() and _version["conn"] is not None:
+            _version["conn"].close()
+        _version.update(pid=None, conn=None)
+
+# ---------- Write-behind (group commit) ----------
+# add_message empile la ligne ; un thread "flusher" unique par process les
+# insère par lots dans UNE transaction toutes les GROUP_COMMIT_MS ms ou dès
+# GROUP_COMMIT_ROWS lignes. GROUP_COMMIT_MS=0 → insertion synchrone (ancien mode).
+# Lecture de ses propres écritures : get_history fusionne les lignes encore en
+# tampon ; _gen (seqlock, impair pendant un COMMIT) évite doublons et trous.
+GROUP_COMMIT_MS = float(os.getenv("DB_GROUP_COMMIT_MS", "5"))
+GROUP_COMMIT_ROWS = int(os.getenv("DB_GROUP_COMMIT_ROWS", "64"))
+# OR IGNORE : un msg_sid déjà enregistré (index unique) n'est pas réinséré
+_INSERT_SQL = "INSERT OR IGNORE INTO messages (user_id, direction, text, msg_sid) VALUES (?,?,?,?)"
+
+_buf_cond = threading.Condition()
+_flush_lock = threading.Lock()
+_pending = []   # [(user_id, direction, text, msg_sid)] pas encore pris par le flusher
+_inflight = []  # lot en cours d'écriture (pas encore commité)
+_gen = 0
+_flusher = None  # (pid, thread)
+
+def _buffering() -> bool:
+    return GROUP_COMMIT_MS > 0
+
+def _flush_once() -> int:
+    """Écrit tout le tampon courant en une transaction. Renvoie le nb de lignes."""
+    global _gen
+    with _flush_lock:
+        with _buf_cond:
+            batch = list(_pending)
+            del _pending[:]
+            _inflight[:] = batch
+        if not batch:
+            return 0
+        committed = False
+        try:
+            with _write_lock:
+                conn = _writer_conn()
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    conn.executemany(_INSERT_SQL, batch)
+                    with _buf_cond:
+                        _gen += 1
+                    conn.execute("COMMIT")
+                    committed = True
+                    _absorb_own_commit(conn)
+                except BaseException:
+                    if conn.in_transaction:
+                        conn.execute("ROLLBACK")
+                    raise
+        finally:
+            with _buf_cond:
+                if not committed:
+                    # on remet le lot en tête, l'ordre d'arrivée est conservé
+                    _pending[:0] = batch
+                del _inflight[:]
+                if _gen % 2:
+                    _gen += 1
+                _buf_cond.notify_all()
+        return len(batch)
+
+def _flush_loop():
+    while True:
+        with _buf_cond:
+            while not _pending:
+                _buf_cond.wait()
+            if len(_pending) < GROUP_COMMIT_ROWS:
+                _buf_cond.wait(GROUP_COMMIT_MS / 1000.0)
+        try:
+            _flush_once()
+        except Exception as e:
+            print(f"[MEM][flush-err] {e}", flush=True)
+            time.sleep(0.5)
+
+def _ensure_flusher():
+    global _flusher
+    f = _flusher
+    if f is None or f[0] != os.getpid() or not f[1].is_alive():
+        with _buf_cond:
+            f = _flusher
+            if f is None or f[0] != os.getpid() or not f[1].is_alive():
+                t = threading.Thread(target=_flush_loop, name="memory-flusher", daemon=True)
+                t.start()
+                _flusher = (os.getpid(), t)
+
+def flush() -> int:
+    """Vide le tampon write-behind de façon synchrone (arrêt, clear_history, tests)."""
+    n = 0
+    while True:
+        with _buf_cond:
+            if not _pending and not _inflight:
+                return n
+        n += _flush_once()
+
+def _reset_after_fork():
+    # Le fils ne rejoue jamais le tampon du parent, et ne réutilise ni ses
+    # verrous (peut-être tenus au moment du fork) ni ses connexions.
+    global _buf_cond, _flush_lock, _write_lock, _version_lock, _pending, _inflight, _gen, _flusher, _writer, _pool
+    _buf_cond = threading.Condition()
+    _flush_lock = threading.Lock()
+    _write_lock = threading.Lock()
+    _version_lock = threading.Lock()
+    _pending, _inflight, _gen = [], [], 0
+    _flusher = _writer = _pool = None
+    _cache.reset()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+atexit.register(flush)
+
+# ---------- API ----------
 def bootstrap_memory():
-    with _get_conn() as c, _lock:
+    with _write_conn() as c:
         c.execute("""
         CREATE TABLE IF NOT EXISTS messages (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id   TEXT NOT NULL,
             ts        TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             direction TEXT CHECK(direction IN ('IN','OUT')) NOT NULL,
-            text      TEXT NOT NULL
+            text      TEXT NOT NULL,
+            msg_sid   TEXT
         )""")
+        cols = {r[1] for r in c.execute("PRAGMA table_info(messages)")}
+        if "msg_sid" not in cols:  # DB créée avant l'idempotence
+            c.execute("ALTER TABLE messages ADD COLUMN msg_sid TEXT")
+        if "delivery" not in cols:  # OUT : 'sent' | 'failed' (core.outbox), msg_sid = SID Twilio
+            c.execute("ALTER TABLE messages ADD COLUMN delivery TEXT")
         c.execute("CREATE INDEX IF NOT EXISTS idx_messages_user_ts ON messages(user_id, ts)")
+        # historique "ORDER BY id DESC" et comptages "id > ?" par utilisateur sans tri
+        c.execute("CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages(user_id, id)")
+        c.execute("""CREATE UNIQUE INDEX IF NOT EXISTS ux_messages_sid_dir
+                     ON messages(msg_sid, direction) WHERE msg_sid IS NOT NULL""")
+        # Résumé glissant par utilisateur (core.summary) : couvre messages.id <= upto_id
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS summaries (
+            user_id    TEXT PRIMARY KEY,
+            summary    TEXT NOT NULL,
+            upto_id    INTEGER NOT NULL,
+            turns      INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""")
+        _bootstrap_fts(c)
     return True
 
-def add_message(user_id: str, direction: str, text: str):
-    with _get_conn() as c, _lock:
-        c.execute("INSERT INTO messages (user_id, direction, text) VALUES (?,?,?)",
-                  (user_id, direction, text))
+# ---------- Rappel long terme (FTS5) ----------
+# Index plein texte "external content" sur messages(user_id, text), tenu à jour
+# par triggers (insert/delete/update) : rien à faire côté add_message, et les
+# lots du group commit l'alimentent dans la même transaction. Le filtre
+# utilisateur passe par la colonne indexée user_id (intersection de doclists),
+# pas par un filtre SQL après coup sur tous les documents qui matchent.
+FTS_ENABLED = os.getenv("DB_FTS", "1") != "0"
+_fts_ok = False
+
+def _bootstrap_fts(c):
+    global _fts_ok
+    if not FTS_ENABLED:
+        return
+    exists = c.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='messages_fts'"
+    ).fetchone()
+    try:
+        c.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            user_id, text, content='messages', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )""")
+    except sqlite3.OperationalError as e:  # SQLite compilé sans FTS5
+        print(f"[MEM][fts] indisponible: {e}", flush=True)
+        return
+    c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts_vocab USING fts5vocab(messages_fts, 'row')")
+    c.execute("""CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, user_id, text) VALUES (new.id, new.user_id, new.text);
+    END""")
+    c.execute("""CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, user_id, text)
+        VALUES ('delete', old.id, old.user_id, old.text);
+    END""")
+    c.execute("""CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF user_id, text ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, user_id, text)
+        VALUES ('delete', old.id, old.user_id, old.text);
+        INSERT INTO messages_fts(rowid, user_id, text) VALUES (new.id, new.user_id, new.text);
+    END""")
+    if not exists and c.execute("SELECT 1 FROM messages LIMIT 1").fetchone():
+        # DB antérieure à l'index : indexation initiale (une seule fois)
+        c.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+    _fts_ok = True
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_STOPWORDS = frozenset("""
+    les des une est pas pour que qui dans sur avec mais par plus tout tous toute
+    cette ces son ses mes tes nos vos leur leurs elle ils elles nous vous moi toi
+    lui suis es sommes etes sont ont avais avait etait fait faire peux peut dois
+    comme quand alors donc aussi tres bien encore deja ici car ainsi
+    the and for are you your with this that have was what not but from can
+    bonjour salut merci oui non ok
+""".split())
+
+def _words(text: str):
+    plain = "".join(ch for ch in unicodedata.normalize("NFKD", text.lower())
+                    if not unicodedata.combining(ch))
+    return _WORD_RE.findall(plain)
+
+# Fréquence documentaire des termes (fts5vocab) : les termes présents dans trop
+# de messages coûtent cher à scorer et ne discriminent rien → écartés. Les df
+# élevées (coûteuses à recompter, stables) sont gardées en cache FTS_DF_TTL s.
+FTS_MAX_DF = float(os.getenv("FTS_MAX_DF", "0.02"))  # part max des messages
+FTS_DF_FLOOR = int(os.getenv("FTS_DF_FLOOR", "1000"))  # en dessous : toujours gardé
+FTS_DF_TTL = float(os.getenv("FTS_DF_TTL", "3600"))
+_df_cache = {}  # terme -> (df, ts)
+
+def _term_df(c, term: str) -> int:
+    now = time.monotonic()
+    hit = _df_cache.get(term)
+    if hit is not None and now - hit[1] < FTS_DF_TTL:
+        return hit[0]
+    row = c.execute("SELECT doc FROM messages_fts_vocab WHERE term=?", (term,)).fetchone()
+    df = row[0] if row else 0
+    if df > 0:  # un terme absent peut apparaître à tout moment : pas de cache
+        if len(_df_cache) >= 50000:
+            _df_cache.clear()
+        _df_cache[term] = (df, now)
+    return df
+
+def _fts_query(c, user_id: str, text: str, max_terms: int) -> str:
+    """Requête MATCH : utilisateur ET (un des termes les plus rares du texte)."""
+    user = max(_words(user_id), key=len, default="")
+    if not user:
+        return ""
+    total = c.execute("SELECT MAX(id) FROM messages").fetchone()[0] or 0
+    max_df = max(FTS_DF_FLOOR, FTS_MAX_DF * total)
+    terms = {}
+    for w in _words(text):
+        if len(w) >= 3 and w not in _STOPWORDS and not w.isdigit() and w not in terms:
+            df = _term_df(c, w)
+            if 0 < df <= max_df:
+                terms[w] = df
+    if not terms:
+        return ""
+    ranked = sorted(terms, key=terms.get)[:max_terms]
+    # côté utilisateur, seul le jeton le plus distinctif ("33612345678" pour
+    # "whatsapp:+33612345678") : le préfixe de canal est dans tous les documents
+    # et rendrait la requête proportionnelle à la taille de la table. L'égalité
+    # exacte sur m.user_id est vérifiée ensuite en SQL.
+    return f'user_id:"{user}" AND text:(' + " OR ".join(f'"{t}"' for t in ranked) + ")"
+
+def search_history(user_id: str, text: str, k: int = 5, max_terms: int = 8):
+    """Top-k messages passés de l'utilisateur les plus proches de `text` (bm25),
+    [{"id", "direction", "text"}] du plus pertinent au moins pertinent.
+    Les lignes encore en tampon write-behind ne sont pas indexées (secondes)."""
+    if not _fts_ok or k <= 0 or not text:
+        return []
+    with _get_conn() as c:
+        q = _fts_query(c, user_id, text, max_terms)
+        if not q:
+            return []
+        rows = c.execute(
+            "SELECT m.id, m.direction, m.text FROM messages_fts f JOIN messages m ON m.id = f.rowid "
+            "WHERE messages_fts MATCH ? AND m.user_id = ? "
+            "ORDER BY bm25(messages_fts, 0.0, 1.0) LIMIT ?",
+            (q, user_id, k),
+        ).fetchall()
+    return [{"id": i, "direction": d, "text": t} for (i, d, t) in rows]
+
+def add_message(user_id: str, direction: str, text: str, msg_sid: str = None):
+    if not _buffering():
+        _cache.touch(user_id)
+        try:
+            with _write_conn() as c:
+                c.execute(_INSERT_SQL, (user_id, direction, text, msg_sid))
+        except Exception:
+            _cache.invalidate(user_id)
+            raise
+        _cache.append(user_id, direction, text)
+        return True
+    _ensure_flusher()
+    with _buf_cond:
+        _pending.append((user_id, direction, text, msg_sid))
+        _cache.append(user_id, direction, text)
+        n = len(_pending)
+        if n >= GROUP_COMMIT_ROWS:
+            _buf_cond.notify_all()
+    if n >= GROUP_COMMIT_ROWS * 8:
+        # DB en retard : contre-pression, l'appelant vide lui-même
+        flush()
     return True
 
-def get_history(user_id: str, limit: int = 20):
-    with _get_conn() as c, _lock:
+def _db_history(user_id: str, limit: int):
+    with _get_conn() as c:
         cur = c.execute(
             "SELECT direction, text FROM messages WHERE user_id=? ORDER BY id DESC LIMIT ?",
             (user_id, limit)
         )
         rows = cur.fetchall()
     rows.reverse()
+    return rows
+
+def _data_version():
+    """Change quand un AUTRE process a commité dans la DB (nos commits sont absorbés),
+    au plus VERSION_POLL_S plus tard."""
+    v = _version
+    fresh = v["pid"] == os.getpid() and v["db"] == DB_PATH
+    if fresh and time.monotonic() - v["polled"] < VERSION_POLL_S:
+        return v["gen"]
+    if not _version_lock.acquire(blocking=not fresh):
+        return v["gen"]  # un autre thread la relit déjà
+    try:
+        return _poll_version()
+    finally:
+        _version_lock.release()
+
+def get_history(user_id: str, limit: int = 20):
+    if not _cache.enabled:
+        return [{"direction": d, "text": t} for (d, t) in _read_history(user_id, limit)]
+    version = _data_version()  # lue AVANT SQLite : un commit concurrent rend l'entrée périmée
+    rows = _cache.get(user_id, limit, version)
+    if rows is None:
+        token = _cache.begin_fill(user_id)
+        fetched = max(limit, _cache.turns)
+        rows = _read_history(user_id, fetched)
+        _cache.fill(user_id, token, rows, fetched, version)
+        rows = rows[-limit:] if limit > 0 else []
     return [{"direction": d, "text": t} for (d, t) in rows]
 
+def iter_history(user_id: str, page: int = 8, max_rows: int = 200):
+    """Historique du plus récent au plus ancien, lu par pages croissantes
+    (8, 16, 32, ... : les premières servies par le cache) jusqu'à max_rows."""
+    seen, limit = 0, max(1, page)
+    while seen < max_rows:
+        limit = min(limit, max_rows)
+        rows = get_history(user_id, limit)
+        for r in reversed(rows[:len(rows) - seen]):
+            yield r
+        seen = len(rows)
+        if len(rows) < limit:
+            return
+        limit *= 2
+
+def history_cache_stats() -> dict:
+    return _cache.stats()
+
+def _read_history(user_id: str, limit: int):
+    if not _buffering():
+        rows = _db_history(user_id, limit)
+    else:
+        while True:
+            g1 = _gen
+            if g1 % 2:
+                time.sleep(0)
+                continue
+            with _buf_cond:
+                buffered = [(d, t) for (u, d, t, _sid) in _inflight + _pending if u == user_id]
+            rows = _db_history(user_id, limit)
+            if _gen == g1:
+                break
+        rows = (rows + buffered)[-limit:] if limit > 0 else []
+    return rows
+
+def incoming_state(msg_sid: str):
+    """None (inconnu), "received" (IN enregistré) ou "answered" (une réponse OUT a suivi).
+    Lecture DB seule : le tampon write-behind est couvert par core.dedup en process."""
+    if not msg_sid:
+        return None
+    with _get_conn() as c:
+        row = c.execute(
+            "SELECT EXISTS(SELECT 1 FROM messages o WHERE o.user_id=i.user_id "
+            "AND o.direction='OUT' AND o.id > i.id) "
+            "FROM messages i WHERE i.msg_sid=? AND i.direction='IN'", (msg_sid,)
+        ).fetchone()
+    if row is None:
+        return None
+    return "answered" if row[0] else "received"
+
+def get_summary(user_id: str):
+    """(summary, upto_id, turns) ou None."""
+    with _get_conn() as c:
+        return c.execute("SELECT summary, upto_id, turns FROM summaries WHERE user_id=?",
+                         (user_id,)).fetchone()
+
+def save_summary(user_id: str, summary: str, upto_id: int, turns: int):
+    with _write_conn() as c:
+        c.execute(
+            "INSERT INTO summaries (user_id, summary, upto_id, turns, updated_at) "
+            "VALUES (?,?,?,?,CURRENT_TIMESTAMP) ON CONFLICT(user_id) DO UPDATE SET "
+            "summary=excluded.summary, upto_id=excluded.upto_id, turns=excluded.turns, "
+            "updated_at=excluded.updated_at",
+            (user_id, summary, upto_id, turns),
+        )
+
+def count_after(user_id: str, after_id: int) -> int:
+    """Nb de messages de l'utilisateur avec id > after_id (tampon write-behind inclus)."""
+    with _buf_cond:
+        buffered = sum(1 for r in _inflight + _pending if r[0] == user_id)
+    with _get_conn() as c:
+        n = c.execute("SELECT COUNT(*) FROM messages WHERE user_id=? AND id > ?",
+                      (user_id, after_id)).fetchone()[0]
+    return n + buffered
+
+def messages_after(user_id: str, after_id: int, limit: int):
+    """[(id, direction, text)] de l'utilisateur avec id > after_id, du plus ancien
+    au plus récent (tampon write-behind vidé d'abord pour avoir des id)."""
+    flush()
+    with _get_conn() as c:
+        return c.execute(
+            "SELECT id, direction, text FROM messages WHERE user_id=? AND id > ? ORDER BY id LIMIT ?",
+            (user_id, after_id, limit),
+        ).fetchall()
+
 def clear_history(user_id: str):
-    with _get_conn() as c, _lock:
+    flush()
+    with _write_conn() as c:
         c.execute("DELETE FROM messages WHERE user_id=?", (user_id,))
+        c.execute("DELETE FROM summaries WHERE user_id=?", (user_id,))
+    _cache.invalidate(user_id)
     return True
@@ -0,0 +1,304 @@
+# core/outbox.py — étage d'envoi sortant (WhatsApp via Twilio), durable
+# - enqueue() écrit le message dans la table `outbox` (même DB que core.memory)
+#   et rend la main : le worker qui a appelé le LLM est libéré tout de suite ;
+# - un thread "dispatcher" par process réclame les messages par lots (une
+#   transaction) et les confie à OUTBOX_CONCURRENCY threads d'envoi (session
+#   HTTP keep-alive partagée, côté app) ; les résultats sont écrits par lots ;
+# - ordre par destinataire : seul le plus ancien message en attente d'un numéro
+#   est éligible (aussi entre workers gunicorn) ; OUTBOX_PER_TO_INTERVAL s
+#   minimum entre deux messages au même numéro ;
+# - débit du numéro expéditeur borné (OUTBOX_MPS messages/s) pour TOUS les
+#   process : GCRA dans la table `outbox_rate`, mis à jour dans la transaction
+#   de réclamation ; 429 → pause courte, elle aussi partagée ;
+# - 429/5xx/réseau → nouvel essai avec backoff exponentiel ; disjoncteur ouvert
+#   ou limite de concurrence (Unavailable) → simple report, pas un essai ;
+#   abandon ('dead') quand le message a plus de OUTBOX_MAX_AGE s, ou tout de
+#   suite pour un autre 4xx (numéro invalide...) ;
+# - résultat reporté sur la ligne OUT de l'historique : msg_sid = SID Twilio,
+#   delivery = 'sent' | 'failed'.
+# Livraison "au moins une fois" : un process tué pendant un envoi → renvoi à
+# l'expiration du bail (OUTBOX_LEASE).
+import os, time, random, socket, threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from . import memory as _memory
+from infra.monitoring import log_json as _log, observe as _observe
+from infra.resilience import Unavailable as _Unavailable
+
+ENABLED = os.getenv("OUTBOX", "1") != "0"
+CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "8"))
+MPS = float(os.getenv("OUTBOX_MPS", "20"))
+PER_TO_INTERVAL_S = float(os.getenv("OUTBOX_PER_TO_INTERVAL", "1"))
+MAX_AGE_S = float(os.getenv("OUTBOX_MAX_AGE", "1800"))  # abandon d'un message encore en échec après N s
+UNAVAILABLE_DELAY_S = float(os.getenv("OUTBOX_UNAVAILABLE_DELAY", "5"))  # disjoncteur ouvert
+LIMIT_DELAY_S = 0.3  # limite de concurrence adaptative atteinte : place libérée sous peu
+BACKOFF_BASE_S = float(os.getenv("OUTBOX_BACKOFF_BASE", "1"))
+BACKOFF_MAX_S = float(os.getenv("OUTBOX_BACKOFF_MAX", "120"))
+LEASE_S = float(os.getenv("OUTBOX_LEASE", "60"))
+KEEP_SENT_S = float(os.getenv("OUTBOX_KEEP_SENT", "3600"))
+POLL_S = float(os.getenv("OUTBOX_POLL", "0.5"))
+
+_sender = None  # fn(to, body) -> sid ; lève une exception en cas d'échec
+_lock = threading.Lock()
+_wake = threading.Event()
+_results = []      # [(item, issue, sid|erreur, ms)] à écrire au prochain tour
+_state = {"pid": None, "thread": None, "executor": None, "inflight": 0}
+_stats = {"sent": 0, "retried": 0, "deferred": 0, "dead": 0, "throttled": 0}
+_STAT_KEY = {"sent": "sent", "retry": "retried", "wait": "deferred", "dead": "dead"}
+_completions = 0
+
+def set_sender(fn: Callable[[str, str], Optional[str]]):
+    global _sender
+    _sender = fn
+
+def bootstrap() -> int:
+    """Crée la table et remet en file les envois dont le bail a expiré."""
+    now = time.time()
+    with _memory.write_tx() as c:
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            to_addr     TEXT NOT NULL,
+            body        TEXT NOT NULL,
+            user_id     TEXT,
+            ref_text    TEXT,
+            state       TEXT NOT NULL DEFAULT 'queued'
+                        CHECK(state IN ('queued','sending','sent','dead')),
+            attempts    INTEGER NOT NULL DEFAULT 0,
+            run_at      REAL NOT NULL,
+            lease_until REAL,
+            owner       TEXT,
+            tw_sid      TEXT,
+            last_error  TEXT,
+            t0          REAL,
+            created_at  REAL NOT NULL,
+            updated_at  REAL NOT NULL
+        )""")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_state_run ON outbox(state, run_at)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_to ON outbox(to_addr, id)")
+        # débit partagé entre process : tat = "theoretical arrival time" (GCRA), pause 429
+        c.execute("CREATE TABLE IF NOT EXISTS outbox_rate (id INTEGER PRIMARY KEY CHECK (id = 1), "
+                  "tat REAL NOT NULL DEFAULT 0, pause_until REAL NOT NULL DEFAULT 0)")
+        c.execute("INSERT OR IGNORE INTO outbox_rate (id) VALUES (1)")
+        n = c.execute("UPDATE outbox SET state='queued', owner=NULL, lease_until=NULL, updated_at=? "
+                      "WHERE state='sending' AND lease_until < ?", (now, now)).rowcount
+    if n:
+        print(f"[OUTBOX] {n} envoi(s) repris après bail expiré", flush=True)
+    return n
+
+def enqueue(to: str, body: str, user_id: Optional[str] = None, ref_text: Optional[str] = None,
+            t0: Optional[float] = None) -> int:
+    """Met un message en file d'envoi. ref_text : texte de la ligne OUT à compléter
+    (SID, statut) une fois envoyé ; t0 : début de l'échange (ttfm_ms)."""
+    now = time.time()
+    with _memory.write_tx() as c:
+        item_id = c.execute(
+            "INSERT INTO outbox (to_addr, body, user_id, ref_text, run_at, t0, created_at, updated_at) "
+            "VALUES (?,?,?,?,?,?,?,?)", (to, body, user_id, ref_text, now, t0, now, now),
+        ).lastrowid
+    start()
+    _wake.set()
+    return item_id
+
+# ---------- Dispatcher ----------
+def _owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def _has_work(now: float) -> bool:
+    # lecture seule (pool) avant de prendre le verrou d'écriture : rien à faire → pas de BEGIN IMMEDIATE
+    with _memory.read_conn() as c:
+        return c.execute(
+            "SELECT 1 FROM outbox WHERE (state='queued' AND run_at <= ?) "
+            "OR (state='sending' AND lease_until < ?) LIMIT 1", (now, now),
+        ).fetchone() is not None
+
+def _claim(n: int) -> List[tuple]:
+    now = time.time()
+    if not _has_work(now):
+        return []
+    with _memory.write_tx() as c:
+        tat, pause_until = c.execute("SELECT tat, pause_until FROM outbox_rate WHERE id=1").fetchone()
+        if now < pause_until:
+            return []
+        if MPS > 0:
+            # GCRA, rafale d'une seconde : au plus MPS messages/s tous process confondus
+            tat = max(tat, now)
+            n = min(n, int((now + 1.0 - tat) * MPS))
+            if n <= 0:
+                return []
+        # tête de file de chaque destinataire : aucun message plus ancien en attente/en cours
+        ids = [r[0] for r in c.execute(
+            "SELECT o.id FROM outbox o WHERE ((o.state='queued' AND o.run_at <= ?) "
+            "OR (o.state='sending' AND o.lease_until < ?)) AND NOT EXISTS ("
+            "SELECT 1 FROM outbox p WHERE p.to_addr=o.to_addr AND p.id < o.id "
+            "AND p.state IN ('queued','sending')) ORDER BY o.id LIMIT ?", (now, now, n))]
+        if not ids:
+            return []
+        if MPS > 0:
+            c.execute("UPDATE outbox_rate SET tat=? WHERE id=1", (tat + len(ids) / MPS,))
+        return c.execute(
+            f"UPDATE outbox SET state='sending', owner=?, lease_until=?, attempts=attempts+1, updated_at=? "
+            f"WHERE id IN ({','.join('?' * len(ids))}) "
+            f"RETURNING id, to_addr, body, user_id, ref_text, attempts, t0, created_at",
+            [_owner(), now + LEASE_S, now] + ids,
+        ).fetchall()
+
+def _outcome(e: BaseException) -> str:
+    # refusé sans tentative (disjoncteur, limite) : report ; 429, 5xx, réseau : réessayer ;
+    # autre 4xx : définitif
+    if isinstance(e, _Unavailable):
+        return "wait"
+    status = getattr(e, "status", None)
+    return "dead" if isinstance(status, int) and 400 <= status < 500 and status != 429 else "retry"
+
+def _send_one(item: tuple):
+    item_id, to, body, user_id, ref_text, attempts, t0, created_at = item
+    if attempts == 1:
+        _observe("stage_ms", (time.time() - created_at) * 1000, stage="outbox_wait")
+    t1 = time.perf_counter()
+    try:
+        sid = _sender(to, body) if _sender is not None else None
+        res = (item, "sent", sid)
+    except Exception as e:
+        res = (item, _outcome(e), e)
+    ms = (time.perf_counter() - t1) * 1000
+    with _lock:
+        _results.append(res + (ms,))
+        _state["inflight"] -= 1
+    _wake.set()
+
+def _write_results(batch) -> float:
+    """Une transaction pour le lot : états outbox + lignes OUT + pause 429 partagée ; renvoie la pause (s)."""
+    global _completions
+    now = time.time()
+    if any(it[4] for (it, *_x) in batch):
+        _memory.flush()  # lignes OUT encore dans le tampon write-behind
+    pause = 0.0
+    with _memory.write_tx() as c:
+        for (item, outcome, val, ms) in batch:
+            item_id, to, body, user_id, ref_text, attempts, t0 = item[:7]
+            if outcome == "sent":
+                c.execute("UPDATE outbox SET state='sent', tw_sid=?, owner=NULL, lease_until=NULL, "
+                          "last_error=NULL, updated_at=? WHERE id=?", (val, now, item_id))
+                if PER_TO_INTERVAL_S > 0:
+                    c.execute("UPDATE outbox SET run_at=MAX(run_at, ?) WHERE to_addr=? AND state='queued'",
+                              (now + PER_TO_INTERVAL_S, to))
+            elif outcome == "retry":
+                delay = min(BACKOFF_MAX_S, BACKOFF_BASE_S * (2 ** (attempts - 1))) * random.uniform(0.8, 1.2)
+                if getattr(val, "status", None) == 429:
+                    pause = max(pause, min(delay, 5.0))  # débit du compte dépassé : tout le monde attend
+                c.execute("UPDATE outbox SET state='queued', owner=NULL, lease_until=NULL, run_at=?, "
+                          "last_error=?, updated_at=? WHERE id=?",
+                          (now + delay, (str(val) or val.__class__.__name__)[:500], now, item_id))
+            elif outcome == "wait":
+                # pas un essai : Twilio n'a pas été appelé
+                delay = UNAVAILABLE_DELAY_S if getattr(val, "breaker", False) else LIMIT_DELAY_S
+                c.execute("UPDATE outbox SET state='queued', owner=NULL, lease_until=NULL, run_at=?, "
+                          "attempts=attempts-1, last_error=?, updated_at=? WHERE id=?",
+                          (now + delay * random.uniform(0.8, 1.2), str(val)[:500], now, item_id))
+            else:
+                c.execute("UPDATE outbox SET state='dead', owner=NULL, lease_until=NULL, last_error=?, "
+                          "updated_at=? WHERE id=?", ((str(val) or val.__class__.__name__)[:500], now, item_id))
+            if ref_text and outcome in ("sent", "dead"):
+                # ligne OUT de l'échange : la plus récente de ce texte pas encore complétée
+                c.execute(
+                    "UPDATE messages SET msg_sid=COALESCE(?, msg_sid), delivery=? WHERE id=("
+                    "SELECT id FROM messages WHERE user_id=? AND direction='OUT' AND text=? "
+                    "AND delivery IS NULL ORDER BY id DESC LIMIT 1)",
+                    (val if outcome == "sent" else None, "sent" if outcome == "sent" else "failed",
+                     user_id, ref_text),
+                )
+        if pause:
+            c.execute("UPDATE outbox_rate SET pause_until=MAX(pause_until, ?) WHERE id=1", (now + pause,))
+        _completions += len(batch)
+        if KEEP_SENT_S > 0 and _completions >= 500:
+            _completions = 0
+            c.execute("DELETE FROM outbox WHERE state='sent' AND updated_at < ?", (now - KEEP_SENT_S,))
+    return pause
+
+def _apply_results():
+    with _lock:
+        raw = _results[:]
+        del _results[:]
+    if not raw:
+        return
+    now = time.time()
+    # abandon au temps, pas au nombre d'essais : une panne Twilio de quelques minutes ne perd rien
+    batch = [(it, "dead" if o in ("retry", "wait") and MAX_AGE_S > 0 and now - it[7] >= MAX_AGE_S else o,
+              val, ms) for (it, o, val, ms) in raw]
+    try:
+        pause = _write_results(batch)
+    except Exception:
+        with _lock:
+            _results[:0] = raw  # réécrits au tour suivant (sinon renvoi à l'expiration du bail)
+        raise
+    with _lock:
+        for (_it, outcome, _v, _ms) in batch:
+            _stats[_STAT_KEY[outcome]] += 1
+        if pause:
+            _stats["throttled"] += 1
+    for (item, outcome, val, ms) in batch:
+        item_id, to, attempts, t0 = item[0], item[1], item[5], item[6]
+        if outcome == "sent":
+            if t0:
+                _observe("ttfm_ms", (now - t0) * 1000)
+            print(f"[OUTBOX] to={to} tw_sid={val} try={attempts} ms={int(ms)}", flush=True)
+        else:
+            print(f"[OUTBOX][{outcome}] id={item_id} to={to} try={attempts} {val}", flush=True)
+            if outcome == "dead":
+                _log("outbox_dead", id=item_id, to=to, attempts=attempts, age_s=round(now - item[7]),
+                     error=str(val)[:200])
+
+def _loop():
+    while True:
+        n, items = 0, []
+        try:
+            _apply_results()
+            with _lock:
+                n = CONCURRENCY - _state["inflight"]
+            items = _claim(n) if n > 0 else []
+            if items:
+                with _lock:
+                    _state["inflight"] += len(items)
+                for it in items:
+                    _state["executor"].submit(_send_one, it)
+        except Exception as e:
+            print(f"[OUTBOX][loop-err] {e}", flush=True)
+        if not items:
+            # rien d'éligible (ou débit atteint) : attendre un enqueue, un résultat, ou le prochain run_at
+            _wake.wait(POLL_S if MPS <= 0 else min(POLL_S, max(0.01, 1.0 / MPS)))
+            _wake.clear()
+
+def start():
+    """Démarre (une fois par process, y compris après fork) le dispatcher et ses threads."""
+    if _state["pid"] == os.getpid():
+        return
+    with _lock:
+        if _state["pid"] == os.getpid():
+            return
+        _results.clear()
+        _state.update(pid=os.getpid(), inflight=0,
+                      executor=ThreadPoolExecutor(max_workers=max(1, CONCURRENCY), thread_name_prefix="outbox"))
+        th = threading.Thread(target=_loop, name="outbox", daemon=True)
+        _state["thread"] = th
+    th.start()
+
+def stats() -> Dict:
+    now = time.time()
+    with _memory.read_conn() as c:
+        try:
+            rows = c.execute("SELECT state, COUNT(*), MIN(created_at) FROM outbox GROUP BY state").fetchall()
+        except Exception:
+            rows = []  # table pas encore créée
+    by_state = {s: (n, oldest) for (s, n, oldest) in rows}
+    queued, oldest = by_state.get("queued", (0, None))
+    with _lock:
+        local = dict(_stats, inflight=_state["inflight"] if _state["pid"] == os.getpid() else 0)
+    return {
+        "depth": queued,
+        "sending": by_state.get("sending", (0, None))[0],
+        "dead": by_state.get("dead", (0, None))[0],
+        "oldest_age_s": round(now - oldest, 1) if oldest else 0.0,
+        **local,
+    }
@@ -0,0 +1,162 @@
+# core/prompt.py — assemblage du prompt système, compilé une fois puis mis en cache
+# - fichiers (profil JSON, LLM_SYSTEM_PROMPT.txt) relus seulement si leur mtime change,
+#   et au plus un stat() toutes les PROMPT_RELOAD_CHECK secondes (pas d'I/O par requête) ;
+# - prompts compilés mémorisés par version des fichiers sources, avec leur nb de tokens.
+import os, re, json, math, threading, time
+from collections import OrderedDict, namedtuple
+
+CHECK_INTERVAL_S = float(os.getenv("PROMPT_RELOAD_CHECK", "2"))
+_COMPILED_MAX = 64
+
+Compiled = namedtuple("Compiled", "text tokens")
+
+_lock = threading.Lock()
+_versions = {}   # path -> (version, checked_at)
+_files = {}      # (path, kind) -> (version, value)
+_compiled = OrderedDict()
+
+def file_version(path: str):
+    """(mtime_ns, size) du fichier, ou None s'il n'existe pas. stat() throttlé."""
+    now = time.monotonic()
+    with _lock:
+        v = _versions.get(path)
+        if v is not None and now - v[1] < CHECK_INTERVAL_S:
+            return v[0]
+    try:
+        st = os.stat(path)
+        version = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        version = None
+    with _lock:
+        _versions[path] = (version, now)
+    return version
+
+def _cached_file(path: str, kind: str, loader, default):
+    version = file_version(path)
+    if version is None:
+        return default
+    with _lock:
+        hit = _files.get((path, kind))
+        if hit is not None and hit[0] == version:
+            return hit[1]
+    try:
+        value = loader(path)
+    except Exception as e:
+        print(f"[PROMPT][err] {path}: {e}", flush=True)
+        return hit[1] if hit is not None else default
+    with _lock:
+        _files[(path, kind)] = (version, value)
+    return value
+
+def _load_text(path: str) -> str:
+    with open(path, "r", encoding="utf-8") as f:
+        return (f.read() or "").strip()
+
+def _load_json(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def read_text(path: str, default: str = "") -> str:
+    txt = _cached_file(path, "text", _load_text, default)
+    return txt or default
+
+def read_json(path: str, default=None):
+    """Contenu JSON partagé entre appelants : ne pas le modifier en place."""
+    return _cached_file(path, "json", _load_json, default)
+
+def compile_prompt(key, builder) -> Compiled:
+    """Mémorise builder() sous `key` (qui doit inclure les versions des sources)."""
+    with _lock:
+        c = _compiled.get(key)
+        if c is not None:
+            _compiled.move_to_end(key)
+            return c
+    text = builder()
+    c = Compiled(text, estimate_tokens(text))
+    with _lock:
+        _compiled[key] = c
+        while len(_compiled) > _COMPILED_MAX:
+            _compiled.popitem(last=False)
+    return c
+
+def invalidate():
+    """Oublie tout (force une relecture au prochain appel)."""
+    with _lock:
+        _versions.clear()
+        _files.clear()
+        _compiled.clear()
+
+# ---------- Estimation locale du nombre de tokens ----------
+_enc = None
+_enc_tried = False
+_WORD_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+def _encoder():
+    # tiktoken si installé (optionnel), sinon heuristique
+    global _enc, _enc_tried
+    if not _enc_tried:
+        _enc_tried = True
+        try:
+            import tiktoken
+            _enc = tiktoken.get_encoding(os.getenv("PROMPT_TOKENIZER", "o200k_base"))
+        except Exception:
+            _enc = None
+    return _enc
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    enc = _encoder()
+    if enc is not None:
+        return len(enc.encode(text))
+    # ≈ 1 token par mot/ponctuation, ou 4 octets UTF-8 (accents, emoji) si plus
+    return max(len(_WORD_RE.findall(text)), math.ceil(len(text.encode("utf-8")) / 4))
+
+MSG_OVERHEAD_TOKENS = 4  # encadrement rôle/séparateurs d'un message chat
+
+def message_tokens(text: str) -> int:
+    return estimate_tokens(text) + MSG_OVERHEAD_TOKENS
+
+# ---------- Budgets (tokens estimés), partagés par app, asgi et core ----------
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "1600"))    # système + historique + message
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1200"))  # plafond de l'historique ; 0 = ancien mode
+HISTORY_MAX_TURNS = int(os.getenv("HISTORY_MAX_TURNS", "40"))
+LEGACY_HISTORY_TURNS = 10  # ancien mode : les N derniers tours, sans budget
+
+def history_budget(system_tokens: int, user_text: str) -> int:
+    """Tokens pour l'historique une fois le système et le message comptés, plafonnés
+    par HISTORY_TOKEN_BUDGET. 0 (ancien mode) si HISTORY_TOKEN_BUDGET <= 0."""
+    if HISTORY_TOKEN_BUDGET <= 0:
+        return 0
+    left = PROMPT_TOKEN_BUDGET - system_tokens - message_tokens(user_text)
+    return max(1, min(HISTORY_TOKEN_BUDGET, left))
+
+def fit_newest(items, budget: int, text_of=lambda x: x, newest_first: bool = False):
+    """Garde les éléments les plus récents tant que leur total de tokens tient dans
+    `budget`. items : liste du plus ancien au plus récent, ou n'importe quel itérable
+    du plus récent au plus ancien si newest_first (consommé seulement jusqu'au
+    dépassement). Renvoie (gardés du plus ancien au plus récent, tokens)."""
+    kept, used = [], 0
+    for it in (items if newest_first else reversed(items)):
+        t = message_tokens(text_of(it))
+        if used + t > budget:
+            break
+        kept.append(it)
+        used += t
+    kept.reverse()
+    return kept, used
+
+def history_messages(history) -> list:
+    """Historique de core.select_history → messages chat (résumé et extraits
+    rappelés en messages "system")."""
+    msgs = []
+    for h in history:
+        if h.get("direction") == "SUMMARY":
+            msgs.append({"role": "system", "content": f"Résumé des échanges précédents : {h.get('text', '')}"})
+            continue
+        if h.get("direction") == "RECALL":
+            msgs.append({"role": "system", "content": f"Extraits pertinents d'échanges plus anciens :\n{h.get('text', '')}"})
+            continue
+        role = "user" if (h.get("direction") == "IN") else "assistant"
+        msgs.append({"role": role, "content": h.get("text", "")})
+    return msgs
@@ -0,0 +1,143 @@
+# core/response_cache.py — cache de réponses LLM pour prompts répétés
+# Clé = sha256 d'une forme normalisée de (modèle, température, prompt complet) :
+# chaque message système (prompt, résumé SUMMARY et rappels RECALL propres à
+# l'utilisateur) et tout l'historique envoyé, pour qu'aucune réponse ne passe
+# d'un utilisateur à l'autre ; casse, espaces et Unicode (NFKC) des tours ne
+# comptent pas. Deux niveaux :
+#   - mémoire du process : LRU borné (RESPONSE_CACHE_SIZE) avec TTL ;
+#   - optionnel, RESPONSE_CACHE_DB=1 : table `response_cache` de la DB SQLite,
+#     partagée entre workers gunicorn et conservée au redémarrage.
+# Activé profil par profil (opt-in) :
+#   "response_cache": {"enabled": true, "ttl": 600}
+import os, json, time, hashlib, threading, unicodedata
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+ENABLED = os.getenv("RESPONSE_CACHE", "1") != "0"  # interrupteur global
+DEFAULT_TTL_S = float(os.getenv("RESPONSE_CACHE_TTL", "600"))
+MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_SIZE", "2000"))
+PERSIST = os.getenv("RESPONSE_CACHE_DB", "0") == "1"
+PROFILE_PATH = os.getenv("RESPONSE_CACHE_PROFILE", "profile.json")
+_PRUNE_EVERY = 200
+
+_lock = threading.Lock()
+_entries = OrderedDict()  # key -> (reply, expires_at)
+_stats = {"hits": 0, "db_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+_table_db = None  # DB_PATH où la table a été créée
+_puts = 0
+_no_store = threading.local()  # posé par skip_store() pendant compute()
+
+def ttl_for(profile: Optional[dict] = None) -> Optional[float]:
+    """TTL (s) si le profil a activé le cache, sinon None."""
+    if not ENABLED:
+        return None
+    if profile is None:
+        from .llm import load_profile
+        profile = load_profile(PROFILE_PATH)
+    conf = profile.get("response_cache") or {}
+    if not conf.get("enabled"):
+        return None
+    return float(conf.get("ttl", DEFAULT_TTL_S))
+
+def _norm(text) -> str:
+    s = unicodedata.normalize("NFKC", str(text or "")).casefold()
+    return " ".join(s.split())
+
+def make_key(model: str, messages: List[Dict], temperature=None) -> str:
+    """messages au format chat : [système..., ...historique..., utilisateur], tous pris en compte."""
+    raw = json.dumps([
+        model, temperature,
+        [(m.get("role"), hashlib.sha256(str(m.get("content") or "").encode("utf-8")).hexdigest()
+          if m.get("role") == "system" else _norm(m.get("content"))) for m in messages],
+    ], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _db_get(key: str, now: float) -> Optional[tuple]:
+    from . import memory as _memory
+    try:
+        with _memory.read_conn() as c:
+            return c.execute("SELECT reply, expires_at FROM response_cache WHERE key=? AND expires_at > ?",
+                             (key, now)).fetchone()
+    except Exception:
+        return None  # table pas encore créée
+
+def _db_put(key: str, reply: str, expires_at: float, now: float):
+    global _table_db, _puts
+    from . import memory as _memory
+    with _memory.write_tx() as c:
+        if _table_db != _memory.DB_PATH:
+            c.execute("""CREATE TABLE IF NOT EXISTS response_cache (
+                key TEXT PRIMARY KEY, reply TEXT NOT NULL, expires_at REAL NOT NULL)""")
+            _table_db = _memory.DB_PATH
+        c.execute("INSERT OR REPLACE INTO response_cache (key, reply, expires_at) VALUES (?,?,?)",
+                  (key, reply, expires_at))
+        _puts += 1
+        if _puts % _PRUNE_EVERY == 0:
+            c.execute("DELETE FROM response_cache WHERE expires_at <= ?", (now,))
+
+def _remember(key: str, reply: str, expires_at: float):
+    # Appelant : _lock tenu
+    _entries[key] = (reply, expires_at)
+    _entries.move_to_end(key)
+    while len(_entries) > MAX_ENTRIES:
+        _entries.popitem(last=False)
+        _stats["evictions"] += 1
+
+def get(key: str) -> Optional[str]:
+    now = time.time()
+    with _lock:
+        hit = _entries.get(key)
+        if hit is not None:
+            if hit[1] > now:
+                _entries.move_to_end(key)
+                _stats["hits"] += 1
+                return hit[0]
+            del _entries[key]
+    row = _db_get(key, now) if PERSIST else None
+    with _lock:
+        if row is not None:
+            _remember(key, row[0], row[1])
+            _stats["db_hits"] += 1
+            return row[0]
+        _stats["misses"] += 1
+    return None
+
+def put(key: str, reply: str, ttl: float):
+    now = time.time()
+    with _lock:
+        _remember(key, reply, now + ttl)
+        _stats["stores"] += 1
+    if PERSIST:
+        try:
+            _db_put(key, reply, now + ttl, now)
+        except Exception as e:
+            print(f"[RCACHE][db-err] {e}", flush=True)
+
+def cached(model: str, messages: List[Dict], compute: Callable[[], str],
+           profile: Optional[dict] = None, temperature=None, skip=()) -> str:
+    """compute() seulement en cas de miss ; les réponses vides ou dans `skip`
+    (réponses de repli) ne sont jamais mises en cache."""
+    ttl = ttl_for(profile)
+    if ttl is None or ttl <= 0:
+        return compute()
+    key = make_key(model, messages, temperature)
+    reply = get(key)
+    if reply is not None:
+        print(f"[RCACHE] hit key={key[:12]}", flush=True)
+        return reply
+    _no_store.flag = False
+    reply = compute()
+    if reply and reply not in skip and not _no_store.flag:
+        put(key, reply, ttl)
+    return reply
+
+def skip_store():
+    """Appelé pendant compute() : la réponse en cours (flux coupé, partielle) n'est pas mise en cache."""
+    _no_store.flag = True
+
+def stats() -> Dict:
+    with _lock:
+        st = dict(_stats, size=len(_entries))
+    seen = st["hits"] + st["db_hits"] + st["misses"]
+    st["hit_ratio"] = round((st["hits"] + st["db_hits"]) / seen, 3) if seen else 0.0
+    return st
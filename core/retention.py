@@ -0,0 +1,305 @@
+# core/retention.py — rétention de l'historique : archivage compressé, purge par lots, vacuum
+# - horizon par profil (features.retention.days, à défaut RETENTION_DAYS ; 0 = jamais) ;
+#   les RETENTION_KEEP_ROWS derniers messages d'un utilisateur restent toujours en base,
+#   et rien n'est archivé au-delà de son résumé (summaries.upto_id) s'il en a un ;
+# - archives append-only : ARCHIVE_DIR/<utilisateur>/<AAAA-MM>.jsonl.gz, un membre
+#   gzip par lot (fichier toujours lisible d'un bloc), fsync AVANT la suppression
+#   en base : un arrêt entre les deux ne perd rien (lignes réarchivées au run
+#   suivant, dédoublonnées par id à la lecture) ;
+# - suppression par lots de RETENTION_BATCH lignes, une transaction courte chacun
+#   (les triggers FTS suivent), pause entre lots pour laisser passer le trafic ;
+# - puis PRAGMA incremental_vacuum par tranches et wal_checkpoint(TRUNCATE) ;
+# - un seul run à la fois sur la machine (verrou fcntl dans ARCHIVE_DIR), au plus
+#   un toutes les RETENTION_INTERVAL s quel que soit le nombre de workers.
+import os, re, json, gzip, time, random, hashlib, threading
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional
+
+from . import memory as _memory
+from infra.monitoring import log_json as _log, observe as _observe
+try:
+    import fcntl as _fcntl
+except ImportError:  # Windows (dev local) : verrou du process seulement
+    _fcntl = None
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+DEFAULT_DAYS = float(os.getenv("RETENTION_DAYS", "90"))
+KEEP_ROWS = int(os.getenv("RETENTION_KEEP_ROWS", "200"))
+BATCH = int(os.getenv("RETENTION_BATCH", "500"))
+PAUSE_MS = float(os.getenv("RETENTION_PAUSE_MS", "50"))
+VACUUM_PAGES = int(os.getenv("RETENTION_VACUUM_PAGES", "1000"))
+INTERVAL_S = float(os.getenv("RETENTION_INTERVAL", "86400"))
+TICK_S = float(os.getenv("RETENTION_TICK", "600"))
+
+_lock = threading.Lock()
+_run_lock = threading.Lock()  # sans fcntl : un seul run par process
+_thread = None  # (pid, Thread)
+_last = {}      # dernier run de ce process
+
+# ---------- Archives ----------
+def _user_dir(user_id: str) -> str:
+    safe = re.sub(r"[^\w+.-]", "_", user_id) or "_"
+    if safe != user_id or safe.startswith("."):
+        safe = f"{safe.lstrip('.')}-{hashlib.sha1(user_id.encode()).hexdigest()[:8]}"
+    return os.path.join(ARCHIVE_DIR, safe)
+
+def _append(user_id: str, month: str, rows: List[tuple]) -> int:
+    """Ajoute un membre gzip (une ligne JSON par message) et le rend durable."""
+    d = _user_dir(user_id)
+    os.makedirs(d, exist_ok=True)
+    data = "".join(
+        json.dumps({"id": i, "ts": ts, "user_id": user_id, "direction": di, "msg_sid": sid, "text": t},
+                   ensure_ascii=False) + "\n"
+        for (i, ts, di, sid, t) in rows
+    ).encode("utf-8")
+    blob = gzip.compress(data, compresslevel=6, mtime=0)
+    with open(os.path.join(d, f"{month}.jsonl.gz"), "ab") as f:
+        f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    return len(blob)
+
+def archive_months(user_id: str) -> List[str]:
+    try:
+        names = os.listdir(_user_dir(user_id))
+    except OSError:
+        return []
+    return sorted(n[:-len(".jsonl.gz")] for n in names if n.endswith(".jsonl.gz"))
+
+def read_archive(user_id: str, since: Optional[str] = None, until: Optional[str] = None) -> Iterator[Dict]:
+    """Messages archivés de l'utilisateur, du plus ancien au plus récent.
+    since/until : bornes sur ts ("AAAA-MM", "AAAA-MM-JJ" ou horodatage complet, until exclu)."""
+    for month in archive_months(user_id):
+        if (since and month < since[:7]) or (until and month > until[:7]):
+            continue
+        rows = {}
+        with gzip.open(os.path.join(_user_dir(user_id), f"{month}.jsonl.gz"), "rt", encoding="utf-8") as f:
+            for line in f:
+                r = json.loads(line)
+                rows[r["id"]] = r  # réarchivage après un arrêt : même id, même contenu
+        for i in sorted(rows):
+            r = rows[i]
+            if (since and r["ts"] < since) or (until and r["ts"] >= until):
+                continue
+            yield r
+
+def history(user_id: str, since: Optional[str] = None, until: Optional[str] = None,
+            limit: int = 1000) -> List[Dict]:
+    """Historique complet (archives puis base), borné aux `limit` plus récents."""
+    out = list(read_archive(user_id, since, until))
+    archived_max = out[-1]["id"] if out else 0
+    _memory.flush()
+    q = "SELECT id, ts, direction, msg_sid, text FROM messages WHERE user_id=? AND id > ?"
+    args = [user_id, archived_max]
+    if since:
+        q += " AND ts >= ?"
+        args.append(since)
+    if until:
+        q += " AND ts < ?"
+        args.append(until)
+    with _memory.read_conn() as c:
+        rows = c.execute(q + " ORDER BY id DESC LIMIT ?", args + [limit if limit > 0 else -1]).fetchall()
+    out += [{"id": i, "ts": ts, "user_id": user_id, "direction": d, "msg_sid": sid, "text": t}
+            for (i, ts, d, sid, t) in reversed(rows)]
+    return out[-limit:] if limit > 0 else out
+
+def delete_archive(user_id: str) -> int:
+    """Supprime les archives de l'utilisateur (clear_history) ; nb de fichiers."""
+    n = 0
+    for month in archive_months(user_id):
+        try:
+            os.remove(os.path.join(_user_dir(user_id), f"{month}.jsonl.gz"))
+            n += 1
+        except OSError:
+            pass
+    return n
+
+# ---------- Horizons ----------
+def horizons() -> Dict[str, float]:
+    """user_id -> jours de rétention déclarés par les profils."""
+    from .scheduler import load_profiles
+    out = {}
+    for path, profile in load_profiles():
+        to = (profile.get("whatsapp") or {}).get("to") or ""
+        days = ((profile.get("features") or {}).get("retention") or {}).get("days")
+        if to and days is not None:
+            try:
+                out[to.replace("whatsapp:", "")] = float(days)
+            except (TypeError, ValueError):
+                print(f"[RETENTION][profile-err] {path}: days={days!r}", flush=True)
+    return out
+
+def _fmt(dt: datetime) -> str:
+    return dt.strftime("%Y-%m-%d %H:%M:%S")  # format de CURRENT_TIMESTAMP (UTC)
+
+# ---------- Purge ----------
+def _archive_user(user_id: str, cutoff: str, dry_run: bool, st: Dict):
+    # plafond d'id (exclu) : KEEP_ROWS derniers messages et messages non résumés restent en base
+    ceiling = 2 ** 63 - 1
+    with _memory.read_conn() as c:
+        if KEEP_ROWS > 0:
+            row = c.execute("SELECT id FROM messages WHERE user_id=? ORDER BY id DESC LIMIT 1 OFFSET ?",
+                            (user_id, KEEP_ROWS - 1)).fetchone()
+            if row is None:
+                return
+            ceiling = row[0]
+        summ = c.execute("SELECT upto_id FROM summaries WHERE user_id=?", (user_id,)).fetchone()
+    if summ is not None:
+        ceiling = min(ceiling, summ[0] + 1)
+    after = 0
+    while True:
+        with _memory.read_conn() as c:
+            rows = c.execute(
+                "SELECT id, ts, direction, msg_sid, text FROM messages "
+                "WHERE user_id=? AND id > ? AND id < ? AND ts < ? ORDER BY id LIMIT ?",
+                (user_id, after, ceiling, cutoff, BATCH),
+            ).fetchall()
+        if not rows:
+            return
+        after = rows[-1][0]
+        if dry_run:
+            st["rows"] += len(rows)
+            continue
+        t0 = time.perf_counter()
+        months = {}
+        for r in rows:
+            months.setdefault(str(r[1])[:7], []).append(r)
+        for month, part in months.items():
+            st["archive_bytes"] += _append(user_id, month, part)
+        ids = [r[0] for r in rows]
+        with _memory.write_tx() as c:
+            c.execute(f"DELETE FROM messages WHERE id IN ({','.join('?' * len(ids))})", ids)
+        _memory.invalidate_cached_history(user_id)
+        st["rows"] += len(rows)
+        st["batches"] += 1
+        _observe("retention_batch_ms", (time.perf_counter() - t0) * 1000)
+        if len(rows) < BATCH:
+            return
+        time.sleep(PAUSE_MS / 1000)
+
+def vacuum() -> Dict:
+    """Libère les pages vides (auto_vacuum=INCREMENTAL) puis tronque le WAL."""
+    out = {"freed_pages": 0}
+    with _memory.read_conn() as c:
+        mode = c.execute("PRAGMA auto_vacuum").fetchone()[0]
+    out["auto_vacuum"] = {0: "none", 1: "full", 2: "incremental"}.get(mode, mode)
+    if mode == 2:
+        while True:
+            with _memory.write_tx() as c:
+                before = c.execute("PRAGMA freelist_count").fetchone()[0]
+                if not before:
+                    break
+                c.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES})").fetchall()
+                after = c.execute("PRAGMA freelist_count").fetchone()[0]
+            out["freed_pages"] += before - after
+            if after >= before:
+                break
+            time.sleep(PAUSE_MS / 1000)
+    elif mode == 0:
+        print("[RETENTION] auto_vacuum=NONE : pages libres réutilisées mais fichier jamais réduit "
+              "(conversion : python ops/retention.py --convert)", flush=True)
+    with _memory.writer_raw() as c:
+        busy, log, done = c.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+    out["checkpoint"] = {"busy": busy, "wal_pages": log, "checkpointed": done}
+    return out
+
+def convert() -> Dict:
+    """Passe une DB existante en auto_vacuum=INCREMENTAL (VACUUM complet : hors trafic)."""
+    _memory.flush()
+    with _memory.writer_raw() as c:
+        before = os.path.getsize(_memory.DB_PATH)
+        c.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        c.execute("VACUUM")
+        c.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        mode = c.execute("PRAGMA auto_vacuum").fetchone()[0]
+    return {"auto_vacuum": mode, "bytes_before": before, "bytes_after": os.path.getsize(_memory.DB_PATH)}
+
+def run_once(now_utc: Optional[datetime] = None, dry_run: bool = False) -> Dict:
+    """Archive et purge les messages hors horizon, puis vacuum + checkpoint."""
+    now_utc = now_utc or datetime.now(timezone.utc)
+    t0 = time.perf_counter()
+    st = {"started": round(time.time(), 1), "dry_run": dry_run, "users": 0, "rows": 0,
+          "batches": 0, "archive_bytes": 0, "errors": 0}
+    per_user = horizons()
+    _memory.flush()
+    oldest_cutoff = _fmt(now_utc - timedelta(days=min([DEFAULT_DAYS] + [d for d in per_user.values() if d > 0])))
+    with _memory.read_conn() as c:
+        users = [u for (u,) in c.execute(
+            "SELECT DISTINCT user_id FROM messages WHERE ts < ?", (oldest_cutoff,))]
+    for user_id in users:
+        days = per_user.get(user_id, DEFAULT_DAYS)
+        if days <= 0:
+            continue
+        rows_before = st["rows"]
+        try:
+            _archive_user(user_id, _fmt(now_utc - timedelta(days=days)), dry_run, st)
+        except Exception as e:
+            st["errors"] += 1
+            print(f"[RETENTION][err] user={user_id} {e}", flush=True)
+        if st["rows"] > rows_before:
+            st["users"] += 1
+    if not dry_run and st["rows"]:
+        st.update(vacuum())
+    st["elapsed_ms"] = round((time.perf_counter() - t0) * 1000)
+    _log("retention", **st)
+    with _lock:
+        _last.clear()
+        _last.update(st)
+    return st
+
+# ---------- Planification ----------
+def maybe_run() -> Optional[Dict]:
+    """run_once si aucun autre process ne tourne et si le dernier run date de plus d'INTERVAL."""
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    with open(os.path.join(ARCHIVE_DIR, ".lock"), "a+") as f:
+        if _fcntl is not None:
+            try:
+                _fcntl.flock(f, _fcntl.LOCK_EX | _fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+        elif not _run_lock.acquire(blocking=False):
+            return None
+        try:
+            try:
+                f.seek(0)
+                last = float(f.read().strip() or 0)
+            except ValueError:
+                last = 0
+            if time.time() - last < INTERVAL_S:
+                return None
+            st = run_once()
+            f.seek(0)
+            f.truncate()
+            f.write(str(time.time()))
+            f.flush()
+            return st
+        finally:
+            if _fcntl is None:
+                _run_lock.release()
+
+def _loop():
+    time.sleep(random.uniform(0, min(TICK_S, 60)))  # workers gunicorn : pas tous au même instant
+    while True:
+        try:
+            maybe_run()
+        except Exception as e:
+            print(f"[RETENTION][loop-err] {e}", flush=True)
+        time.sleep(TICK_S)
+
+def start():
+    """Démarre (une fois par process, y compris après fork) la boucle de maintenance."""
+    global _thread
+    t = _thread
+    if t is not None and t[0] == os.getpid():
+        return
+    with _lock:
+        t = _thread
+        if t is not None and t[0] == os.getpid():
+            return
+        th = threading.Thread(target=_loop, name="retention", daemon=True)
+        th.start()
+        _thread = (os.getpid(), th)
+
+def stats() -> Dict:
+    with _lock:
+        return {"last_run": dict(_last) or None}
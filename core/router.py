@@ -0,0 +1,209 @@
+# core/router.py — choix du modèle et de max_tokens par requête
+# Caractéristiques locales, sans appel réseau : longueur du message, question,
+# mots-clés de tâche "lourde" (explique, compare, rédige...), taille de
+# l'historique, check-in vs conversation. Routes par défaut :
+#   short   : message court (≤ short_chars)             → ROUTER_FAST_MODEL, peu de tokens
+#             (s'il reste le modèle de "chat", max_tokens de "chat" : pas de réponse tronquée
+#             sans gain de latence)
+#   chat    : cas général                               → OPENAI_MODEL
+#   complex : long, tâche lourde, ou question détaillée → plus de tokens, et
+#             ROUTER_COMPLEX_MODEL (même modèle par défaut : le gros modèle est opt-in)
+#   checkin : check-in du matin (core.scheduler)         → modèle rapide
+# Chaque appel est journalisé (log "route" : route, modèle, ms, tokens) ; en mode
+# ombre, une part `shadow_rate` des requêtes est rejouée en fond sur une autre
+# route (réponse jamais envoyée) pour comparer latence, tokens et texte ; l'ombre a
+# son propre disjoncteur/limiteur ("openai_shadow") : ses échecs et ses appels ne
+# touchent pas ceux des vraies réponses.
+# Réglages par profil (profile.json), tous optionnels :
+#   "router": {"enabled": true, "short_chars": 80, "complex_chars": 280,
+#              "routes": {"complex": {"model": "gpt-4o", "max_tokens": 350}},
+#              "shadow_rate": 0.05, "shadow": {"short": "chat"}}
+import os, time, random, difflib, threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from infra import resilience as _resilience
+from infra.monitoring import log_json as _log, observe as _observe
+
+ENABLED = os.getenv("ROUTER", "1") != "0"
+PROFILE_PATH = os.getenv("ROUTER_PROFILE") or os.getenv("PROFILE_PATH", "profile.json")
+DEFAULT_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+FAST_MODEL = os.getenv("ROUTER_FAST_MODEL", DEFAULT_MODEL)
+COMPLEX_MODEL = os.getenv("ROUTER_COMPLEX_MODEL", DEFAULT_MODEL)
+DEFAULT_MAX_TOKENS = int(os.getenv("OPENAI_MAX_TOKENS", "180"))
+SHADOW_RATE = float(os.getenv("ROUTER_SHADOW_RATE", "0"))
+SHADOW_CONCURRENCY = int(os.getenv("ROUTER_SHADOW_CONCURRENCY", "2"))
+SHADOW_TIMEOUT_S = float(os.getenv("ROUTER_SHADOW_TIMEOUT", "15"))
+
+SHORT_MAX_TOKENS = os.getenv("ROUTER_SHORT_MAX_TOKENS")  # None : 100, ou celui de "chat" (même modèle)
+
+DEFAULT_ROUTES = {
+    "short": {"model": FAST_MODEL, "max_tokens": int(SHORT_MAX_TOKENS or "100")},
+    "chat": {"model": DEFAULT_MODEL, "max_tokens": DEFAULT_MAX_TOKENS},
+    "complex": {"model": COMPLEX_MODEL, "max_tokens": int(os.getenv("ROUTER_COMPLEX_MAX_TOKENS", "350"))},
+    "checkin": {"model": FAST_MODEL, "max_tokens": int(os.getenv("ROUTER_CHECKIN_MAX_TOKENS", "220"))},
+}
+DEFAULT_SHADOW = {"short": "chat", "chat": "complex", "complex": "chat", "checkin": "chat"}
+SHORT_CHARS = int(os.getenv("ROUTER_SHORT_CHARS", "80"))
+COMPLEX_CHARS = int(os.getenv("ROUTER_COMPLEX_CHARS", "280"))
+COMPLEX_QUESTION_WORDS = 20  # question d'au moins N mots → complex
+DEEP_HISTORY_TURNS = 12      # question de suivi (≥ 10 mots) dans une longue conversation → complex
+# Mots entiers normalisés (sans accents) d'une demande de travail plus long ;
+# pas de préfixes : "Stéphane", "programme", "résumé" restent de la conversation
+COMPLEX_WORDS = frozenset((
+    "explique", "expliquer", "expliquez", "explication", "compare", "comparer", "comparez", "comparaison",
+    "analyse", "analyser", "analysez", "detaille", "detailler", "detaillez", "redige", "rediger", "redigez",
+    "argumente", "argumenter", "avantages", "inconvenients", "explain", "analyze",
+    "elaborate", "pros", "cons"))
+_QUESTION_STARTS = frozenset(("comment", "pourquoi", "quoi", "quel", "quelle", "quels", "quelles", "combien",
+                              "ou", "quand", "qui", "est ce", "peux tu", "tu peux", "what", "why", "how",
+                              "when", "where", "which", "who", "can you", "should"))
+
+Route = namedtuple("Route", "name model max_tokens features")
+
+_lock = threading.Lock()
+_stats = {}   # route -> compteurs
+_shadow = {"submitted": 0, "skipped_busy": 0, "done": 0, "errors": 0}
+_shadow_inflight = 0
+_executor = None  # (pid, ThreadPoolExecutor)
+
+def _conf(profile: Optional[dict]) -> dict:
+    if profile is None:
+        from .llm import load_profile
+        profile = load_profile(PROFILE_PATH)
+    return profile.get("router") or {}
+
+def features(messages: List[Dict], kind: str = "chat") -> Dict:
+    """messages au format chat : [système..., historique..., utilisateur]."""
+    from .fastpath import normalize
+    text = str(messages[-1].get("content") or "") if messages else ""
+    norm = normalize(text)
+    words = norm.split()
+    return {
+        "kind": kind,
+        "chars": len(text),
+        "words": len(words),
+        "lines": text.count("\n") + 1 if text.strip() else 0,
+        "question": "?" in text or bool(words) and (words[0] in _QUESTION_STARTS
+                                                    or " ".join(words[:2]) in _QUESTION_STARTS),
+        "keyword": any(w in COMPLEX_WORDS for w in words),
+        "history_turns": sum(1 for m in messages[:-1] if m.get("role") in ("user", "assistant")),
+    }
+
+def _pick(f: Dict, conf: dict) -> str:
+    if f["kind"] == "checkin":
+        return "checkin"
+    if (f["chars"] >= int(conf.get("complex_chars", COMPLEX_CHARS)) or f["keyword"] or f["lines"] >= 4
+            or (f["question"] and f["words"] >= COMPLEX_QUESTION_WORDS)
+            or (f["question"] and f["words"] >= 10 and f["history_turns"] >= DEEP_HISTORY_TURNS)):
+        return "complex"
+    if f["chars"] <= int(conf.get("short_chars", SHORT_CHARS)) and f["lines"] <= 1:
+        return "short"
+    return "chat"
+
+def _route(name: str, conf: dict, f: Dict) -> Route:
+    r = dict(DEFAULT_ROUTES.get(name) or DEFAULT_ROUTES["chat"])
+    own = (conf.get("routes") or {}).get(name) or {}
+    r.update(own)
+    if name == "short" and SHORT_MAX_TOKENS is None and "max_tokens" not in own:
+        chat = _route("chat", conf, f)
+        if r["model"] == chat.model:
+            r["max_tokens"] = chat.max_tokens
+    return Route(name, r["model"], int(r["max_tokens"]), f)
+
+def route(messages: List[Dict], kind: str = "chat", profile: Optional[dict] = None) -> Route:
+    """Route (modèle, max_tokens) de la requête ; "chat" si le routage est coupé."""
+    conf = _conf(profile)
+    f = features(messages, kind)
+    if not ENABLED or conf.get("enabled") is False:
+        return _route("checkin" if kind == "checkin" else "chat", conf, f)
+    return _route(_pick(f, conf), conf, f)
+
+def record(r: Route, ms: float, usage=None, error=None, **extra):
+    """Journalise l'appel servi par la route r (latence, tokens)."""
+    pt = getattr(usage, "prompt_tokens", None)
+    ct = getattr(usage, "completion_tokens", None)
+    with _lock:
+        st = _stats.setdefault(r.name, {"n": 0, "errors": 0, "ms_total": 0.0,
+                                        "prompt_tokens": 0, "completion_tokens": 0})
+        st["n"] += 1
+        st["errors"] += 1 if error else 0
+        st["ms_total"] += ms
+        st["prompt_tokens"] += pt or 0
+        st["completion_tokens"] += ct or 0
+    _observe("llm_route_ms", ms, route=r.name)
+    _log("route", route=r.name, model=r.model, max_tokens=r.max_tokens, ms=round(ms),
+         prompt_tokens=pt, completion_tokens=ct, error=str(error)[:200] if error else None,
+         **{k: v for k, v in r.features.items() if k != "kind"}, **extra)
+
+# ---------- Mode ombre ----------
+def _pool() -> ThreadPoolExecutor:
+    global _executor
+    e = _executor
+    if e is None or e[0] != os.getpid():
+        with _lock:
+            e = _executor
+            if e is None or e[0] != os.getpid():
+                e = _executor = (os.getpid(), ThreadPoolExecutor(max_workers=max(1, SHADOW_CONCURRENCY),
+                                                                 thread_name_prefix="route-shadow"))
+    return e[1]
+
+def maybe_shadow(r: Route, messages: List[Dict], reply: str, ms: float, usage=None,
+                 temperature: float = 0.3, profile: Optional[dict] = None) -> bool:
+    """Rejoue (parfois) la requête en fond sur la route de comparaison."""
+    global _shadow_inflight
+    conf = _conf(profile)
+    rate = float(conf.get("shadow_rate", SHADOW_RATE))
+    if rate <= 0 or random.random() >= rate:
+        return False
+    other = dict(DEFAULT_SHADOW, **(conf.get("shadow") or {})).get(r.name)
+    if not other or other == r.name:
+        return False
+    alt = _route(other, conf, r.features)
+    with _lock:
+        if _shadow_inflight >= SHADOW_CONCURRENCY:
+            _shadow["skipped_busy"] += 1  # jamais de file : l'ombre ne doit rien retarder
+            return False
+        _shadow_inflight += 1
+        _shadow["submitted"] += 1
+    _pool().submit(_run_shadow, r, alt, list(messages), reply, ms,
+                   getattr(usage, "completion_tokens", None), temperature)
+    return True
+
+def _run_shadow(r: Route, alt: Route, messages, reply: str, ms: float, tokens, temperature: float):
+    global _shadow_inflight
+    from . import llm
+    t0 = time.perf_counter()
+    try:
+        shadow_up = _resilience.upstream("openai_shadow", SHADOW_TIMEOUT_S, llm._is_upstream_failure,
+                                         initial=SHADOW_CONCURRENCY, max_limit=SHADOW_CONCURRENCY)
+        rsp = shadow_up.call(
+            llm.client().with_options(timeout=SHADOW_TIMEOUT_S, max_retries=0).chat.completions.create,
+            model=alt.model, messages=messages, temperature=temperature, max_tokens=alt.max_tokens,
+        )
+        alt_ms = (time.perf_counter() - t0) * 1000
+        alt_reply = (rsp.choices[0].message.content or "").strip()
+        with _lock:
+            _shadow["done"] += 1
+        _log("route_shadow", route=r.name, model=r.model, ms=round(ms), completion_tokens=tokens,
+             chars=len(reply or ""), shadow_route=alt.name, shadow_model=alt.model, shadow_ms=round(alt_ms),
+             shadow_completion_tokens=getattr(getattr(rsp, "usage", None), "completion_tokens", None),
+             shadow_chars=len(alt_reply),
+             similarity=round(difflib.SequenceMatcher(None, reply or "", alt_reply).ratio(), 3))
+        _observe("llm_shadow_ms", alt_ms, route=alt.name)
+    except Exception as e:
+        with _lock:
+            _shadow["errors"] += 1
+        print(f"[ROUTE][shadow-err] {alt.name}: {e}", flush=True)
+    finally:
+        with _lock:
+            _shadow_inflight -= 1
+
+def stats() -> Dict:
+    with _lock:
+        routes = {k: dict(v, ms_avg=round(v["ms_total"] / v["n"]) if v["n"] else 0)
+                  for k, v in _stats.items()}
+        for v in routes.values():
+            del v["ms_total"]
+        return {"enabled": ENABLED, "routes": routes, "shadow": dict(_shadow, inflight=_shadow_inflight)}
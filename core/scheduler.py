@@ -1,2 +1,316 @@
-# Placeholder pour un planificateur (cron/Celery). Ici, on documente l'idée.
-# Ex. Celery Beat qui POST /internal/send avec payloads prévus.
+# core/scheduler.py — check-ins du matin, planifiés dans le process
+# - profils : PROFILES_DIR/*.json (un par utilisateur, "whatsapp.to" requis),
+#   à défaut PROFILE_PATH ;
+# - toutes les CHECKIN_TICK s, un profil est "dû" quand features.checkin.time est
+#   passé dans sa timezone (depuis moins de CHECKIN_WINDOW min) ;
+# - chaque check-in est réservé en base (table checkins, clé utilisateur + jour
+#   local) juste avant l'envoi : pas de doublon entre workers gunicorn ni après
+#   un redémarrage ; échec → nouvel essai au tick suivant (CHECKIN_MAX_ATTEMPTS) ;
+# - fan-out borné : CHECKIN_CONCURRENCY générations en parallèle, départs étalés
+#   sur CHECKIN_JITTER s (pas de pic OpenAI/Twilio à 08:00 pile) ;
+# - progression et latences par run dans stats().
+import os, time, random, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional
+from zoneinfo import ZoneInfo
+
+from . import memory as _memory
+from infra.monitoring import log_json as _log, observe as _observe
+
+PROFILES_DIR = os.getenv("PROFILES_DIR", "profiles")
+PROFILE_PATH = os.getenv("PROFILE_PATH", "profile.json")
+TICK_S = float(os.getenv("CHECKIN_TICK", "30"))
+WINDOW_MIN = float(os.getenv("CHECKIN_WINDOW", "120"))
+JITTER_S = float(os.getenv("CHECKIN_JITTER", "120"))
+CONCURRENCY = int(os.getenv("CHECKIN_CONCURRENCY", "8"))
+MAX_ATTEMPTS = int(os.getenv("CHECKIN_MAX_ATTEMPTS", "3"))
+RETRIES = int(os.getenv("CHECKIN_RETRIES", "3"))  # limiteur/disjoncteur OpenAI plein
+LEASE_S = float(os.getenv("CHECKIN_LEASE", "300"))
+
+_generator = None  # fn(profile_path, profile, now_local) -> texte
+_sender = None     # fn(to, texte) -> sid|None ; lève une exception en cas d'échec
+_executor = None   # (pid, ThreadPoolExecutor)
+_thread = None     # (pid, Thread)
+_lock = threading.Lock()
+_inflight = set()  # (user_id, jour) en file ou en cours dans ce process
+_runs = deque(maxlen=10)
+_run_seq = 0
+
+def set_generator(fn: Callable[[str, dict, datetime], str]):
+    global _generator
+    _generator = fn
+
+def set_sender(fn: Callable[[str, str], Optional[str]]):
+    global _sender
+    _sender = fn
+
+def _default_generator(path: str, profile: dict, now_local: datetime) -> str:
+    from . import llm
+    return llm.generate_checkin(path, now=now_local)
+
+def _default_sender(to: str, body: str):
+    print(f"[CHECKIN] no-op (pas d'expéditeur) to={to}", flush=True)
+    return None
+
+# skipped : généré mais pas d'expéditeur (Twilio non configuré), rien n'est parti
+_CHECKINS_DDL = """
+        CREATE TABLE IF NOT EXISTS checkins (
+            user_id    TEXT NOT NULL,
+            day        TEXT NOT NULL,
+            state      TEXT NOT NULL CHECK(state IN ('sending','sent','failed','skipped')),
+            attempts   INTEGER NOT NULL DEFAULT 1,
+            tw_sid     TEXT,
+            last_error TEXT,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (user_id, day)
+        )"""
+
+def bootstrap() -> None:
+    with _memory.write_tx() as c:
+        c.execute(_CHECKINS_DDL)
+        sql = c.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='checkins'").fetchone()[0]
+        if "'skipped'" not in sql:
+            # table d'avant l'état 'skipped' : CHECK non modifiable, on la recrée
+            c.execute("ALTER TABLE checkins RENAME TO checkins_old")
+            c.execute(_CHECKINS_DDL)
+            c.execute("INSERT INTO checkins SELECT * FROM checkins_old")
+            c.execute("DROP TABLE checkins_old")
+
+# ---------- Profils et créneaux ----------
+def load_profiles() -> List[tuple]:
+    """[(chemin, profil)] : PROFILES_DIR/*.json, sinon PROFILE_PATH."""
+    from . import llm
+    paths = []
+    try:
+        paths = sorted(e.path for e in os.scandir(PROFILES_DIR) if e.name.endswith(".json") and e.is_file())
+    except OSError:
+        pass
+    if not paths and os.path.exists(PROFILE_PATH):
+        paths = [PROFILE_PATH]
+    return [(p, llm.load_profile(p)) for p in paths]
+
+def slot(profile: dict, now_utc: datetime):
+    """(user_id, jour local, heure locale du créneau, maintenant local) ou None."""
+    checkin = profile.get("features", {}).get("checkin", {})
+    to = (profile.get("whatsapp") or {}).get("to") or ""
+    if not checkin.get("enabled") or not to.startswith("whatsapp:") or "X" in to:  # "X" : numéro d'exemple
+        return None
+    try:
+        tz = ZoneInfo(profile.get("timezone") or "Europe/Paris")
+        hh, mm = (int(x) for x in str(checkin.get("time", "08:00")).split(":")[:2])
+    except Exception as e:
+        print(f"[CHECKIN][profile-err] to={to} {e}", flush=True)
+        return None
+    now_local = now_utc.astimezone(tz)
+    at = now_local.replace(hour=hh, minute=mm, second=0, microsecond=0)
+    return to.replace("whatsapp:", ""), at.date().isoformat(), at, now_local
+
+def due(now_utc: Optional[datetime] = None) -> List[tuple]:
+    """Check-ins à envoyer maintenant : [(chemin, profil, user_id, jour, maintenant local)]."""
+    now_utc = now_utc or datetime.now(timezone.utc)
+    window = timedelta(minutes=WINDOW_MIN)
+    out = []
+    for path, profile in load_profiles():
+        s = slot(profile, now_utc)
+        if s is None:
+            continue
+        user_id, day, at, now_local = s
+        if at <= now_local < at + window:
+            out.append((path, profile, user_id, day, now_local))
+    if not out:
+        return out
+    # Déjà envoyés / en cours / abandonnés (une requête par jour local)
+    now = time.time()
+    closed = set()
+    with _memory.read_conn() as c:
+        for day in {d[3] for d in out}:
+            for (user_id, state, attempts, updated_at) in c.execute(
+                "SELECT user_id, state, attempts, updated_at FROM checkins WHERE day=?", (day,)
+            ):
+                if (state in ("sent", "skipped") or (state == "failed" and attempts >= MAX_ATTEMPTS)
+                        or (state == "sending" and now - updated_at < LEASE_S)):
+                    closed.add((user_id, day))
+    return [d for d in out if (d[2], d[3]) not in closed]
+
+# ---------- Réservation en base ----------
+def _claim(user_id: str, day: str) -> bool:
+    now = time.time()
+    with _memory.write_tx() as c:
+        row = c.execute(
+            "INSERT INTO checkins (user_id, day, state, updated_at) VALUES (?,?,'sending',?) "
+            "ON CONFLICT(user_id, day) DO UPDATE SET state='sending', attempts=attempts+1, updated_at=excluded.updated_at "
+            "WHERE (state='failed' AND attempts < ?) OR (state='sending' AND updated_at < ?) "
+            "RETURNING attempts",
+            (user_id, day, now, MAX_ATTEMPTS, now - LEASE_S),
+        ).fetchone()
+    return row is not None
+
+def _close(user_id: str, day: str, state: str, tw_sid=None, error=None):
+    with _memory.write_tx() as c:
+        c.execute("UPDATE checkins SET state=?, tw_sid=?, last_error=?, updated_at=? WHERE user_id=? AND day=?",
+                  (state, tw_sid, (error or "")[:500] or None, time.time(), user_id, day))
+
+# ---------- Fan-out ----------
+class _Run:
+    def __init__(self, run_id: int, total: int):
+        self.id = run_id
+        self.total = total
+        self.started = time.time()
+        self.finished = None
+        self.sent = self.failed = self.skipped = self.undelivered = 0
+        self.latencies = []
+        self.lock = threading.Lock()
+        self.done_event = threading.Event()
+        if total == 0:
+            self.done_event.set()
+
+    def record(self, outcome: str, ms: Optional[float] = None):
+        with self.lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            if ms is not None:
+                self.latencies.append(ms)
+            last = self.sent + self.failed + self.skipped + self.undelivered == self.total
+            if last:
+                self.finished = time.time()
+        if last:
+            _log("checkin_run", **self.stats())
+            self.done_event.set()
+
+    def stats(self) -> Dict:
+        with self.lock:
+            lat = sorted(self.latencies)
+            done = self.sent + self.failed + self.skipped + self.undelivered
+            pct = (lambda p: round(lat[min(len(lat) - 1, int(len(lat) * p))]) if lat else 0)
+            return {
+                "id": self.id,
+                "started": round(self.started, 1),
+                "elapsed_s": round((self.finished or time.time()) - self.started, 1),
+                "total": self.total,
+                "done": done,
+                "progress": round(done / self.total, 3) if self.total else 1.0,
+                "sent": self.sent,
+                "failed": self.failed,
+                "skipped": self.skipped,
+                "undelivered": self.undelivered,
+                "p50_ms": pct(0.50),
+                "p95_ms": pct(0.95),
+                "max_ms": round(lat[-1]) if lat else 0,
+            }
+
+def _pool() -> ThreadPoolExecutor:
+    global _executor
+    e = _executor
+    if e is None or e[0] != os.getpid():
+        with _lock:
+            e = _executor
+            if e is None or e[0] != os.getpid():
+                e = _executor = (os.getpid(), ThreadPoolExecutor(max_workers=CONCURRENCY,
+                                                                 thread_name_prefix="checkin"))
+    return e[1]
+
+def _generate(path: str, profile: dict, now_local: datetime) -> str:
+    from infra.resilience import Unavailable
+    for attempt in range(RETRIES + 1):
+        try:
+            return (_generator or _default_generator)(path, profile, now_local)
+        except Unavailable:
+            # limite de concurrence OpenAI atteinte (trafic webhook prioritaire) : patienter
+            if attempt >= RETRIES:
+                raise
+            time.sleep(random.uniform(1.0, 2.0) * (attempt + 1))
+
+def _checkin(run: _Run, path: str, profile: dict, user_id: str, day: str, now_local: datetime,
+             start_at: float):
+    try:
+        delay = start_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        if not _claim(user_id, day):
+            run.record("skipped")
+            return
+        t0 = time.perf_counter()
+        try:
+            now_local = now_local + timedelta(seconds=max(delay, 0))
+            text = _generate(path, profile, now_local)
+            tw_sid = (_sender or _default_sender)(profile["whatsapp"]["to"], text)
+        except Exception as e:
+            _close(user_id, day, "failed", error=str(e) or e.__class__.__name__)
+            print(f"[CHECKIN][err] user={user_id} {e}", flush=True)
+            run.record("failed")
+            return
+        if tw_sid is None:
+            # expéditeur absent (no-op) : rien n'est parti, pas de ligne OUT dans l'historique
+            _close(user_id, day, "skipped")
+            run.record("undelivered")
+            return
+        _close(user_id, day, "sent", tw_sid=tw_sid)
+        from . import record_outgoing
+        record_outgoing(user_id, text, tw_sid)
+        ms = (time.perf_counter() - t0) * 1000
+        _observe("checkin_ms", ms)
+        run.record("sent", ms)
+    except Exception as e:
+        print(f"[CHECKIN][task-err] user={user_id} {e}", flush=True)
+        run.record("failed")
+    finally:
+        with _lock:
+            _inflight.discard((user_id, day))
+
+def run_once(now_utc: Optional[datetime] = None, wait: bool = False) -> Dict:
+    """Lance les check-ins dus (hors ceux déjà en file dans ce process)."""
+    global _run_seq
+    todo = []
+    with _lock:
+        for d in due(now_utc):
+            key = (d[2], d[3])
+            if key not in _inflight:
+                _inflight.add(key)
+                todo.append(d)
+        _run_seq += 1
+        run = _Run(_run_seq, len(todo))
+        if todo:
+            _runs.append(run)
+    if not todo:
+        return run.stats()
+    # départs étalés, soumis dans l'ordre (le pool FIFO les prend dans cet ordre)
+    t0 = time.monotonic()
+    jitter = min(JITTER_S, len(todo) * 0.5)
+    starts = sorted((t0 + random.uniform(0, jitter), d) for d in todo)
+    pool = _pool()
+    for start_at, (path, profile, user_id, day, now_local) in starts:
+        pool.submit(_checkin, run, path, profile, user_id, day, now_local, start_at)
+    print(f"[CHECKIN] run={run.id} dus={len(todo)} jitter={jitter:.0f}s concurrence={CONCURRENCY}", flush=True)
+    if wait:
+        run.done_event.wait()
+    return run.stats()
+
+# ---------- Boucle de fond ----------
+def _loop():
+    while True:
+        try:
+            run_once()
+        except Exception as e:
+            print(f"[CHECKIN][loop-err] {e}", flush=True)
+        time.sleep(TICK_S)
+
+def start():
+    """Démarre (une fois par process, y compris après fork) la boucle de planification."""
+    global _thread
+    t = _thread
+    if t is not None and t[0] == os.getpid():
+        return
+    with _lock:
+        t = _thread
+        if t is not None and t[0] == os.getpid():
+            return
+        th = threading.Thread(target=_loop, name="checkin-scheduler", daemon=True)
+        th.start()
+        _thread = (os.getpid(), th)
+
+def stats() -> Dict:
+    with _lock:
+        runs = list(_runs)
+        inflight = len(_inflight)
+    return {"inflight": inflight, "runs": [r.stats() for r in runs[-5:]]}
@@ -0,0 +1,129 @@
+# core/summary.py — résumés glissants par utilisateur, calculés hors du chemin chaud
+# Toutes les SUMMARY_EVERY_TURNS nouvelles lignes, un thread de fond replie les
+# anciens tours (hors SUMMARY_RECENT_TURNS derniers) dans un résumé compact
+# (table `summaries`). Le prompt reçoit alors : résumé + quelques tours récents.
+# Appels OpenAI sous leur propre disjoncteur/limiteur ("openai_summary") : un
+# résumé en échec n'ouvre pas celui des réponses et ne leur prend aucun créneau.
+import os, time, threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+from infra import resilience as _resilience
+from . import memory as _memory
+
+EVERY_TURNS = int(os.getenv("SUMMARY_EVERY_TURNS", "20"))  # 0 = désactivé
+RECENT_TURNS = int(os.getenv("SUMMARY_RECENT_TURNS", "6"))
+BATCH_ROWS = int(os.getenv("SUMMARY_BATCH_ROWS", "200"))
+MAX_CHARS = int(os.getenv("SUMMARY_MAX_CHARS", "1200"))
+MODEL = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")
+CACHE_TTL_S = float(os.getenv("SUMMARY_CACHE_TTL", "60"))
+LATENCY_TARGET_S = float(os.getenv("SUMMARY_LATENCY_TARGET", "20"))
+
+SUMMARY_DIRECTION = "SUMMARY"  # entrée d'historique spéciale → message "system"
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summary")
+_lock = threading.Lock()
+_counts = {}     # user_id -> tours depuis le dernier déclenchement (ce process)
+_inflight = set()
+_cache = {}      # user_id -> [summary|None, tours non résumés, ts]
+_summarizer = None
+
+def set_summarizer(fn: Callable[[str, List[Dict]], str]):
+    """fn(résumé_précédent, [{"direction","text"}, ...]) -> nouveau résumé."""
+    global _summarizer
+    _summarizer = fn
+
+def _default_summarizer(previous: str, turns: List[Dict]) -> str:
+    from . import llm
+    lines = "\n".join(
+        f"{'Utilisateur' if t['direction'] == 'IN' else 'Assistant'}: {t['text']}" for t in turns
+    )
+    # une seule génération à la fois (executor à 1 thread)
+    up = _resilience.upstream("openai_summary", LATENCY_TARGET_S, llm._is_upstream_failure,
+                              initial=1, max_limit=1)
+    rsp = up.call(
+        llm.client().chat.completions.create,
+        model=MODEL,
+        messages=[
+            {"role": "system", "content": (
+                "Tu tiens le résumé d'une conversation WhatsApp. Mets-le à jour avec les "
+                "nouveaux échanges. Garde les faits durables, préférences, projets et "
+                f"engagements. Pas de politesse. Français. ≤ {MAX_CHARS} caractères.")},
+            {"role": "user", "content": f"Résumé actuel:\n{previous or '(vide)'}\n\nNouveaux échanges:\n{lines}"},
+        ],
+        temperature=0.2,
+        max_tokens=400,
+    )
+    return (rsp.choices[0].message.content or "").strip()[:MAX_CHARS]
+
+def get(user_id: str):
+    """(résumé, nb de tours postérieurs au résumé) ou None. Cache court en mémoire :
+    le nb de tours suit note_turns() sans relire SQLite."""
+    if EVERY_TURNS <= 0:
+        return None
+    now = time.monotonic()
+    with _lock:
+        hit = _cache.get(user_id)
+        if hit is not None and now - hit[2] < CACHE_TTL_S:
+            return (hit[0], hit[1]) if hit[0] else None
+    row = _memory.get_summary(user_id)
+    if row:
+        summary, after = row[0], _memory.count_after(user_id, row[1])
+    else:
+        summary, after = None, 0
+    with _lock:
+        _cache[user_id] = [summary, after, now]
+    return (summary, after) if summary else None
+
+def invalidate(user_id: str):
+    with _lock:
+        _cache.pop(user_id, None)
+        _counts.pop(user_id, None)
+
+def note_turns(user_id: str, n: int = 1):
+    """Appelé après chaque échange ; déclenche un rafraîchissement en fond au K-ième tour."""
+    if EVERY_TURNS <= 0:
+        return
+    with _lock:
+        hit = _cache.get(user_id)
+        if hit is not None:
+            hit[1] += n
+        c = _counts.get(user_id, 0) + n
+        if c < EVERY_TURNS or user_id in _inflight:
+            _counts[user_id] = c
+            return
+        _counts[user_id] = 0
+        _inflight.add(user_id)
+    _executor.submit(_refresh, user_id)
+
+def _refresh(user_id: str):
+    try:
+        while _refresh_once(user_id):
+            pass
+    except Exception as e:
+        print(f"[SUMMARY][err] user={user_id} {e}", flush=True)
+    finally:
+        with _lock:
+            _inflight.discard(user_id)
+
+def _refresh_once(user_id: str) -> bool:
+    """Replie un lot de tours dans le résumé. True s'il en reste à replier."""
+    row = _memory.get_summary(user_id)
+    previous, upto_id, turns = row if row else ("", 0, 0)
+    rows = _memory.messages_after(user_id, upto_id, BATCH_ROWS + RECENT_TURNS)
+    more = len(rows) == BATCH_ROWS + RECENT_TURNS
+    todo = rows[:BATCH_ROWS] if more else rows[:max(len(rows) - RECENT_TURNS, 0)]
+    if len(todo) < (1 if more else EVERY_TURNS):
+        return False
+    t0 = time.time()
+    summary = (_summarizer or _default_summarizer)(
+        previous, [{"direction": d, "text": t} for (_id, d, t) in todo]
+    )
+    if not summary:
+        return False
+    _memory.save_summary(user_id, summary, todo[-1][0], turns + len(todo))
+    with _lock:
+        _cache.pop(user_id, None)  # relu (avec le nb de tours restants) au prochain get()
+    print(f"[SUMMARY] user={user_id} turns+={len(todo)} upto={todo[-1][0]} "
+          f"chars={len(summary)} ms={int((time.time() - t0) * 1000)}", flush=True)
+    return more
@@ -3,4 +3,9 @@ TEMPLATES = {
     "checkin_morning": "Bonjour {name} ☀️ Comment ça va ce matin ?",
     "sport_evening": "Bonsoir {name} 🏀 Voici un petit résumé sport du jour (démo).",
     "weather": "Météo pour aujourd'hui à {city} : (démo).",
+    # Réponses locales du fast-path (core.fastpath), sans appel LLM
+    "ping": "pong",
+    "greeting": "Salut {name} 👋 Comment ça va aujourd'hui ?",
+    "thanks": "Avec plaisir {name} 🙂",
+    "ack": "Parfait 👍",
 }
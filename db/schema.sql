@@ -1,3 +1,5 @@
+-- auto_vacuum avant WAL (nouvelle DB) : pages rendues par core.retention (incremental_vacuum)
+PRAGMA auto_vacuum=INCREMENTAL;
 PRAGMA journal_mode=WAL;
 
 CREATE TABLE IF NOT EXISTS messages (
@@ -7,10 +9,81 @@ CREATE TABLE IF NOT EXISTS messages (
   channel TEXT NOT NULL DEFAULT 'whatsapp',
   direction TEXT NOT NULL CHECK (direction IN ('IN','OUT')),
   msg_sid TEXT,
-  text TEXT NOT NULL
+  text TEXT NOT NULL,
+  delivery TEXT  -- OUT : 'sent' | 'failed' (core.outbox)
 );
 
 CREATE INDEX IF NOT EXISTS idx_messages_user_ts ON messages(user_id, ts);
+CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages(user_id, id);
 
 CREATE UNIQUE INDEX IF NOT EXISTS ux_messages_sid_dir
   ON messages(msg_sid, direction) WHERE msg_sid IS NOT NULL;
+
+CREATE TABLE IF NOT EXISTS summaries (
+  user_id TEXT PRIMARY KEY,
+  summary TEXT NOT NULL,
+  upto_id INTEGER NOT NULL,
+  turns INTEGER NOT NULL DEFAULT 0,
+  updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Check-ins du matin : une ligne par utilisateur et jour local (core.scheduler)
+CREATE TABLE IF NOT EXISTS checkins (
+  user_id TEXT NOT NULL,
+  day TEXT NOT NULL,
+  state TEXT NOT NULL CHECK(state IN ('sending','sent','failed','skipped')),
+  attempts INTEGER NOT NULL DEFAULT 1,
+  tw_sid TEXT,
+  last_error TEXT,
+  updated_at REAL NOT NULL,
+  PRIMARY KEY (user_id, day)
+);
+
+-- Rappel long terme : index plein texte tenu à jour par triggers (core.memory)
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+  user_id, text, content='messages', content_rowid='id',
+  tokenize='unicode61 remove_diacritics 2'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts_vocab USING fts5vocab(messages_fts, 'row');
+
+CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+  INSERT INTO messages_fts(rowid, user_id, text) VALUES (new.id, new.user_id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+  INSERT INTO messages_fts(messages_fts, rowid, user_id, text)
+  VALUES ('delete', old.id, old.user_id, old.text);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF user_id, text ON messages BEGIN
+  INSERT INTO messages_fts(messages_fts, rowid, user_id, text)
+  VALUES ('delete', old.id, old.user_id, old.text);
+  INSERT INTO messages_fts(rowid, user_id, text) VALUES (new.id, new.user_id, new.text);
+END;
+
+-- Envois sortants (core.outbox) : file durable, ordre par destinataire
+CREATE TABLE IF NOT EXISTS outbox (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  to_addr TEXT NOT NULL,
+  body TEXT NOT NULL,
+  user_id TEXT,
+  ref_text TEXT,
+  state TEXT NOT NULL DEFAULT 'queued' CHECK(state IN ('queued','sending','sent','dead')),
+  attempts INTEGER NOT NULL DEFAULT 0,
+  run_at REAL NOT NULL,
+  lease_until REAL,
+  owner TEXT,
+  tw_sid TEXT,
+  last_error TEXT,
+  t0 REAL,
+  created_at REAL NOT NULL,
+  updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_state_run ON outbox(state, run_at);
+CREATE INDEX IF NOT EXISTS idx_outbox_to ON outbox(to_addr, id);
+
+-- Débit du numéro expéditeur partagé entre process (GCRA) + pause après un 429
+CREATE TABLE IF NOT EXISTS outbox_rate (
+  id INTEGER PRIMARY KEY CHECK (id = 1),
+  tat REAL NOT NULL DEFAULT 0,
+  pause_until REAL NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO outbox_rate (id) VALUES (1);
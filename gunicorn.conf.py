@@ -0,0 +1,38 @@
+# gunicorn.conf.py — chargé automatiquement par `gunicorn app:app`
+# Hooks de cycle de vie des workers.
+import os, tempfile
+
+def on_starting(server):
+    # Métriques partagées entre workers (infra.monitoring → /metrics) :
+    # un répertoire neuf par démarrage du master, hérité par les workers.
+    d = os.environ.get("METRICS_DIR")
+    if d:
+        os.makedirs(d, exist_ok=True)
+        for name in os.listdir(d):  # instantanés du démarrage précédent
+            if name.endswith(".json"):
+                os.remove(os.path.join(d, name))
+    else:
+        os.environ["METRICS_DIR"] = tempfile.mkdtemp(prefix="metrics-")
+
+def child_exit(server, worker):
+    # Compteurs du worker terminé conservés (repliés dans _retired.json)
+    try:
+        from infra import monitoring
+        monitoring.retire(worker.pid)
+    except Exception as e:
+        print(f"[METRICS][retire-err] {e}", flush=True)
+
+def worker_exit(server, worker):
+    # Vide le tampon write-behind de core.memory avant la sortie du worker
+    try:
+        import core
+        n = core.flush_memory()
+        if n:
+            print(f"[MEM] flush à l'arrêt: {n} lignes", flush=True)
+    except Exception as e:
+        print(f"[MEM][flush-err] {e}", flush=True)
+    try:
+        from infra import monitoring
+        monitoring.flush()
+    except Exception as e:
+        print(f"[METRICS][flush-err] {e}", flush=True)
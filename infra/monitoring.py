@@ -1,6 +1,9 @@
 # infra/monitoring.py
 
+import bisect as _bisect
 import json
+import os as _os
+import threading as _threading
 import time
 
 def health_payload(instance_label: str):
@@ -16,3 +19,263 @@ def now() -> float:
 def log_json(event: str, **fields):
     obj = {"event": event, **fields}
     print(json.dumps(obj, ensure_ascii=False), flush=True)
+
+# ---------- Compteurs en process ----------
+_counters = {}
+_counters_lock = _threading.Lock()
+
+def incr(name: str, n: int = 1):
+    with _counters_lock:
+        _counters[name] = _counters.get(name, 0) + n
+    _ensure_flusher()
+
+def counters() -> dict:
+    with _counters_lock:
+        return dict(_counters)
+
+# ---------- Histogrammes (durées, ms) ----------
+# Seaux fixes (bornes hautes, ms) : un observe() = un bisect + un verrou, sans
+# allocation ; p50/p95/p99 sont interpolés dans les seaux (bornés par le max).
+BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+_observed = {}  # (nom, ((label, valeur), ...)) -> [comptes par seau, somme, nb, max]
+
+def observe(name: str, value: float, **labels):
+    key = (name, tuple(sorted(labels.items())) if labels else ())
+    i = _bisect.bisect_left(BUCKETS_MS, value)
+    with _counters_lock:
+        o = _observed.get(key)
+        if o is None:
+            o = _observed[key] = [[0] * (len(BUCKETS_MS) + 1), 0.0, 0, 0.0]
+        o[0][i] += 1
+        o[1] += value
+        o[2] += 1
+        if value > o[3]:
+            o[3] = value
+    _ensure_flusher()
+
+class span:
+    """with span("llm"): ...  → durée observée dans stage_ms{stage="llm"}."""
+    __slots__ = ("stage", "t0")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe("stage_ms", (time.perf_counter() - self.t0) * 1000, stage=self.stage)
+        return False
+
+def _quantile(counts, count: int, vmax: float, q: float) -> float:
+    rank = q * count
+    seen = 0
+    for i, c in enumerate(counts):
+        if c and seen + c >= rank:
+            lo = BUCKETS_MS[i - 1] if i > 0 else 0.0
+            hi = BUCKETS_MS[i] if i < len(BUCKETS_MS) else vmax
+            return min(lo + (hi - lo) * (rank - seen) / c, vmax)
+        seen += c
+    return vmax
+
+def _label_str(labels) -> str:
+    return ",".join(f"{k}={v}" for k, v in labels)
+
+def _summarize(hists) -> dict:
+    out = {}
+    for (name, labels), (counts, total, count, vmax) in sorted(hists.items()):
+        if not count:
+            continue
+        out[name + (f"{{{_label_str(labels)}}}" if labels else "")] = {
+            "count": count,
+            "avg": round(total / count, 1),
+            "p50": round(_quantile(counts, count, vmax, 0.50), 1),
+            "p95": round(_quantile(counts, count, vmax, 0.95), 1),
+            "p99": round(_quantile(counts, count, vmax, 0.99), 1),
+            "max": round(vmax, 1),
+        }
+    return out
+
+def observations(all_workers: bool = False) -> dict:
+    """count/avg/p50/p95/p99/max par mesure ; all_workers : agrégé sur METRICS_DIR."""
+    if all_workers:
+        return _summarize(_aggregate()[1])
+    with _counters_lock:
+        hists = {k: (list(o[0]), o[1], o[2], o[3]) for k, o in _observed.items()}
+    return _summarize(hists)
+
+# ---------- Agrégation entre workers gunicorn ----------
+# Chaque process écrit son instantané dans METRICS_DIR/<pid>.json (toutes les
+# METRICS_FLUSH s, et à la demande) ; /metrics additionne les fichiers. Un
+# worker mort est replié dans _retired.json : les compteurs restent monotones.
+
+METRICS_FLUSH_S = float(_os.getenv("METRICS_FLUSH", "5"))
+try:
+    import fcntl as _fcntl
+except ImportError:  # Windows (dev local) : pas de verrou de répertoire
+    _fcntl = None
+
+_flusher_pid = None
+
+def metrics_dir():
+    return _os.getenv("METRICS_DIR") or None
+
+def _snapshot() -> dict:
+    with _counters_lock:
+        return {
+            "counters": dict(_counters),
+            "hists": [[name, list(labels), list(o[0]), o[1], o[2], o[3]] for (name, labels), o in _observed.items()],
+        }
+
+def _write_json(path: str, obj):
+    tmp = f"{path}.{_os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(obj, f)
+    _os.replace(tmp, path)
+
+def flush():
+    """Écrit l'instantané de ce process dans METRICS_DIR (no-op sans METRICS_DIR)."""
+    d = metrics_dir()
+    if not d:
+        return
+    try:
+        _os.makedirs(d, exist_ok=True)
+        _write_json(_os.path.join(d, f"{_os.getpid()}.json"), _snapshot())
+    except OSError as e:
+        print(f"[METRICS][flush-err] {e}", flush=True)
+
+def _flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_S)
+        flush()
+
+def _ensure_flusher():
+    global _flusher_pid
+    if _flusher_pid == _os.getpid() or not metrics_dir():
+        return
+    with _counters_lock:
+        if _flusher_pid == _os.getpid():
+            return
+        _flusher_pid = _os.getpid()
+    _threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True).start()
+
+def _merge(acc_counters: dict, acc_hists: dict, snap: dict):
+    for k, v in snap.get("counters", {}).items():
+        acc_counters[k] = acc_counters.get(k, 0) + v
+    for name, labels, counts, total, count, vmax in snap.get("hists", []):
+        key = (name, tuple(tuple(x) for x in labels))
+        o = acc_hists.get(key)
+        if o is None:
+            acc_hists[key] = [list(counts), total, count, vmax]
+        else:
+            o[0] = [a + b for a, b in zip(o[0], counts)]
+            o[1] += total
+            o[2] += count
+            o[3] = max(o[3], vmax)
+
+def _read_json(path: str) -> dict:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _alive(pid: int) -> bool:
+    try:
+        _os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+
+class _DirLock:
+    def __init__(self, d: str):
+        self.path = _os.path.join(d, ".lock")
+
+    def __enter__(self):
+        self.f = open(self.path, "a")
+        if _fcntl is not None:
+            _fcntl.flock(self.f, _fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        self.f.close()  # libère le verrou
+        return False
+
+def retire(pid: int):
+    """Replie l'instantané d'un worker terminé dans _retired.json (hook gunicorn child_exit)."""
+    d = metrics_dir()
+    if not d:
+        return
+    path = _os.path.join(d, f"{pid}.json")
+    if not _os.path.exists(path):
+        return
+    with _DirLock(d):
+        snap = _read_json(path)
+        retired_path = _os.path.join(d, "_retired.json")
+        c, h = {}, {}
+        _merge(c, h, _read_json(retired_path))
+        _merge(c, h, snap)
+        _write_json(retired_path, {"counters": c, "hists": [[n, list(l), o[0], o[1], o[2], o[3]]
+                                                            for (n, l), o in h.items()]})
+        try:
+            _os.remove(path)
+        except OSError:
+            pass
+
+def _aggregate():
+    """(compteurs, histogrammes) additionnés sur tous les workers (ou ce process seul)."""
+    d = metrics_dir()
+    if not d:
+        snap = _snapshot()
+        c, h = {}, {}
+        _merge(c, h, snap)
+        return c, h
+    flush()
+    c, h = {}, {}
+    for name in sorted(_os.listdir(d)):
+        if not name.endswith(".json"):
+            continue
+        if name != "_retired.json":
+            pid = int(name[:-5]) if name[:-5].isdigit() else None
+            if pid is not None and not _alive(pid):
+                retire(pid)  # worker tué sans passer par child_exit
+                continue
+        # "_retired.json" est trié après les <pid>.json : lu après les retire() ci-dessus
+        _merge(c, h, _read_json(_os.path.join(d, name)))
+    return c, h
+
+# ---------- Format texte Prometheus ----------
+METRICS_PREFIX = _os.getenv("METRICS_PREFIX", "wa")
+
+def _prom_escape(v) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _prom_labels(labels, le=None) -> str:
+    parts = [f'{k}="{_prom_escape(v)}"' for k, v in labels]
+    if le is not None:
+        parts.append(f'le="{le}"')
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def prometheus_text() -> str:
+    """Compteurs et histogrammes de tous les workers, au format d'exposition Prometheus."""
+    c, h = _aggregate()
+    lines = []
+    for name in sorted(c):
+        metric = f"{METRICS_PREFIX}_{name}_total"
+        lines += [f"# TYPE {metric} counter", f"{metric} {c[name]}"]
+    typed = set()
+    for (name, labels), (counts, total, count, _vmax) in sorted(h.items()):
+        metric = f"{METRICS_PREFIX}_{name}"
+        if metric not in typed:
+            typed.add(metric)
+            lines.append(f"# TYPE {metric} histogram")
+        cum = 0
+        for bound, n in zip(BUCKETS_MS + ("+Inf",), counts):
+            cum += n
+            lines.append(f"{metric}_bucket{_prom_labels(labels, bound)} {cum}")
+        lines.append(f"{metric}_sum{_prom_labels(labels)} {round(total, 3)}")
+        lines.append(f"{metric}_count{_prom_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
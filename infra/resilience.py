@@ -0,0 +1,215 @@
+# infra/resilience.py — disjoncteur + limite de concurrence adaptative (AIMD)
+# pour les appels sortants (OpenAI, Twilio). Pendant un incident amont :
+#   - le disjoncteur s'ouvre après BREAKER_FAILURES échecs consécutifs : les
+#     appels échouent tout de suite (Unavailable) pendant le cooldown, puis UNE
+#     sonde passe (half-open) ; succès → refermé, échec → rouvert (cooldown x2) ;
+#   - la limite de concurrence grandit de +1 par "fenêtre" d'appels rapides et
+#     réussis, et est multipliée par LIMIT_BACKOFF sur échec ou latence > cible.
+#     Au-delà : rejet immédiat, pas de file d'attente qui grossit sans borne.
+# L'appelant attrape Unavailable et répond par un message de repli.
+import os, time, threading
+from typing import Callable, Dict, Optional
+
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN_S = float(os.getenv("BREAKER_COOLDOWN", "15"))
+BREAKER_COOLDOWN_MAX_S = float(os.getenv("BREAKER_COOLDOWN_MAX", "120"))
+LIMIT_INITIAL = float(os.getenv("LIMIT_INITIAL", "8"))
+LIMIT_MIN = float(os.getenv("LIMIT_MIN", "1"))
+LIMIT_MAX = float(os.getenv("LIMIT_MAX", "64"))
+LIMIT_BACKOFF = float(os.getenv("LIMIT_BACKOFF", "0.7"))
+
+class Unavailable(Exception):
+    """Appel refusé sans être tenté (disjoncteur ouvert ou limite atteinte)."""
+
+    def __init__(self, message: str = "", breaker: bool = False):
+        super().__init__(message)
+        self.breaker = breaker  # True : disjoncteur ouvert ; False : limite de concurrence
+
+class CircuitBreaker:
+    def __init__(self, failures: int = BREAKER_FAILURES, cooldown_s: float = BREAKER_COOLDOWN_S,
+                 cooldown_max_s: float = BREAKER_COOLDOWN_MAX_S):
+        self.failures = max(1, failures)
+        self.base_cooldown_s = cooldown_s
+        self.cooldown_max_s = cooldown_max_s
+        self.cooldown_s = cooldown_s
+        self.state = "closed"  # closed | open | half_open
+        self._consecutive = 0
+        self._opened_at = 0.0
+        self._probe = False
+        self._lock = threading.Lock()
+        self.opened = 0
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self._opened_at >= self.cooldown_s:
+                self.state = "half_open"
+                self._probe = False
+            if self.state == "half_open" and not self._probe:
+                self._probe = True  # une seule sonde à la fois
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self._consecutive = 0
+            if self.state != "closed":
+                self.state = "closed"
+                self.cooldown_s = self.base_cooldown_s
+
+    def failure(self):
+        with self._lock:
+            self._consecutive += 1
+            if self.state == "half_open":
+                self.cooldown_s = min(self.cooldown_s * 2, self.cooldown_max_s)
+                self._open()
+            elif self.state == "closed" and self._consecutive >= self.failures:
+                self._open()
+
+    def cancel_probe(self):
+        """La sonde réservée par allow() n'a pas été tentée."""
+        with self._lock:
+            self._probe = False
+
+    def _open(self):
+        # Appelant : _lock tenu
+        self.state = "open"
+        self._opened_at = time.monotonic()
+        self._probe = False
+        self.opened += 1
+
+class AdaptiveLimiter:
+    """Limite de concurrence AIMD ; la latence cible sert de signal de congestion."""
+
+    def __init__(self, target_s: float, initial: float = LIMIT_INITIAL,
+                 min_limit: float = LIMIT_MIN, max_limit: float = LIMIT_MAX):
+        self.target_s = target_s
+        self.initial = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = min(max(initial, min_limit), max_limit)
+        self.inflight = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self.inflight >= int(self.limit):
+                self.rejected += 1
+                return False
+            self.inflight += 1
+            return True
+
+    def release(self, latency_s: float, ok: bool):
+        with self._lock:
+            self.inflight -= 1
+            if ok and latency_s <= self.target_s:
+                # +1 par "limit" appels réussis : croissance additive
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            else:
+                self.limit = max(self.min_limit, self.limit * LIMIT_BACKOFF)
+
+class Upstream:
+    """Disjoncteur + limiteur autour d'une dépendance externe."""
+
+    def __init__(self, name: str, target_s: float,
+                 is_failure: Optional[Callable[[BaseException], bool]] = None,
+                 initial: float = LIMIT_INITIAL, max_limit: float = LIMIT_MAX):
+        self.name = name
+        self.breaker = CircuitBreaker()
+        self.limiter = AdaptiveLimiter(target_s, initial, LIMIT_MIN, max_limit)
+        self.is_failure = is_failure or (lambda e: True)
+        self.calls = 0
+        self.errors = 0
+        self.short_circuited = 0
+
+    def call(self, fn: Callable, *args, **kwargs):
+        if not self.breaker.allow():
+            self.short_circuited += 1
+            raise Unavailable(f"{self.name}: disjoncteur ouvert", breaker=True)
+        if not self.limiter.try_acquire():
+            self.breaker.cancel_probe()
+            raise Unavailable(f"{self.name}: limite de concurrence ({int(self.limiter.limit)}) atteinte")
+        self.calls += 1
+        t0 = time.monotonic()
+        try:
+            res = fn(*args, **kwargs)
+        except BaseException as e:
+            failed = self.is_failure(e)
+            self.limiter.release(time.monotonic() - t0, not failed)
+            if failed:
+                self.errors += 1
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+            raise
+        self.limiter.release(time.monotonic() - t0, True)
+        self.breaker.success()
+        return res
+
+    async def acall(self, fn: Callable, *args, **kwargs):
+        """Comme call(), pour une coroutine (serveur asyncio)."""
+        if not self.breaker.allow():
+            self.short_circuited += 1
+            raise Unavailable(f"{self.name}: disjoncteur ouvert", breaker=True)
+        if not self.limiter.try_acquire():
+            self.breaker.cancel_probe()
+            raise Unavailable(f"{self.name}: limite de concurrence ({int(self.limiter.limit)}) atteinte")
+        self.calls += 1
+        t0 = time.monotonic()
+        try:
+            res = await fn(*args, **kwargs)
+        except BaseException as e:
+            failed = self.is_failure(e)
+            self.limiter.release(time.monotonic() - t0, not failed)
+            if failed:
+                self.errors += 1
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+            raise
+        self.limiter.release(time.monotonic() - t0, True)
+        self.breaker.success()
+        return res
+
+    def stats(self) -> Dict:
+        return {
+            "state": self.breaker.state,
+            "opened": self.breaker.opened,
+            "limit": round(self.limiter.limit, 1),
+            "inflight": self.limiter.inflight,
+            "rejected": self.limiter.rejected,
+            "calls": self.calls,
+            "errors": self.errors,
+            "short_circuited": self.short_circuited,
+        }
+
+_upstreams = {}
+_lock = threading.Lock()
+
+def upstream(name: str, target_s: float = 5.0,
+             is_failure: Optional[Callable[[BaseException], bool]] = None,
+             initial: float = LIMIT_INITIAL, max_limit: float = LIMIT_MAX) -> Upstream:
+    """Instance partagée (par process) pour la dépendance `name`."""
+    with _lock:
+        u = _upstreams.get(name)
+        if u is None:
+            u = _upstreams[name] = Upstream(name, target_s, is_failure, initial, max_limit)
+        return u
+
+def stats() -> Dict:
+    with _lock:
+        return {name: u.stats() for name, u in _upstreams.items()}
+
+def _reset_after_fork():
+    # État propre par worker gunicorn (verrous éventuellement tenus au fork)
+    global _lock
+    _lock = threading.Lock()
+    for u in _upstreams.values():
+        u.breaker = CircuitBreaker()
+        lim = u.limiter
+        u.limiter = AdaptiveLimiter(lim.target_s, lim.initial, lim.min_limit, lim.max_limit)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,111 @@
+# infra/startup.py — profil de démarrage, préchauffage optionnel et disponibilité (/ready)
+# - mark(nom) : durée de chaque phase du démarrage (imports, bootstrap DB...) ;
+# - step(nom, fn) : étape de préchauffage (connexions DB, prompts, clients HTTP),
+#   exécutée dans un thread de fond si WARMUP=1 ; une étape en échec est
+#   journalisée sans bloquer la disponibilité ;
+# - status() : /ready répond 503 tant que le démarrage (et le préchauffage, au
+#   plus WARMUP_TIMEOUT s) n'est pas fini ; /health reste instantané et sert de
+#   health check (liveness) à la plateforme.
+# Module sans dépendance lourde : importé avant tout le reste.
+import os, time, threading
+
+ENABLED = os.getenv("WARMUP", "0") == "1"
+WARMUP_HTTP = os.getenv("WARMUP_HTTP", "1") == "1"  # ouvre aussi les connexions HTTP (requête GET légère)
+# /ready passe à 200 au plus tard après ce délai, même si une étape traîne encore
+WARMUP_TIMEOUT_S = float(os.getenv("WARMUP_TIMEOUT", "15"))
+
+_t_last = time.perf_counter()
+_phases = {}      # phase de démarrage -> ms
+_steps = []       # [(nom, fn)] étapes de préchauffage
+_expected = []    # étapes signalées par record() (ex. client async créé dans la boucle)
+_warm = {}        # étape -> {"ms": ..., "error": ...}
+_state = {"pid": os.getpid(), "imported": False, "warmup": "off", "process_ms": None}
+_lock = threading.Lock()
+
+def _process_age_ms():
+    # Linux : âge du process (interpréteur compris) depuis /proc
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return round((uptime - start_ticks / os.sysconf("SC_CLK_TCK")) * 1000)
+    except Exception:
+        return None
+
+def mark(phase: str):
+    """Clôt une phase du démarrage (durée depuis la marque précédente)."""
+    global _t_last
+    now = time.perf_counter()
+    with _lock:
+        _phases[phase] = round((now - _t_last) * 1000, 1)
+        _t_last = now
+
+def step(name: str, fn):
+    _steps.append((name, fn))
+
+def expect(name: str):
+    """Étape signalée de l'extérieur par record() (ex. depuis une boucle asyncio)."""
+    _expected.append(name)
+
+def record(name: str, ms: float, error=None):
+    with _lock:
+        _warm[name] = {"ms": round(ms, 1), "error": str(error)[:200] if error else None}
+        _check_done()
+
+def _check_done():
+    # Appelant : _lock tenu
+    if _state["warmup"] in ("running", "timeout") and all(n in _warm for n, _ in _steps) \
+            and all(n in _warm for n in _expected):
+        _state["warmup"] = "done"
+        _state["warm_done_ms"] = _process_age_ms()
+        print(f"[STARTUP] préchauffage fini {_warm}", flush=True)
+
+def _run_steps():
+    for name, fn in _steps:
+        t0 = time.perf_counter()
+        err = None
+        try:
+            fn()
+        except Exception as e:
+            err = e
+            print(f"[STARTUP][warmup-err] {name}: {e}", flush=True)
+        record(name, (time.perf_counter() - t0) * 1000, err)
+
+def ready_after_import():
+    """Fin du chargement du module applicatif : journalise le profil et lance le préchauffage."""
+    from infra.monitoring import log_json
+    with _lock:
+        _state.update(pid=os.getpid(), imported=True, process_ms=_process_age_ms())
+        if ENABLED:
+            _state["warmup"] = "running"
+            _state["warm_started"] = time.monotonic()
+            _warm.clear()
+            _check_done()
+    log_json("startup", phases=dict(_phases), process_ms=_state["process_ms"], warmup=_state["warmup"])
+    if ENABLED:
+        threading.Thread(target=_run_steps, name="warmup", daemon=True).start()
+
+def status() -> dict:
+    with _lock:
+        restart = ENABLED and _state["imported"] and _state["pid"] != os.getpid()
+        if restart:
+            # fork après l'import (gunicorn --preload) : préchauffer ce worker, une
+            # seule fois même si deux requêtes arrivent ensemble
+            _state["pid"] = os.getpid()
+    if restart:
+        ready_after_import()
+    with _lock:
+        if (_state["warmup"] == "running"
+                and time.monotonic() - _state.get("warm_started", 0.0) > WARMUP_TIMEOUT_S):
+            _state["warmup"] = "timeout"  # étape lente : prêt quand même, elle finit en fond
+            print(f"[STARTUP] préchauffage > {WARMUP_TIMEOUT_S}s, prêt sans attendre {_warm}", flush=True)
+        return {
+            "ready": _state["imported"] and _state["warmup"] in ("off", "done", "timeout"),
+            "warmup": _state["warmup"],
+            "startup_ms": dict(_phases),
+            "process_ms": _state["process_ms"],
+            "warm_done_ms": _state.get("warm_done_ms"),
+            "steps": dict(_warm),
+            "pending": [n for n, _ in _steps if n not in _warm] + [n for n in _expected if n not in _warm],
+        }
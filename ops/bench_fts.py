@@ -0,0 +1,105 @@
+# ops/bench_fts.py — rappel long terme (FTS5) sur une grosse DB synthétique
+# Usage: python ops/bench_fts.py [n_rows] [n_users] [db_path]
+# (db_path : DB conservée et réutilisée d'un lancement à l'autre si elle existe)
+# Remplit messages (donc messages_fts via les triggers) puis mesure
+# memory.search_history pour des utilisateurs "lourds" et "légers", ainsi que
+# le surcoût d'indexation à l'insertion (lots du group commit).
+
+import os, sys, time, random, tempfile, itertools
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from core import memory  # noqa: E402
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+USERS = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+KEEP = sys.argv[3] if len(sys.argv) > 3 else None
+BATCH = 5000
+
+random.seed(7)
+# vocabulaire zipfien : quelques mots très fréquents, une longue traîne de rares
+VOCAB = [f"mot{i}" for i in range(20000)] + [
+    "sommeil", "fatigue", "travail", "projet", "sport", "course", "anniversaire",
+    "médecin", "voyage", "lisbonne", "budget", "déménagement", "entretien", "stress",
+]
+CUM = list(itertools.accumulate(1.0 / (i + 1) for i in range(len(VOCAB))))
+
+def _user(i):
+    # 1 % des utilisateurs écrivent ~30 % des messages
+    heavy = USERS // 100 or 1
+    return f"whatsapp:+336{(i % heavy if random.random() < 0.3 else random.randrange(USERS)):08d}"
+
+def _text():
+    return " ".join(random.choices(VOCAB, cum_weights=CUM, k=random.randint(4, 16)))
+
+def _pct(xs, p):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(len(xs) * p))]
+
+def _fill(path):
+    memory.DB_PATH = path
+    memory.bootstrap_memory()
+    t0 = time.perf_counter()
+    for start in range(0, N, BATCH):
+        rows = [(_user(i), "IN" if i % 2 == 0 else "OUT", _text(), None)
+                for i in range(start, min(N, start + BATCH))]
+        with memory.write_tx() as c:
+            c.executemany(memory._INSERT_SQL, rows)
+    dt = time.perf_counter() - t0
+    print(f"remplissage {N} lignes / {USERS} utilisateurs : {dt:.1f}s "
+          f"({dt / N * 1e6:.1f}µs/ligne, index FTS inclus)", flush=True)
+
+def _insert_cost(path):
+    # Coût marginal par ligne de l'index FTS : lots de 64 lignes (group commit),
+    # sur deux DB jetables (l'une sans le trigger FTS) via l'API publique write_tx
+    with tempfile.TemporaryDirectory() as d:
+        for label, fts in (("sans FTS", False), ("avec FTS", True)):
+            memory.DB_PATH = os.path.join(d, f"insert_{int(fts)}.db")
+            memory.bootstrap_memory()
+            if not fts:
+                with memory.write_tx() as c:
+                    c.execute("DROP TRIGGER messages_fts_ai")
+            with memory.write_tx() as c:  # index non vide avant la mesure
+                c.executemany(memory._INSERT_SQL, [("warm", "IN", _text(), None) for _ in range(BATCH)])
+            t0 = time.perf_counter()
+            for _ in range(50):
+                with memory.write_tx() as c:
+                    c.executemany(memory._INSERT_SQL, [("bench", "IN", _text(), None) for _ in range(64)])
+            dt = time.perf_counter() - t0
+            print(f"insertion {label:<9} {dt / 3200 * 1e6:.1f}µs/ligne (commit inclus)", flush=True)
+        memory.close_pool()
+    memory.DB_PATH = path
+
+def _search(label, users, queries=300):
+    # 1er passage : cache des fréquences de termes (df) froid ; 2e : régime établi
+    qs = [(random.choice(users),
+           " ".join(random.choices(VOCAB[:2000], k=6) + random.choices(VOCAB[-14:], k=2)))
+          for _ in range(queries)]
+    for phase in ("froid", "chaud"):
+        lat, hits = [], 0
+        for (u, q) in qs:
+            t0 = time.perf_counter()
+            hits += len(memory.search_history(u, q, 5))
+            lat.append((time.perf_counter() - t0) * 1000)
+        print(f"search {label:<7} {phase:<6} p50={_pct(lat, 0.5):.2f}ms p95={_pct(lat, 0.95):.2f}ms "
+              f"p99={_pct(lat, 0.99):.2f}ms  résultats/requête={hits / queries:.1f}", flush=True)
+
+def _main(path):
+    if os.path.exists(path):
+        memory.DB_PATH = path
+        memory.bootstrap_memory()
+    else:
+        _fill(path)
+    heavy = [f"whatsapp:+336{i:08d}" for i in range(USERS // 100 or 1)]
+    light = [f"whatsapp:+336{i:08d}" for i in range(USERS // 2, USERS)]
+    _search("lourds", heavy)
+    _search("légers", light)
+    _insert_cost(path)
+    print(f"taille DB : {os.path.getsize(path) / 1e6:.0f} Mo", flush=True)
+    memory.close_pool()
+
+if __name__ == "__main__":
+    if KEEP:
+        _main(KEEP)
+    else:
+        with tempfile.TemporaryDirectory() as d:
+            _main(os.path.join(d, "bench_fts.db"))
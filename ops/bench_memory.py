@@ -0,0 +1,156 @@
+# ops/bench_memory.py — coût DB par message (motif de core.process_incoming)
+# Usage: python ops/bench_memory.py [n_messages]
+# Compare l'ancien "connect par appel" au pool de connexions persistantes,
+# puis le débit sous N utilisateurs concurrents (verrou global vs lecteurs WAL),
+# en threads d'un même process puis en process (workers gunicorn) sur la même DB,
+# puis le débit d'insertion avec et sans group commit (DB_GROUP_COMMIT_MS),
+# puis la lecture d'historique "conversation chaude" avec et sans cache LRU.
+
+import os, sys, time, sqlite3, tempfile, threading, multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from core import memory  # noqa: E402
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+def _legacy_conn(path):
+    conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    return conn
+
+def _legacy_turn(path, user_id, i):
+    # IN + historique + OUT, une connexion neuve par appel (avant user-001)
+    with _legacy_conn(path) as c:
+        c.execute("INSERT INTO messages (user_id, direction, text) VALUES (?,?,?)", (user_id, "IN", f"msg {i}"))
+    with _legacy_conn(path) as c:
+        c.execute("SELECT direction, text FROM messages WHERE user_id=? ORDER BY id DESC LIMIT ?", (user_id, 10)).fetchall()
+    with _legacy_conn(path) as c:
+        c.execute("INSERT INTO messages (user_id, direction, text) VALUES (?,?,?)", (user_id, "OUT", f"rep {i}"))
+
+def _pooled_turn(path, user_id, i):
+    memory.add_message(user_id, "IN", f"msg {i}")
+    memory.get_history(user_id, 10)
+    memory.add_message(user_id, "OUT", f"rep {i}")
+
+def _run(label, turn):
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "bench.db")
+        memory.DB_PATH = path
+        memory.bootstrap_memory()
+        t0 = time.perf_counter()
+        for i in range(N):
+            turn(path, f"u{i % 50}", i)
+        dt = time.perf_counter() - t0
+        memory.close_pool()
+    print(f"{label:<10} {N} tours  total={dt:.3f}s  par_message={dt / N * 1e6:.0f}µs", flush=True)
+    return dt
+
+_global_lock = threading.Lock()
+
+def _locked_turn(path, user_id, i):
+    # Émule l'ancien _lock process-wide autour de chaque appel
+    with _global_lock:
+        memory.add_message(user_id, "IN", f"msg {i}")
+    with _global_lock:
+        memory.get_history(user_id, 10)
+    with _global_lock:
+        memory.add_message(user_id, "OUT", f"rep {i}")
+
+def _read_heavy(turn):
+    # Un webhook relit l'historique plus souvent qu'il n'écrit (prompt, logs, ...)
+    def _t(path, user_id, i):
+        turn(path, user_id, i)
+        for _ in range(4):
+            if turn is _locked_turn:
+                with _global_lock:
+                    memory.get_history(user_id, 10)
+            else:
+                memory.get_history(user_id, 10)
+    return _t
+
+def _run_concurrent(label, turn, workers):
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "bench.db")
+        memory.DB_PATH = path
+        memory.POOL_SIZE = workers + 1
+        memory.bootstrap_memory()
+        # historique préexistant, pour des lectures réalistes
+        for u in range(workers * 4):
+            for k in range(20):
+                memory.add_message(f"u{u}", "IN" if k % 2 == 0 else "OUT", "x" * 200)
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            list(ex.map(lambda i: turn(path, f"u{i % (workers * 4)}", i), range(N)))
+        dt = time.perf_counter() - t0
+        memory.close_pool()
+    print(f"{label:<10} workers={workers:<2} {N / dt:8.0f} tours/s", flush=True)
+
+def _proc_turns(args):
+    # Un worker gunicorn : son propre pool, son writer, son cache
+    path, p, n = args
+    memory.DB_PATH = path
+    turn = _read_heavy(_pooled_turn)
+    for i in range(n):
+        turn(path, f"p{p}u{i % 20}", i)
+    memory.flush()
+
+def _run_processes(procs):
+    # Même nombre de tours par process : le débit total doit croître avec les process
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "bench.db")
+        memory.DB_PATH = path
+        memory.bootstrap_memory()
+        memory.close_pool()
+        ctx = multiprocessing.get_context("spawn")
+        with ctx.Pool(procs) as pool:
+            pool.map(_proc_turns, [(path, p, 20) for p in range(procs)])  # imports, connexions
+            t0 = time.perf_counter()
+            pool.map(_proc_turns, [(path, p, N) for p in range(procs)])
+            dt = time.perf_counter() - t0
+    print(f"process={procs:<2} {N * procs / dt:8.0f} tours/s", flush=True)
+
+def _run_inserts(group_ms, workers):
+    with tempfile.TemporaryDirectory() as d:
+        memory.DB_PATH = os.path.join(d, "bench.db")
+        memory.GROUP_COMMIT_MS = group_ms
+        memory.bootstrap_memory()
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            list(ex.map(lambda i: memory.add_message(f"u{i % 100}", "IN", f"msg {i}"), range(N * 4)))
+        memory.flush()
+        dt = time.perf_counter() - t0
+        memory.close_pool()
+    print(f"group_ms={group_ms:<4} workers={workers:<2} {N * 4 / dt:8.0f} inserts/s", flush=True)
+
+def _run_warm_reads(cache_users):
+    with tempfile.TemporaryDirectory() as d:
+        memory.DB_PATH = os.path.join(d, "bench.db")
+        memory._cache.max_users = cache_users
+        memory._cache.invalidate()
+        memory._cache.hits = memory._cache.misses = 0
+        memory.bootstrap_memory()
+        for k in range(40):
+            memory.add_message("u0", "IN" if k % 2 == 0 else "OUT", "x" * 200)
+        t0 = time.perf_counter()
+        for _ in range(N * 4):
+            memory.get_history("u0", 10)
+        dt = time.perf_counter() - t0
+        memory.close_pool()
+    print(f"cache_users={cache_users:<5} get_history={dt / (N * 4) * 1e6:.1f}µs  {memory.history_cache_stats()}", flush=True)
+
+if __name__ == "__main__":
+    a = _run("legacy", _legacy_turn)
+    b = _run("pool", _pooled_turn)
+    print(f"gain x{a / b:.1f}", flush=True)
+    for w in (1, 2, 4, 8):
+        _run_concurrent("lock", _read_heavy(_locked_turn), w)
+        _run_concurrent("wal", _read_heavy(_pooled_turn), w)
+    for p in (1, 2, 4, 8):
+        _run_processes(p)
+    for w in (1, 4, 8):
+        _run_inserts(0, w)
+        _run_inserts(5, w)
+    _run_warm_reads(0)
+    _run_warm_reads(1000)
@@ -0,0 +1,116 @@
+# ops/fakes.py — faux OpenAI et Twilio locaux pour les bancs de charge
+# Latence (ms, ± jitter) et taux d'erreurs injectés configurables.
+#   FakeOpenAI : POST /v1/chat/completions (réponse ou flux SSE si stream=true)
+#   FakeTwilio : POST /2010-04-01/Accounts/<sid>/Messages.json (journalise les envois)
+
+import json, time, random, threading, uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+class _Fake:
+    def __init__(self, latency_ms: float = 0, jitter: float = 0.2, error_rate: float = 0.0):
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.calls = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+    def _delay(self):
+        if self.latency_ms > 0:
+            j = random.uniform(1 - self.jitter, 1 + self.jitter) if self.jitter else 1
+            time.sleep(self.latency_ms * j / 1000)
+
+    def _fail(self) -> bool:
+        with self.lock:
+            self.calls += 1
+            if self.error_rate and random.random() < self.error_rate:
+                self.errors += 1
+                return True
+        return False
+
+    def start(self, port: int = 0) -> int:
+        fake = self
+
+        class H(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *a):
+                pass
+
+            def do_POST(self):
+                n = int(self.headers.get("Content-Length") or 0)
+                fake.handle(self, self.rfile.read(n))
+
+        self.server = _Server(("127.0.0.1", port), H)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server.server_address[1]
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+
+    @staticmethod
+    def _reply(h, status: int, obj: dict):
+        body = json.dumps(obj).encode()
+        h.send_response(status)
+        h.send_header("Content-Type", "application/json")
+        h.send_header("Content-Length", str(len(body)))
+        h.end_headers()
+        h.wfile.write(body)
+
+class FakeOpenAI(_Fake):
+    """Erreurs injectées : alternance 500 / 429 (le SDK réessaie selon max_retries)."""
+
+    def handle(self, h, raw: bytes):
+        req = json.loads(raw or b"{}")
+        self._delay()
+        if self._fail():
+            status = random.choice((500, 429))
+            return self._reply(h, status, {"error": {"message": "injected", "type": "server_error"}})
+        text = "ok " + str((req.get("messages") or [{}])[-1].get("content", ""))[:60]
+        if req.get("stream"):
+            h.send_response(200)
+            h.send_header("Content-Type", "text/event-stream")
+            h.send_header("Transfer-Encoding", "chunked")
+            h.end_headers()
+            for part in (text[:len(text) // 2], text[len(text) // 2:], None):
+                if part is None:
+                    b = b"data: [DONE]\n\n"
+                else:
+                    d = {"id": "x", "object": "chat.completion.chunk", "created": 0, "model": req.get("model"),
+                         "choices": [{"index": 0, "delta": {"content": part}, "finish_reason": None}]}
+                    b = f"data: {json.dumps(d)}\n\n".encode()
+                h.wfile.write(f"{len(b):x}\r\n".encode() + b + b"\r\n")
+            h.wfile.write(b"0\r\n\r\n")
+            return
+        self._reply(h, 200, {
+            "id": "x", "object": "chat.completion", "created": 0, "model": req.get("model"),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": text}}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 3, "total_tokens": 13},
+        })
+
+class FakeTwilio(_Fake):
+    """Garde (ts, To, Body) de chaque envoi réussi dans `sent`."""
+
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self.sent = []
+
+    def handle(self, h, raw: bytes):
+        form = {k: v[0] for k, v in parse_qs(raw.decode("utf-8")).items()}
+        self._delay()
+        if self._fail():
+            return self._reply(h, 500, {"code": 20500, "message": "injected", "status": 500})
+        sid = "SM" + uuid.uuid4().hex
+        with self.lock:
+            self.sent.append((time.time(), form.get("To", ""), form.get("Body", "")))
+        self._reply(h, 201, {
+            "sid": sid, "status": "queued", "to": form.get("To"), "from": form.get("From"),
+            "body": form.get("Body"), "num_segments": "1", "direction": "outbound-api",
+        })
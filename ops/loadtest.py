@@ -0,0 +1,344 @@
+# ops/loadtest.py — banc de charge hors ligne : app.app contre de faux OpenAI/Twilio
+# Usage:
+#   python ops/loadtest.py --rate 20 --duration 30                 (trafic synthétique)
+#   python ops/loadtest.py --replay trafic.jsonl --speed 2           (trafic enregistré)
+#   python ops/loadtest.py ... --out run.json --baseline base.json   (comparaison)
+# L'app tourne dans un sous-process (serveur WSGI threadé, DB et METRICS_DIR
+# temporaires) ; OpenAI et Twilio sont remplacés par ops/fakes.py (latence et
+# erreurs injectées). Le trafic part en boucle ouverte au débit visé vers
+# /whatsapp/webhook et /internal/send. Rapport : débit, p50/p95/p99 par route,
+# délai de livraison (Option A : jusqu'au faux Twilio), profondeur de file,
+# lignes en base. --baseline : écarts au-delà de --tolerance → code de sortie 1.
+# Trafic enregistré (JSONL) : {"t": s, "endpoint": "webhook"|"send", "user": "...", "text": "..."}
+
+import os, sys, json, time, random, signal, socket, sqlite3, asyncio, argparse, tempfile, subprocess, uuid
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from ops.fakes import FakeOpenAI, FakeTwilio  # noqa: E402
+
+TOKEN = "loadtest"
+TEXTS = [
+    "salut", "merci !", "ok", "tu peux me rappeler mon rendez-vous de demain ?",
+    "j'ai mal dormi, des idées pour tenir la journée ?", "quel temps pour courir ce soir ?",
+    "résume ma semaine en deux phrases", "j'hésite entre deux offres de travail",
+    "comment avancer sur mon projet de déménagement ?", "rappelle-moi ce que je t'ai dit sur Lisbonne",
+]
+
+# ---------- Sous-process : l'app ----------
+def _serve(port: int, twilio_url: str):
+    os.chdir(ROOT)
+    import app as webapp
+    from werkzeug.serving import make_server
+    if webapp._twilio_client() is not None and twilio_url:
+        webapp._twilio_client().api.base_url = twilio_url
+
+    def _stop(*_a):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, _stop)
+    srv = make_server("127.0.0.1", port, webapp.app, threaded=True)
+    srv.socket.listen(1024)
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        webapp.coreapp.flush_memory()
+
+# ---------- Trafic ----------
+def _synthetic(args) -> list:
+    rnd = random.Random(args.seed)
+    events, t = [], 0.0
+    while True:
+        t += rnd.expovariate(args.rate) if args.arrivals == "poisson" else 1.0 / args.rate
+        if t >= args.duration:
+            return events
+        events.append({
+            "t": t,
+            "endpoint": "send" if rnd.random() < args.send_ratio else "webhook",
+            "user": f"+3360{rnd.randrange(args.users):07d}",
+            "text": rnd.choice(TEXTS),
+        })
+
+def _replay(path: str, speed: float, rate: float) -> list:
+    events = []
+    with open(path, "r", encoding="utf-8") as f:
+        for i, line in enumerate(x for x in f if x.strip()):
+            e = json.loads(line)
+            user = str(e.get("user") or e.get("user_id") or e.get("from") or "+33600000000").replace("whatsapp:", "")
+            events.append({
+                "t": float(e["t"]) / speed if "t" in e else i / rate,
+                "endpoint": e.get("endpoint", "webhook"),
+                "user": user,
+                "text": e.get("text") or e.get("body") or "salut",
+            })
+    events.sort(key=lambda e: e["t"])
+    return events
+
+def _pct(xs, p):
+    xs = sorted(xs)
+    return round(xs[min(len(xs) - 1, int(len(xs) * p))], 1) if xs else 0.0
+
+def _dist(xs) -> dict:
+    return {"p50_ms": _pct(xs, 0.50), "p95_ms": _pct(xs, 0.95), "p99_ms": _pct(xs, 0.99),
+            "max_ms": round(max(xs), 1) if xs else 0.0}
+
+async def _drive(base: str, events: list, mode: str, drain_s: float) -> dict:
+    import aiohttp
+    results, samples = [], []
+    outbox_left = [0]  # envois encore en file (core.outbox), mis à jour par _sample
+    done = asyncio.Event()
+
+    async def _one(session, e, t0):
+        lag = (time.monotonic() - t0 - e["t"]) * 1000
+        sent_at = time.time()
+        t1 = time.perf_counter()
+        try:
+            if e["endpoint"] == "send":
+                r = await session.post(f"{base}/internal/send", json={"user_id": e["user"], "text": e["text"]},
+                                       headers={"X-Token": TOKEN})
+            else:
+                r = await session.post(f"{base}/whatsapp/webhook", data={
+                    "From": f"whatsapp:{e['user']}", "Body": e["text"], "MessageSid": "SM" + uuid.uuid4().hex})
+            await r.read()
+            status = r.status
+        except Exception:
+            status = 0
+        results.append({"endpoint": e["endpoint"], "user": e["user"], "status": status, "lag_ms": lag,
+                        "sent_at": sent_at, "ms": (time.perf_counter() - t1) * 1000})
+
+    async def _sample(session):
+        while not done.is_set():
+            try:
+                async with session.get(f"{base}/internal/stats", headers={"X-Token": TOKEN}) as r:
+                    st = await r.json()
+                jobs, ob = st.get("jobs", {}), st.get("outbox") or {}
+                outbox_left[0] = ob.get("depth", 0) + ob.get("sending", 0)
+                samples.append((jobs.get("depth", 0), jobs.get("running", 0)))
+            except Exception:
+                pass
+            await asyncio.sleep(0.5)
+
+    conn = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=conn, timeout=aiohttp.ClientTimeout(total=120)) as session:
+        sampler = asyncio.create_task(_sample(session))
+        t0 = time.monotonic()
+        tasks = []
+        for e in events:
+            delay = t0 + e["t"] - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(_one(session, e, t0)))
+        await asyncio.gather(*tasks)
+        wall = time.monotonic() - t0
+        # Option A : attendre que les files se vident (réponses en génération, envois en retry)
+        deadline = time.monotonic() + drain_s
+        while mode == "a" and time.monotonic() < deadline:
+            if samples and samples[-1] == (0, 0) and not outbox_left[0]:
+                break
+            await asyncio.sleep(0.5)
+        done.set()
+        await sampler
+        async with session.get(f"{base}/internal/stats", headers={"X-Token": TOKEN}) as r:
+            stats = await r.json()
+    return {"results": results, "samples": samples, "wall": wall, "stats": stats}
+
+# ---------- Rapport ----------
+def _delivery(results: list, sent: list) -> dict:
+    # 1er envoi Twilio vers l'utilisateur après chaque message reçu (lots fusionnés inclus)
+    outs = {}
+    for ts, to, _body in sorted(sent):
+        outs.setdefault(to.replace("whatsapp:", ""), []).append(ts)
+    lat, missing = [], 0
+    for r in results:
+        if r["endpoint"] != "webhook" or r["status"] != 200:
+            continue
+        nxt = next((ts for ts in outs.get(r["user"], []) if ts >= r["sent_at"]), None)
+        if nxt is None:
+            missing += 1
+        else:
+            lat.append((nxt - r["sent_at"]) * 1000)
+    return {"delivered": len(lat), "undelivered": missing, **_dist(lat)}
+
+def _db_counts(path: str) -> dict:
+    out = {"db_bytes": sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))}
+    c = sqlite3.connect(path)
+    try:
+        for d, n in c.execute("SELECT direction, COUNT(*) FROM messages GROUP BY direction"):
+            out[f"messages_{d.lower()}"] = n
+        for s, n in c.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"):
+            out[f"jobs_{s}"] = n
+    finally:
+        c.close()
+    return out
+
+def _report(args, run: dict, oai: FakeOpenAI, tw: FakeTwilio, db_path: str) -> dict:
+    res = run["results"]
+    endpoints = {}
+    for ep in ("webhook", "send"):
+        rs = [r for r in res if r["endpoint"] == ep]
+        if rs:
+            ok = [r["ms"] for r in rs if r["status"] == 200]
+            endpoints[ep] = {"count": len(rs), "ok": len(ok), "errors": len(rs) - len(ok),
+                             "rps": round(len(rs) / run["wall"], 1), **_dist(ok)}
+    depths = [d for d, _ in run["samples"]] or [0]
+    report = {
+        "scenario": {k: v for k, v in vars(args).items() if k not in ("out", "baseline", "serve")},
+        "started": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "throughput_rps": round(sum(1 for r in res if r["status"] == 200) / run["wall"], 1),
+        "client_lag_p95_ms": _pct([r["lag_ms"] for r in res], 0.95),
+        "endpoints": endpoints,
+        "queue": {"max_depth": max(depths), "avg_depth": round(sum(depths) / len(depths), 1),
+                  "max_running": max([n for _, n in run["samples"]] or [0])},
+        "db": _db_counts(db_path),
+        "fakes": {"openai_calls": oai.calls, "openai_errors": oai.errors,
+                  "twilio_calls": tw.calls, "twilio_errors": tw.errors},
+        "app": {"counters": run["stats"].get("counters", {}), "timings": run["stats"].get("timings", {})},
+    }
+    if args.mode == "a":
+        report["delivery"] = _delivery(res, tw.sent)
+    return report
+
+# (chemin, sens) : +1 plus haut = mieux, -1 plus bas = mieux ; plancher absolu du bruit
+_COMPARE = [
+    ("throughput_rps", +1, 0.5),
+    ("endpoints.webhook.p50_ms", -1, 5), ("endpoints.webhook.p95_ms", -1, 10),
+    ("endpoints.webhook.p99_ms", -1, 20), ("endpoints.webhook.errors", -1, 0),
+    ("endpoints.send.p50_ms", -1, 5), ("endpoints.send.p95_ms", -1, 10),
+    ("endpoints.send.p99_ms", -1, 20), ("endpoints.send.errors", -1, 0),
+    ("delivery.p50_ms", -1, 10), ("delivery.p95_ms", -1, 20), ("delivery.p99_ms", -1, 50),
+    ("delivery.undelivered", -1, 0), ("queue.max_depth", -1, 2),
+]
+
+def _get(d: dict, path: str):
+    for k in path.split("."):
+        if not isinstance(d, dict) or k not in d:
+            return None
+        d = d[k]
+    return d
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list:
+    """Lignes (métrique, base, actuel, écart %, régression?) ; régression si pire
+    de plus de `tolerance` (relatif) et du plancher absolu."""
+    rows = []
+    for path, sense, floor in _COMPARE:
+        b, c = _get(baseline, path), _get(current, path)
+        if b is None or c is None:
+            continue
+        delta = (c - b) / b if b else (0.0 if c == b else float("inf"))
+        worse = (b - c) if sense > 0 else (c - b)
+        rows.append((path, b, c, delta, worse > floor and worse > abs(b) * tolerance))
+    return rows
+
+def _print(report: dict):
+    print(f"débit {report['throughput_rps']} req/s  (retard client p95 {report['client_lag_p95_ms']}ms)")
+    for ep, s in report["endpoints"].items():
+        print(f"  {ep:<8} n={s['count']:<6} err={s['errors']:<4} p50={s['p50_ms']}ms p95={s['p95_ms']}ms "
+              f"p99={s['p99_ms']}ms max={s['max_ms']}ms")
+    if "delivery" in report:
+        d = report["delivery"]
+        print(f"  livraison livrés={d['delivered']} non livrés={d['undelivered']} p50={d['p50_ms']}ms "
+              f"p95={d['p95_ms']}ms p99={d['p99_ms']}ms")
+    q = report["queue"]
+    print(f"  file profondeur max={q['max_depth']} moy={q['avg_depth']} en cours max={q['max_running']}")
+    print(f"  base {report['db']}")
+    print(f"  faux services {report['fakes']}")
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _wait_ready(base: str, proc, timeout_s: float = 30):
+    import urllib.request
+    t0 = time.time()
+    while time.time() - t0 < timeout_s:
+        if proc.poll() is not None:
+            raise RuntimeError("l'app s'est arrêtée au démarrage (voir le log)")
+        try:
+            urllib.request.urlopen(f"{base}/health", timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("l'app n'est pas prête")
+
+def main():
+    ap = argparse.ArgumentParser(description="Banc de charge hors ligne (app.app + faux OpenAI/Twilio)")
+    ap.add_argument("--rate", type=float, default=10, help="requêtes/s visées")
+    ap.add_argument("--duration", type=float, default=30, help="durée du trafic synthétique (s)")
+    ap.add_argument("--users", type=int, default=200)
+    ap.add_argument("--send-ratio", type=float, default=0.0, help="part vers /internal/send (reste : webhook)")
+    ap.add_argument("--arrivals", choices=("poisson", "uniform"), default="poisson")
+    ap.add_argument("--replay", help="trafic enregistré (JSONL)")
+    ap.add_argument("--speed", type=float, default=1.0, help="accélération du replay")
+    ap.add_argument("--mode", choices=("a", "b"), default="a", help="a : file + API Twilio ; b : TwiML")
+    ap.add_argument("--llm-ms", type=float, default=800)
+    ap.add_argument("--llm-jitter", type=float, default=0.3)
+    ap.add_argument("--llm-errors", type=float, default=0.0, help="taux d'erreurs 500/429")
+    ap.add_argument("--twilio-ms", type=float, default=150)
+    ap.add_argument("--twilio-jitter", type=float, default=0.3)
+    ap.add_argument("--twilio-errors", type=float, default=0.0)
+    ap.add_argument("--drain", type=float, default=60, help="attente max de la file après le trafic (s)")
+    ap.add_argument("--env", action="append", default=[], help="variable pour l'app, KEY=VALEUR")
+    ap.add_argument("--seed", type=int, default=7)
+    ap.add_argument("--out", help="rapport JSON")
+    ap.add_argument("--baseline", help="rapport JSON de référence")
+    ap.add_argument("--tolerance", type=float, default=0.2)
+    ap.add_argument("--serve", nargs=2, metavar=("PORT", "TWILIO_URL"), help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.serve:
+        return _serve(int(args.serve[0]), args.serve[1])
+
+    events = _replay(args.replay, args.speed, args.rate) if args.replay else _synthetic(args)
+    oai = FakeOpenAI(args.llm_ms, args.llm_jitter, args.llm_errors)
+    tw = FakeTwilio(args.twilio_ms, args.twilio_jitter, args.twilio_errors)
+    oai_port, tw_port, port = oai.start(), tw.start(), _free_port()
+    tmp = tempfile.mkdtemp(prefix="loadtest-")
+    db_path = os.path.join(tmp, "loadtest.db")
+    env = dict(os.environ, DB_PATH=db_path, METRICS_DIR=os.path.join(tmp, "metrics"),
+               OPENAI_BASE_URL=f"http://127.0.0.1:{oai_port}/v1", OPENAI_API_KEY="x",
+               INTERNAL_TOKEN=TOKEN, VERIFY_TWILIO_SIGNATURE="false", CHECKIN_SCHEDULER="0")
+    if args.mode == "a":
+        env.update(TWILIO_ACCOUNT_SID="ACloadtest", TWILIO_AUTH_TOKEN="x", TWILIO_WHATSAPP_FROM="whatsapp:+10000000000")
+    else:
+        env.update(TWILIO_ACCOUNT_SID="", TWILIO_AUTH_TOKEN="")
+    env.update(kv.split("=", 1) for kv in args.env)
+    log_path = os.path.join(tmp, "app.log")
+    with open(log_path, "w") as log:
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", str(port),
+                                 f"http://127.0.0.1:{tw_port}"], cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base = f"http://127.0.0.1:{port}"
+    print(f"{len(events)} requêtes, mode {args.mode.upper()}, LLM {args.llm_ms:.0f}ms "
+          f"(erreurs {args.llm_errors:.0%}), Twilio {args.twilio_ms:.0f}ms — log : {log_path}", flush=True)
+    try:
+        _wait_ready(base, proc)
+        run = asyncio.run(_drive(base, events, args.mode, args.drain))
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        oai.stop()
+        tw.stop()
+    report = _report(args, run, oai, tw, db_path)
+    _print(report)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("scenario") != report["scenario"]:
+            print("attention : scénario différent de la référence", flush=True)
+        rows = compare(report, baseline, args.tolerance)
+        print(f"\ncomparaison à {args.baseline} (tolérance {args.tolerance:.0%})")
+        for path, b, c, delta, bad in rows:
+            print(f"  {'RÉGRESSION' if bad else 'ok':<10} {path:<28} {b:>10} → {c:<10} ({delta:+.0%})")
+        if any(bad for *_x, bad in rows):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# ops/loadtest_asgi.py — charge comparée : Flask + threads (gunicorn) vs asgi.py (uvicorn)
+# Usage: python ops/loadtest_asgi.py [concurrence] [requêtes] [latence_llm_ms] [threads_flask]
+# Un faux OpenAI local répond après `latence_llm_ms` ; chaque serveur tourne dans
+# un sous-process (DB temporaire) et reçoit `requêtes` POST /internal/send avec
+# `concurrence` clients en parallèle. Mesure débit, p50/p95, erreurs et RSS max.
+
+import os, sys, time, socket, asyncio, tempfile, subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from ops.fakes import FakeOpenAI  # noqa: E402
+
+CONC = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+N = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+LLM_MS = float(sys.argv[3]) if len(sys.argv) > 3 else 800
+FLASK_THREADS = int(sys.argv[4]) if len(sys.argv) > 4 else 32
+TOKEN = "loadtest"
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _rss_kb(pid: int) -> int:
+    # RSS du process et de ses enfants (workers gunicorn)
+    total = 0
+    pids = [pid]
+    try:
+        pids += [int(p) for p in open(f"/proc/{pid}/task/{pid}/children").read().split()]
+    except OSError:
+        pass
+    for p in pids:
+        try:
+            for line in open(f"/proc/{p}/status"):
+                if line.startswith("VmRSS:"):
+                    total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+def _pct(xs, p):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(len(xs) * p))] if xs else 0.0
+
+async def _drive(port: int, proc: subprocess.Popen) -> dict:
+    import aiohttp
+    url = f"http://127.0.0.1:{port}/internal/send"
+    lat, errors, degraded, peak = [], 0, 0, 0
+    todo = iter(range(N))
+
+    async def _client(session):
+        nonlocal errors, degraded
+        for i in todo:
+            t0 = time.perf_counter()
+            try:
+                async with session.post(url, json={"user_id": f"u{i % (CONC * 2)}", "text": f"message {i}"},
+                                        headers={"X-Token": TOKEN}) as r:
+                    data = await r.json(content_type=None)
+                    if r.status != 200:
+                        errors += 1
+                    elif not str(data.get("reply", "")).startswith("ok "):
+                        degraded += 1  # réponse de repli (limiteur/disjoncteur)
+            except Exception:
+                errors += 1
+            lat.append((time.perf_counter() - t0) * 1000)
+
+    async def _sample():
+        nonlocal peak
+        while True:
+            peak = max(peak, _rss_kb(proc.pid))
+            await asyncio.sleep(0.2)
+
+    conn = aiohttp.TCPConnector(limit=CONC)
+    timeout = aiohttp.ClientTimeout(total=120)
+    async with aiohttp.ClientSession(connector=conn, timeout=timeout) as session:
+        sampler = asyncio.create_task(_sample())
+        t0 = time.perf_counter()
+        await asyncio.gather(*[_client(session) for _ in range(CONC)])
+        wall = time.perf_counter() - t0
+        sampler.cancel()
+    return {"rps": round(N / wall, 1), "p50_ms": round(_pct(lat, 0.50)), "p95_ms": round(_pct(lat, 0.95)),
+            "errors": errors, "degraded": degraded, "rss_mb": round(peak / 1024, 1)}
+
+def _wait_ready(port: int, proc: subprocess.Popen, timeout_s: float = 30):
+    import urllib.request
+    t0 = time.time()
+    while time.time() - t0 < timeout_s:
+        if proc.poll() is not None:
+            raise RuntimeError("serveur arrêté au démarrage")
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("serveur pas prêt")
+
+def _run(name: str, cmd, oai_port: int, **extra_env) -> dict:
+    tmp = tempfile.mkdtemp(prefix=f"lt-{name}-")
+    env = dict(os.environ,
+               DB_PATH=os.path.join(tmp, "lt.db"),
+               OPENAI_BASE_URL=f"http://127.0.0.1:{oai_port}/v1",
+               OPENAI_API_KEY="x",
+               INTERNAL_TOKEN=TOKEN,
+               FASTPATH="0",
+               SUMMARY_EVERY_TURNS="0",
+               OPENAI_REQUEST_TIMEOUT="60",
+               TWILIO_ACCOUNT_SID="", TWILIO_AUTH_TOKEN="", **extra_env)
+    port = _free_port()
+    proc = subprocess.Popen([c.format(port=port) for c in cmd], cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait_ready(port, proc)
+        res = asyncio.run(_drive(port, proc))
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+    print(f"{name:<28} {res['rps']:>8} req/s  p50={res['p50_ms']}ms  p95={res['p95_ms']}ms  "
+          f"erreurs={res['errors']}  repli={res['degraded']}  rss={res['rss_mb']}MB", flush=True)
+    return res
+
+def main():
+    oai = FakeOpenAI(LLM_MS, jitter=0)
+    oai_port = oai.start()
+    print(f"concurrence={CONC} requêtes={N} latence LLM={LLM_MS:.0f}ms", flush=True)
+    py = sys.executable
+    _run(f"flask+gunicorn ({FLASK_THREADS} thr)",
+         [py, "-m", "gunicorn", "app:app", "-b", "127.0.0.1:{port}", "-w", "1",
+          "-k", "gthread", "--threads", str(FLASK_THREADS), "--timeout", "120", "--log-level", "warning"],
+         oai_port, LIMIT_INITIAL=str(FLASK_THREADS), OPENAI_POOL_SIZE=str(FLASK_THREADS))
+    _run("asgi+uvicorn",
+         [py, "-m", "uvicorn", "asgi:app", "--host", "127.0.0.1", "--port", "{port}",
+          "--log-level", "warning", "--no-access-log", "--backlog", "2048"],
+         oai_port)
+    oai.stop()
+
+if __name__ == "__main__":
+    main()
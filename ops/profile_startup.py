@@ -0,0 +1,100 @@
+# ops/profile_startup.py — profil du démarrage à froid de app.py
+# Usage: python ops/profile_startup.py [top_n]
+# 1) coût d'import par module (python -X importtime), regroupé par paquet ;
+# 2) phases du démarrage (infra.startup) et étapes du préchauffage (WARMUP=1) ;
+# 3) 1re requête /internal/send vs suivantes, avec et sans préchauffage
+#    (faux OpenAI local, ops/fakes.py).
+# Chaque mesure tourne dans un process neuf (DB temporaire).
+
+import os, sys, json, tempfile, subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from ops.fakes import FakeOpenAI  # noqa: E402
+
+TOP = int(sys.argv[1]) if len(sys.argv) > 1 else 15
+
+_FIRST_REQUESTS = r"""
+import json, time
+t0 = time.perf_counter()
+import app
+t_import = (time.perf_counter() - t0) * 1000
+from infra import startup
+while not startup.status()["ready"]:
+    time.sleep(0.01)
+t_ready = (time.perf_counter() - t0) * 1000
+c = app.app.test_client()
+ms = []
+for i in range(3):
+    t1 = time.perf_counter()
+    r = c.post("/internal/send", json={"user_id": "u1", "text": f"bonjour {i}"}, headers={"X-Token": "t"})
+    assert r.status_code == 200, r.status_code
+    ms.append(round((time.perf_counter() - t1) * 1000, 1))
+print(json.dumps({"import_ms": round(t_import, 1), "ready_ms": round(t_ready, 1), "requests_ms": ms,
+                  "status": startup.status()}))
+"""
+
+def _env(tmp: str, **extra) -> dict:
+    env = dict(os.environ, DB_PATH=os.path.join(tmp, "startup.db"), INTERNAL_TOKEN="t", FASTPATH="0",
+               TWILIO_ACCOUNT_SID="", TWILIO_AUTH_TOKEN="", CHECKIN_SCHEDULER="0", WEBHOOK_WORKERS="1")
+    env.pop("METRICS_DIR", None)
+    env.update(extra)
+    return env
+
+def import_profile(tmp: str):
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], cwd=ROOT, env=_env(tmp),
+                         capture_output=True, text=True).stderr
+    rows = []  # (self_us, cumul_us, profondeur, module)
+    for line in out.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cum_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((int(self_us), int(cum_us), depth, name.strip()))
+    by_pkg = {}
+    for self_us, _cum, _d, name in rows:
+        pkg = name.split(".")[0]
+        by_pkg[pkg] = by_pkg.get(pkg, 0) + self_us
+    total = sum(r[0] for r in rows)
+    print(f"imports : {total / 1000:.0f}ms au total ({len(rows)} modules)")
+    print("  par paquet (temps propre cumulé) :")
+    for pkg, us in sorted(by_pkg.items(), key=lambda x: -x[1])[:TOP]:
+        print(f"    {pkg:<28} {us / 1000:>7.1f}ms")
+    print("  imports directs d'app.py (cumulé) :")
+    app_depth = min((d for *_x, d, n in rows if n == "app"), default=0)
+    direct = [r for r in rows if r[2] == app_depth + 1]
+    for _s, cum, _d, name in sorted(direct, key=lambda r: -r[1])[:TOP]:
+        print(f"    {name:<28} {cum / 1000:>7.1f}ms")
+    heavy = [m for m in ("openai", "twilio", "tiktoken", "httpx", "pydantic") if any(n == m for *_x, n in rows)]
+    print(f"  SDK lourds importés au démarrage : {', '.join(heavy) or 'aucun'}")
+
+def first_requests(tmp: str, oai_port: int, warmup: bool) -> dict:
+    env = _env(tmp, OPENAI_BASE_URL=f"http://127.0.0.1:{oai_port}/v1", OPENAI_API_KEY="x",
+               WARMUP="1" if warmup else "0", WARMUP_HTTP="0")
+    out = subprocess.run([sys.executable, "-c", _FIRST_REQUESTS], cwd=ROOT, env=env, capture_output=True, text=True)
+    line = next((x for x in reversed(out.stdout.splitlines()) if x.startswith('{"import_ms"')), None)
+    if line is None:
+        raise RuntimeError(out.stderr[-2000:])
+    return json.loads(line)
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        import_profile(tmp)
+        oai = FakeOpenAI(latency_ms=50, jitter=0)
+        port = oai.start()
+        try:
+            for warmup in (False, True):
+                with tempfile.TemporaryDirectory() as t2:
+                    r = first_requests(t2, port, warmup)
+                st = r["status"]
+                print(f"\nWARMUP={int(warmup)} : import {r['import_ms']}ms, prêt à {r['ready_ms']}ms "
+                      f"(process {st['process_ms']}ms) ; requêtes 1/2/3 = {r['requests_ms']} ms")
+                print(f"  phases : {st['startup_ms']}")
+                if warmup:
+                    steps = ", ".join(f"{k} {v['ms']}ms" + (" (échec)" if v["error"] else "") for k, v in st["steps"].items())
+                    print(f"  préchauffage : {steps}")
+        finally:
+            oai.stop()
+
+if __name__ == "__main__":
+    main()
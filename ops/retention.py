@@ -0,0 +1,37 @@
+# ops/retention.py — maintenance de l'historique (core.retention) à la demande
+# Usage :
+#   python ops/retention.py --dry-run        # nb de messages qui seraient archivés
+#   python ops/retention.py                  # archive + purge + vacuum + checkpoint
+#   python ops/retention.py --convert        # DB existante → auto_vacuum=INCREMENTAL (hors trafic)
+#   python ops/retention.py --read +33612345678 --since 2024-01 --until 2024-03
+# Mêmes variables que l'app (DB_PATH, ARCHIVE_DIR, RETENTION_*, PROFILES_DIR).
+
+import os, sys, json, argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def main():
+    ap = argparse.ArgumentParser(description="Rétention de l'historique (archives gzip JSONL)")
+    ap.add_argument("--dry-run", action="store_true", help="compte sans archiver ni supprimer")
+    ap.add_argument("--convert", action="store_true", help="VACUUM complet en auto_vacuum=INCREMENTAL")
+    ap.add_argument("--read", metavar="USER_ID", help="affiche l'historique complet (archives + base) en JSONL")
+    ap.add_argument("--since")
+    ap.add_argument("--until")
+    ap.add_argument("--limit", type=int, default=0, help="avec --read : N plus récents (0 = tout)")
+    args = ap.parse_args()
+
+    from core import memory, retention
+    memory.bootstrap_memory()
+    if args.read:
+        for r in retention.history(args.read, args.since, args.until, args.limit):
+            print(json.dumps(r, ensure_ascii=False))
+        return
+    size = lambda: sum(os.path.getsize(memory.DB_PATH + s) for s in ("", "-wal") if os.path.exists(memory.DB_PATH + s))
+    before = size()
+    st = retention.convert() if args.convert else retention.run_once(dry_run=args.dry_run)
+    st["db_bytes_before"], st["db_bytes_after"] = before, size()
+    print(json.dumps(st, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
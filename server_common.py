@@ -0,0 +1,255 @@
+# server_common.py — logique commune aux deux serveurs HTTP (app.py Flask, asgi.py ASGI)
+# - configuration (.env, OpenAI, Twilio, TwiML, INTERNAL_TOKEN) lue une seule fois ;
+# - prompt système compilé, budget d'historique, échéance des appels OpenAI ;
+# - Twilio : prêt ou non, validation de signature, nettoyage du texte sortant, TwiML ;
+# - routes internes : contrôle du jeton, contenu de /internal/stats et /internal/history ;
+# - webhook : lecture du formulaire, mise en file (Option A), réponses différées (Option B).
+# Chaque serveur garde son transport (threads ou coroutines) et ses clients HTTP.
+
+import os, time, threading, unicodedata, importlib.util
+from typing import List, Dict, Callable, Optional
+from xml.sax.saxutils import escape as _xml_escape
+from dotenv import load_dotenv
+
+# ---- .env (avant core : ses modules lisent l'environnement à l'import) ----
+load_dotenv()
+
+import core as coreapp
+from core import prompt as _prompt
+from core import jobs as _jobs
+from core import scheduler as _scheduler
+from core import retention as _retention
+from core import router as _router
+from core import outbox as _outbox
+from core import fastpath as _fastpath
+from core import response_cache as _rcache
+from infra import resilience as _resilience
+from infra.monitoring import log_json as _log, incr as _incr, counters as _counters
+from infra.monitoring import observe as _observe, observations as _observations
+from infra.monitoring import span as _span
+
+# ---- OpenAI (timeouts/retries) ----
+OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+OPENAI_MODEL = os.environ.get("OPENAI_MODEL", "gpt-4o-mini")  # route "chat" (core.router) ; modèle par route
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_REQUEST_TIMEOUT", "8"))
+OPENAI_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "1"))
+OPENAI_MAX_TOKENS = int(os.environ.get("OPENAI_MAX_TOKENS", "180"))
+FALLBACK_REPLY = "Désolé, je ne peux pas répondre pour le moment."
+
+def openai_budget(deadline: Optional[float]):
+    """(timeout, retries) bornés par l'échéance (epoch), ou None si elle est dépassée."""
+    if deadline is None:
+        return OPENAI_TIMEOUT, OPENAI_RETRIES
+    remaining = deadline - time.time()
+    if remaining <= 0.2:
+        return None
+    timeout = min(OPENAI_TIMEOUT, remaining)
+    # pas de retry SDK s'il ne tient pas dans le temps restant
+    retries = OPENAI_RETRIES if remaining >= timeout * (OPENAI_RETRIES + 1) else 0
+    return timeout, retries
+
+# ---- Prompt système ----
+SYSTEM_PROMPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "LLM_SYSTEM_PROMPT.txt")
+DEFAULT_SYSTEM_PROMPT = "Tu es un compagnon simple et bienveillant. Phrases courtes. Ton chaleureux."
+
+def system_prompt():
+    """Prompt système compilé (texte + tokens), relu seulement si le fichier change."""
+    version = _prompt.file_version(SYSTEM_PROMPT_PATH)
+    return _prompt.compile_prompt(
+        ("app", SYSTEM_PROMPT_PATH, version),
+        lambda: _prompt.read_text(SYSTEM_PROMPT_PATH, DEFAULT_SYSTEM_PROMPT),
+    )
+
+def history_budget(user_text: str) -> int:
+    """Tokens pour l'historique (budgets de core.prompt) ; 0 = ancien mode."""
+    return _prompt.history_budget(system_prompt().tokens, user_text)
+
+def prompt_messages(user_text: str, history: List[Dict]) -> List[Dict]:
+    with _span("prompt_build"):
+        msgs = [{"role": "system", "content": system_prompt().text}]
+        msgs.extend(_prompt.history_messages(history))
+        msgs.append({"role": "user", "content": user_text})
+    return msgs
+
+def warm_prompts():
+    from core import llm
+    system_prompt()
+    llm.system_prompt(os.environ.get("PROFILE_PATH", "profile.json"))
+    _prompt.estimate_tokens("préchauffage")  # tokenizer
+
+# ---- Twilio ----
+# SDK importé au premier envoi / à la première vérification de signature
+# (ou par le préchauffage), pas au démarrage.
+TWILIO_SDK_OK = importlib.util.find_spec("twilio") is not None
+
+TWILIO_SID   = os.environ.get("TWILIO_ACCOUNT_SID")
+TWILIO_TOKEN = os.environ.get("TWILIO_AUTH_TOKEN")
+# >>> multi-ENV pour FROM (évite les confusions entre noms)
+TWILIO_FROM  = (
+    os.environ.get("TWILIO_WHATSAPP_FROM")
+    or os.environ.get("TWILIO_SANDBOX_FROM")
+    or os.environ.get("TWILIO_FROM")
+    or os.environ.get("TWILIO_WHATSAPP_NUMBER")
+    or ""
+)
+VERIFY_TWILIO_SIGNATURE = (os.environ.get("VERIFY_TWILIO_SIGNATURE", "false").lower() == "true")
+TWILIO_LATENCY_TARGET_S = float(os.environ.get("TWILIO_LATENCY_TARGET", "3"))
+
+_validator = {}
+_validator_lock = threading.Lock()
+
+def twilio_ready() -> bool:
+    return bool(TWILIO_SDK_OK and TWILIO_SID and TWILIO_TOKEN and TWILIO_FROM.startswith("whatsapp:"))
+
+def outbox_ready() -> bool:
+    return _outbox.ENABLED and twilio_ready()
+
+def twilio_failure(e: BaseException) -> bool:
+    # 4xx (numéro invalide, etc.) hors 429 : pas une panne Twilio
+    status = getattr(e, "status", None)
+    return not (isinstance(status, int) and 400 <= status < 500 and status != 429)
+
+def twilio_validator():
+    v = _validator.get("v")
+    if v is None and VERIFY_TWILIO_SIGNATURE and TWILIO_SDK_OK and TWILIO_TOKEN:
+        with _validator_lock:
+            v = _validator.get("v")
+            if v is None:
+                from twilio.request_validator import RequestValidator
+                v = _validator["v"] = RequestValidator(TWILIO_TOKEN)
+    return v
+
+def verify_twilio(url: str, params: Dict[str, str], signature: str) -> bool:
+    if not VERIFY_TWILIO_SIGNATURE:
+        return True
+    validator = twilio_validator()
+    if not validator:
+        return False
+    try:
+        with _span("signature"):
+            return validator.validate(url, params, signature)
+    except Exception as e:
+        print(f"[SIG][err] {e}", flush=True)
+        return False
+
+def clean_outgoing(text: str) -> str:
+    s = unicodedata.normalize("NFC", text or "")
+    s = s.replace("\u202f", " ").replace("\xa0", " ")
+    try:
+        s.encode("utf-8")
+    except Exception:
+        s = s.encode("utf-8", "ignore").decode("utf-8", "ignore")
+    return s
+
+def twiml(*messages: str) -> str:
+    body = "".join(f"<Message>{_xml_escape(clean_outgoing(m))}</Message>" for m in messages if m)
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<Response>{body}</Response>"""
+
+# ---- Routes internes ----
+def authorized(token: str, authorization: str = "") -> bool:
+    """X-Token (ou « Authorization: Bearer ») égal à INTERNAL_TOKEN ; tout refusé s'il n'est pas défini."""
+    expect = os.environ.get("INTERNAL_TOKEN") or ""
+    if not expect:
+        return False
+    return token == expect or (bool(authorization) and authorization.removeprefix("Bearer ") == expect)
+
+def stats_payload(dispatch: Dict) -> Dict:
+    # lit la DB (jobs, outbox) : thread à part côté ASGI
+    from core import llm  # importé à la demande (SDK openai lourd)
+    return {
+        "fastpath": _fastpath.stats(),
+        "response_cache": _rcache.stats(),
+        "upstreams": _resilience.stats(),
+        "openai_pool": llm.client_stats(),
+        "history_cache": coreapp.history_cache_stats(),
+        "dispatch": dispatch,
+        "jobs": _jobs.stats(),
+        "checkins": _scheduler.stats(),
+        "retention": _retention.stats(),
+        "router": _router.stats(),
+        "outbox": _outbox.stats(),
+        "counters": _counters(),
+        "timings": _observations(all_workers=True),
+    }
+
+def history_query(arg: Callable[[str], Optional[str]]) -> tuple:
+    """(statut, corps JSON) de /internal/history ; ?user_id=...&since=AAAA-MM[-JJ]&until=...&limit=..."""
+    user_id = (arg("user_id") or "").strip()
+    if not user_id:
+        return 400, {"error": "user_id requis"}
+    try:
+        limit = int(arg("limit") or "1000")
+    except ValueError:
+        return 400, {"error": "limit invalide"}
+    rows = coreapp.full_history(user_id, arg("since"), arg("until"), limit)
+    return 200, {"user_id": user_id, "count": len(rows), "messages": rows}
+
+def send_params(data: Dict) -> tuple:
+    """(texte, user_id) d'un POST /internal/send."""
+    return (data.get("text") or "").strip() or "ping", (data.get("user_id") or "local")
+
+# ---- Webhook WhatsApp ----
+def webhook_fields(form: Dict[str, str]) -> tuple:
+    """(sender, texte, MessageSid) du formulaire Twilio."""
+    return form.get("From") or "", (form.get("Body") or "").strip() or "Salut", form.get("MessageSid")
+
+def enqueue_incoming(sender: str, text_in: str, msg_sid: Optional[str], req_id: str) -> bool:
+    """Option A : message mis dans la file durable ; False si elle est pleine (→ 503)."""
+    try:
+        _jobs.enqueue("whatsapp_in", {"sender": sender, "text": text_in, "msg_sid": msg_sid, "req_id": req_id})
+    except _jobs.QueueFull as e:
+        coreapp.forget_sid(msg_sid)  # sinon le retry de Twilio serait écarté en [DUP]
+        print(f"[JOBS][full] {e} sid={msg_sid} rejeté", flush=True)
+        return False
+    except Exception:
+        coreapp.forget_sid(msg_sid)
+        raise
+    return True
+
+# ---- Option B : budget de latence + livraison différée ----
+TWIML_BUDGET_S = float(os.environ.get("TWIML_BUDGET", "10"))   # < 15 s (timeout Twilio)
+TWIML_GRACE_S = float(os.environ.get("TWIML_GRACE", "20"))     # temps de plus pour la réponse différée
+TWIML_ACK_TEXT = os.environ.get("TWIML_ACK_TEXT", "Je réfléchis… je te réponds dans un instant.")
+
+def twiml_outcome(outcome: str, t0: float):
+    """Réponse TwiML partie (in_time : la vraie réponse, deferred : l'accusé)."""
+    ms = (time.time() - t0) * 1000
+    _observe("ttfm_ms", ms)
+    _incr(f"twiml_{outcome}")
+    _log("twiml", outcome=outcome, ms=int(ms))
+
+class DeferredReplies:
+    """Réponses arrivées après le budget TwiML, en attente d'un moyen d'envoi."""
+
+    def __init__(self, per_user: int = 3, max_users: int = 1000):
+        self.per_user = per_user
+        self.max_users = max_users
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def put(self, sender: str, reply: str):
+        with self._lock:
+            lst = self._items.setdefault(sender, [])
+            lst.append(reply)
+            del lst[:-self.per_user]
+            while len(self._items) > self.max_users:
+                self._items.pop(next(iter(self._items)))
+
+    def pop(self, sender: str) -> List[str]:
+        with self._lock:
+            return self._items.pop(sender, [])
+
+# ---- Tâches de fond ----
+def start_services(outbox_sender: Callable, checkin_sender: Optional[Callable] = None):
+    """core.outbox (si Twilio prêt), check-ins (CHECKIN_SCHEDULER=1, avec un expéditeur) et rétention (RETENTION=1)."""
+    if outbox_ready():
+        _outbox.bootstrap()
+        _outbox.set_sender(outbox_sender)
+        _outbox.start()  # reprend aussi les envois laissés en file par le process précédent
+    if checkin_sender is not None and os.environ.get("CHECKIN_SCHEDULER", "0") == "1":
+        _scheduler.bootstrap()
+        _scheduler.set_sender(checkin_sender)
+        _scheduler.start()
+    if os.environ.get("RETENTION", "0") == "1":
+        _retention.start()